@@ -26,27 +26,26 @@
 
 """
 OCBase setup FCU, OSU, EIM and LBU connection objects to Outscale Cloud.
+
+Connections are handed out by a ConnectionPool: each thread gets its own
+connection objects, so OCBase can be used from many threads at once.
 """
 
 __author__      = "Heckle"
 __copyright__   = "BSD"
 
 
-import sys
-import logging
-import boto
+import threading
+import contextlib
+from functools import partial
 import ConfigParser
 import os.path
 import os
 import urlparse
-import boto.s3.connection
-from boto.ec2.regioninfo import EC2RegionInfo
-from boto.ec2.regioninfo import RegionInfo
-from boto.iam.connection import IAMConnection
-from boto.ec2.elb import ELBConnection
 
-from osc_cloud_builder.vendor.outscale.icu import ICUConnection
-from osc_cloud_builder.vendor.outscale.fcu import FCUConnection
+# boto and the connection classes are imported by the connection factories,
+# scripts only pay for the services they use
+from osc_cloud_builder import logs
 
 
 SLEEP_SHORT = 5
@@ -65,14 +64,165 @@ class OCBError(RuntimeError):
     pass
 
 
-class OCBase(object):
+class ConnectionPool(object):
     """
-    Manage API connections (FCU, OSU, EIM, LBU) and provide centralized logging system
+    Connections per endpoint and credentials.
+    get() returns a connection bound to the calling thread, checkout() lends a connection
+    for exclusive use. Connections keep their HTTP connections alive between calls.
     """
 
-    __metaclass__ = Singleton
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._factories = {}
+        self._idle = {}
+
+    def register(self, key, factory):
+        """
+        :param key: connection identifier, (service, endpoint, access key, options...)
+        :type key: tuple
+        :param factory: callable creating a new connection
+        :type factory: callable
+        """
+        with self._lock:
+            self._factories[key] = factory
+
+    def _create(self, key):
+        with self._lock:
+            factory = self._factories[key]
+        return factory()
 
-    def __init__(self, region='eu-west-2', settings_paths=['~/.osc_cloud_builder/services.ini', '/etc/osc_cloud_builder/services.ini'], is_secure=True, boto_debug=0, debug_filename='/tmp/ocb.log', debug_level='INFO'):
+    def get(self, key):
+        """
+        :param key: connection identifier given to register()
+        :type key: tuple
+        :return: connection of the calling thread
+        """
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if key not in connections:
+            connections[key] = self._create(key)
+        return connections[key]
+
+    @contextlib.contextmanager
+    def checkout(self, key):
+        """
+        Lend a connection which is not used by any other thread until the end of the block
+        :param key: connection identifier given to register()
+        :type key: tuple
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        if connection is None:
+            connection = self._create(key)
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                self._idle.setdefault(key, []).append(connection)
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+def _with_cache(factory, cache):
+    connection = factory()
+    connection.cache = cache
+    return connection
+
+
+def _split_endpoint(endpoint):
+    """
+    :param endpoint: host or host:port
+    :type endpoint: str
+    :return: host and port, port is None when not given
+    :rtype: tuple
+    """
+    host, _, port = endpoint.partition(':')
+    return host, int(port) if port else None
+
+
+def _connect_fcu(access_key_id, secret_access_key, endpoint, **kwargs):
+    """
+    :param endpoint: host or host:port
+    :type endpoint: str
+    :rtype: osc_cloud_builder.vendor.outscale.fcu.FCUConnection
+    """
+    from boto.ec2.regioninfo import EC2RegionInfo
+    from osc_cloud_builder.vendor.outscale.fcu import FCUConnection
+    host, port = _split_endpoint(endpoint)
+    return FCUConnection(access_key_id, secret_access_key, region=EC2RegionInfo(endpoint=host), port=port, **kwargs)
+
+
+def _connect_lbu(access_key_id, secret_access_key, endpoint, **kwargs):
+    """
+    :param endpoint: host or host:port
+    :type endpoint: str
+    :rtype: osc_cloud_builder.vendor.outscale.lbu.LBUConnection
+    """
+    from boto.ec2.regioninfo import EC2RegionInfo
+    from osc_cloud_builder.vendor.outscale.lbu import LBUConnection
+    host, port = _split_endpoint(endpoint)
+    return LBUConnection(access_key_id, secret_access_key, region=EC2RegionInfo(endpoint=host), port=port, **kwargs)
+
+
+def _connect_eim(access_key_id, secret_access_key, endpoint, **kwargs):
+    """
+    :rtype: osc_cloud_builder.vendor.outscale.eim.EIMConnection
+    """
+    from osc_cloud_builder.vendor.outscale.eim import EIMConnection
+    return EIMConnection(access_key_id, secret_access_key, host=endpoint, **kwargs)
+
+
+def _connect_osu(access_key_id, secret_access_key, endpoint, **kwargs):
+    """
+    :param endpoint: host or host:port
+    :type endpoint: str
+    :rtype: osc_cloud_builder.vendor.outscale.osu.OSUConnection
+    """
+    from boto.s3.connection import ProtocolIndependentOrdinaryCallingFormat
+    from osc_cloud_builder.vendor.outscale.osu import OSUConnection
+    host, port = _split_endpoint(endpoint)
+    return OSUConnection(access_key_id, secret_access_key, host=host, port=port,
+                         calling_format=ProtocolIndependentOrdinaryCallingFormat(), **kwargs)
+
+
+DEFAULT_SETTINGS_PATHS = ['~/.osc_cloud_builder/services.ini', '/etc/osc_cloud_builder/services.ini']
+
+
+def load_settings(settings_paths=DEFAULT_SETTINGS_PATHS):
+    """
+    Read services.ini, the last existing path of settings_paths is used,
+    the services.ini of the package if none exists
+    :param settings_paths: paths where services.init should be
+    :type settings_paths: list
+    :rtype: ConfigParser.ConfigParser
+    """
+    settings = ConfigParser.ConfigParser()
+    settings_path = None
+
+    for set_path in settings_paths:
+        if os.path.exists(os.path.expanduser(set_path)):
+            settings_path = os.path.expanduser(set_path)
+    if not settings_path:
+        full_path = os.path.realpath(__file__)
+        base_path = os.path.dirname(full_path)
+        settings_path = '{0}/../services.ini'.format(base_path)
+    settings.read(filenames=settings_path)
+    return settings
+
+
+class OCBConnections(object):
+    """
+    API connections (FCU, OSU, EIM, LBU, ICU) of one services.ini section.
+    Unlike OCBase, it is not a singleton: several accounts or regions can be used at once.
+    """
+
+    SERVICES = ('fcu', 'lbu', 'eim', 'osu', 'icu')
+
+    def __init__(self, region='eu-west-2', settings_paths=DEFAULT_SETTINGS_PATHS, is_secure=True, boto_debug=0, use_environment=True, cache=None):
         """
         :param region: region choosen for loading settings.ini section
         :type region: str
@@ -82,29 +232,20 @@ class OCBase(object):
         :type is_secure: bool
         :param boto_debug: debug level for boto
         :type boto_debug: int
-        :param debug_filename: File to store logs
-        :type debug_filename: str
+        :param use_environment: credentials and endpoints from environment variables override services.ini
+        :type use_environment: bool
+        :param cache: cache of reference data (catalogs, instance and product types) for FCU and ICU connections
+        :type cache: osc_cloud_builder.vendor.outscale.cache.TTLCache
         """
-        self.__logger_setup(debug_filename, debug_level)
         self.region = region
         self.settings_paths = settings_paths
+        self.use_environment = use_environment
+        self.cache = cache
+        self.connection_keys = dict((service, None) for service in self.SERVICES)
         self.__connections_setup(is_secure, boto_debug)
 
-    def __logger_setup(self, debug_filename, debug_level):
-        """
-        Logger setup
-        :param debug_filename: File to store logs
-        :type debug_filename: str
-        :param debug_level: level debug
-        :type debug_level: str
-        """
-        debug_level = getattr(logging, debug_level)
-        self.__logger = logging.getLogger()
-        logging.basicConfig(filename=debug_filename,
-                            filemode='a',
-                            level=debug_level,
-                            format='%(asctime)s.%(msecs)d %(levelname)s - %(message)s',
-                            datefmt="%Y-%m-%d %H:%M:%S")
+    def __repr__(self):
+        return '{0}:{1}'.format(self.__class__.__name__, self.region)
 
     def __load_config(self):
         """
@@ -115,51 +256,41 @@ class OCBase(object):
         endpoints['lbu'] = None
         endpoints['eim'] = None
         endpoints['osu'] = None
-        settings = ConfigParser.ConfigParser()
-        settings_path = None
+        settings = load_settings(self.settings_paths)
+        environ = os.environ if self.use_environment else {}
 
-        for set_path in self.settings_paths:
-            if os.path.exists(set_path):
-                settings_path = set_path
-        if not settings_path:
-            full_path = os.path.realpath(__file__)
-            base_path = os.path.dirname(full_path)
-            settings_path = '{0}/../services.ini'.format(base_path)
-        settings.read(filenames=settings_path)
-
-
-        access_key_id = os.environ.get('AWS_ACCESS_KEY_ID', None)
-        secret_access_key = os.environ.get('AWS_SECRET_ACCESS_KEY', None)
+        access_key_id = environ.get('AWS_ACCESS_KEY_ID', None)
+        secret_access_key = environ.get('AWS_SECRET_ACCESS_KEY', None)
         if not access_key_id or not secret_access_key:
             try:
                 access_key_id = settings.get(self.region, 'access_key_id', None)
                 secret_access_key = settings.get(self.region, 'secret_access_key', None)
             except ConfigParser.Error:
-                self.__logger.critical('You must setup both AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variable or in your settings.ini file')
+                self.log('You must setup both AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variable or in your settings.ini file', 'critical')
                 raise OCBError('Bad credential (access_key_id, secret_access_key) setup')
 
-        endpoints['fcu'] = os.environ.get('FCU_ENDPOINT', None)
+        endpoints['fcu'] = environ.get('FCU_ENDPOINT', None)
         if not endpoints['fcu']:
             try:
                 endpoints['fcu'] = settings.get(self.region, 'fcu_endpoint')
             except ConfigParser.Error:
                 self.log('No fcu_endpoint set', 'warning')
 
-        endpoints['lbu'] = os.environ.get('LBU_ENDPOINT', None)
+        endpoints['lbu'] = environ.get('LBU_ENDPOINT', None)
         if not endpoints['lbu']:
             try:
                 endpoints['lbu'] = settings.get(self.region, 'lbu_endpoint')
             except ConfigParser.Error:
                 self.log('No lbu_endpoint set', 'warning')
 
-        endpoints['eim'] = os.environ.get('EIM_ENDPOINT', None)
+        endpoints['eim'] = environ.get('EIM_ENDPOINT', None)
         if not endpoints['eim']:
             try:
                 endpoints['eim'] = settings.get(self.region, 'eim_endpoint')
             except ConfigParser.Error:
                 self.log('No eim_endpoint set', 'warning')
 
-        endpoints['osu'] = os.environ.get('OSU_ENDPOINT', None)
+        endpoints['osu'] = environ.get('OSU_ENDPOINT', None)
         if not endpoints['osu']:
             try:
                 endpoints['osu'] = settings.get(self.region, 'osu_endpoint')
@@ -167,14 +298,14 @@ class OCBase(object):
                 self.log('No osu_endpoint set', 'warning')
 
         icu = {}
-        icu['endpoint'] = os.environ.get('ICU_ENDPOINT', None)
-        icu['login'] = os.environ.get('ICU_LOGIN', '')
-        icu['password'] = os.environ.get('ICU_PASSWORD', '')
+        icu['endpoint'] = environ.get('ICU_ENDPOINT', None)
+        icu['login'] = environ.get('ICU_LOGIN', '')
+        icu['password'] = environ.get('ICU_PASSWORD', '')
         if not icu['endpoint']:
             try:
                 icu['endpoint'] = settings.get(self.region, 'icu_endpoint')
                 icu['login'] = settings.get(self.region, 'icu_login')
-                icu['endpoint'] = settings.get(self.region, 'icu_password')
+                icu['password'] = settings.get(self.region, 'icu_password')
             except ConfigParser.Error:
                 self.log('No icu_endpoint set', 'warning')
 
@@ -193,7 +324,7 @@ class OCBase(object):
         :param dict kwargs:
         :return class: `outscale.boto.icu.ICUConnection`
         """
-        if not url.startswith('https://'):
+        if '://' not in url:
             url = 'https://{0}'.format(url)
         purl = urlparse.urlparse(url)
         kwargs['port'] = purl.port
@@ -201,18 +332,20 @@ class OCBase(object):
         if not 'is_secure' in kwargs:
             kwargs['is_secure'] = (purl.scheme == "https")
 
-        kwargs['host'] = RegionInfo(name=purl.hostname, endpoint=purl.hostname).endpoint
+        kwargs['host'] = purl.hostname
         kwargs['aws_access_key_id'] = aws_access_key_id
         kwargs['aws_secret_access_key'] = aws_secret_access_key
         kwargs['login'] = login
         kwargs['password'] = password
 
+        from osc_cloud_builder.vendor.outscale.icu import ICUConnection
         return ICUConnection(**kwargs)
 
 
     def __connections_setup(self, is_secure, boto_debug):
         """
-        Creates FCU, OSU and EIM connections if endpoints are configured
+        Registers the factories of the connections whose endpoints are configured,
+        a connection is created on the first access of each thread to its service
         :param is_secure: allow connection without SSL
         :type is_secure: bool
         :param boto_debug: debug level for boto
@@ -221,68 +354,121 @@ class OCBase(object):
         """
 
         access_key_id, secret_access_key, endpoints, icu_conn = self.__load_config()
+        factories = {}
 
         if endpoints['fcu']:
-            fcu_endpoint = EC2RegionInfo(endpoint=endpoints['fcu'])
-            self.fcu = FCUConnection(access_key_id, secret_access_key, region=fcu_endpoint, is_secure=is_secure, debug=boto_debug)
+            factories['fcu'] = partial(_connect_fcu, access_key_id, secret_access_key, endpoints['fcu'], is_secure=is_secure, debug=boto_debug)
         else:
-            self.__logger.info('No FCU connection configured')
-            self.fcu = None
+            self.log('No FCU connection configured', 'info')
 
         if endpoints['lbu']:
-            lbu_endpoint = EC2RegionInfo(endpoint=endpoints['lbu'])
-            self.lbu = ELBConnection(access_key_id, secret_access_key, region=lbu_endpoint, debug=boto_debug)
+            factories['lbu'] = partial(_connect_lbu, access_key_id, secret_access_key, endpoints['lbu'], is_secure=is_secure, debug=boto_debug)
         else:
-            self.__logger.info('No LBU connection configured')
-            self.lbu = None
+            self.log('No LBU connection configured', 'info')
 
         if endpoints['eim']:
-            self.eim = IAMConnection(access_key_id, secret_access_key, host=endpoints['eim'], debug=boto_debug)
+            factories['eim'] = partial(_connect_eim, access_key_id, secret_access_key, endpoints['eim'], is_secure=is_secure, debug=boto_debug)
         else:
-            self.__logger.info('No EIM connection configured')
-            self.eim = None
+            self.log('No EIM connection configured', 'info')
 
         if endpoints['osu']:
-            self.osu = boto.connect_s3(access_key_id, secret_access_key, host=endpoints['osu'],
-                                       calling_format=boto.s3.connection.ProtocolIndependentOrdinaryCallingFormat())
+            factories['osu'] = partial(_connect_osu, access_key_id, secret_access_key, endpoints['osu'], is_secure=is_secure, debug=boto_debug)
         else:
-            self.__logger.info('No OSU connection configured')
-            self.osu = None
+            self.log('No OSU connection configured', 'info')
 
         if icu_conn['endpoint']:
-            self.icu = self.__connect_icu(icu_conn['endpoint'], access_key_id, secret_access_key, icu_conn['login'], icu_conn['password'])
+            endpoints['icu'] = icu_conn['endpoint']
+            factories['icu'] = partial(self.__connect_icu, icu_conn['endpoint'], access_key_id, secret_access_key, icu_conn['login'], icu_conn['password'])
         else:
-            self.__logger.info('No ICU connection configured')
-            self.icu = None
+            self.log('No ICU connection configured', 'info')
+
+        if self.cache is not None:
+            for service in ('fcu', 'icu'):
+                if service in factories:
+                    factories[service] = partial(_with_cache, factories[service], self.cache)
+
+        for service in self.SERVICES:
+            if service in factories:
+                key = (service, endpoints[service], access_key_id, is_secure, boto_debug, id(self.cache))
+                CONNECTION_POOL.register(key, factories[service])
+                self.connection_keys[service] = key
+            else:
+                self.connection_keys[service] = None
+
+    def connection(self, service):
+        """
+        :param service: one of fcu, lbu, eim, osu, icu
+        :type service: str
+        :return: connection of the calling thread to the service, None if the service is not configured
+        """
+        key = self.connection_keys[service]
+        if key is None:
+            return None
+        return CONNECTION_POOL.get(key)
 
+    @contextlib.contextmanager
+    def checkout(self, service):
+        """
+        Lend a connection to the service which is not shared with any other thread until the end of the block
+        :param service: one of fcu, lbu, eim, osu, icu
+        :type service: str
+        :raises OCBError: When the service is not configured
+        """
+        key = self.connection_keys[service]
+        if key is None:
+            raise OCBError('No {0} connection configured'.format(service.upper()))
+        with CONNECTION_POOL.checkout(key) as connection:
+            yield connection
 
-    def log(self, message, level='debug', module_name=''):
+    def async_connection(self, service, max_workers=32):
+        """
+        Non blocking connection to FCU or ICU, calls return futures
+        :param service: fcu or icu
+        :type service: str
+        :param max_workers: maximum number of calls in flight
+        :type max_workers: int
+        :rtype: osc_cloud_builder.vendor.outscale.nonblocking.AsyncConnection
+        :raises OCBError: When the service is not configured
         """
-        Centralized log system
-        :param message: Message to be logged
+        if self.connection_keys.get(service) is None:
+            raise OCBError('No {0} connection configured'.format(service.upper()))
+        from osc_cloud_builder.vendor.outscale.nonblocking import AsyncFCUConnection, AsyncICUConnection
+        classes = {'fcu': AsyncFCUConnection, 'icu': AsyncICUConnection}
+        return classes[service](partial(self.connection, service), max_workers)
+
+    @property
+    def fcu(self):
+        return self.connection('fcu')
+
+    @property
+    def lbu(self):
+        return self.connection('lbu')
+
+    @property
+    def eim(self):
+        return self.connection('eim')
+
+    @property
+    def osu(self):
+        return self.connection('osu')
+
+    @property
+    def icu(self):
+        return self.connection('icu')
+
+    def log(self, message, level='debug', module_name='', *args, **kwargs):
+        """
+        Centralized log system, the message is formatted only if level is enabled
+        :param message: Message to be logged, formatted with str.format(*args) if args are given
         :type message: str
         :param module_name: Module name where the message is coming
         :type module_name: str
         :param level: message level
         :type level: str
+        :param resource_ids: keyword only, IDs of the ressources involved, added to JSON records
+        :type resource_ids: list
         """
-        try:
-            log = getattr(self.__logger, level)
-        except AttributeError:
-            log = getattr(self.__logger, 'debug')
-        log('{0} - {1}'.format(module_name, message))
-
-
-    def activate_stdout_logging(self):
-        """
-        Display logging messages in stdout
-        """
-        ch = logging.StreamHandler(sys.stdout)
-        logging.StreamHandler(sys.stdout)
-        ch.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
-        self.__logger.addHandler(ch)
+        logs.log(message, level, module_name, args, kwargs.get('resource_ids'))
 
     def reload(self, region, is_secure=True, boto_debug=0, debug_filename='/tmp/ocb.log', debug_level='INFO'):
         """
@@ -290,3 +476,51 @@ class OCBase(object):
         """
         self.region = region
         self.__connections_setup(is_secure, boto_debug)
+
+
+class OCBase(OCBConnections):
+    """
+    Manage API connections (FCU, OSU, EIM, LBU) and provide centralized logging system
+    """
+
+    __metaclass__ = Singleton
+
+    def __init__(self, region='eu-west-2', settings_paths=DEFAULT_SETTINGS_PATHS, is_secure=True, boto_debug=0, debug_filename='/tmp/ocb.log', debug_level='INFO', cache=None, debug_json=False):
+        """
+        :param region: region choosen for loading settings.ini section
+        :type region: str
+        :param settings_paths: paths where services.init should be if needed
+        :type settings_paths: list
+        :param is_secure: allow connector without ssl
+        :type is_secure: bool
+        :param boto_debug: debug level for boto
+        :type boto_debug: int
+        :param debug_filename: File to store logs
+        :type debug_filename: str
+        :param cache: cache of reference data, see osc_cloud_builder.vendor.outscale.cache.get_cache
+        :type cache: osc_cloud_builder.vendor.outscale.cache.TTLCache
+        :param debug_json: write logs as JSON lines carrying the ressource IDs
+        :type debug_json: bool
+        """
+        self.__logger_setup(debug_filename, debug_level, debug_json)
+        super(OCBase, self).__init__(region, settings_paths, is_secure, boto_debug, cache=cache)
+
+    def __logger_setup(self, debug_filename, debug_level, debug_json):
+        """
+        Logger setup, records are written by a background thread
+        :param debug_filename: File to store logs
+        :type debug_filename: str
+        :param debug_level: level debug
+        :type debug_level: str
+        :param debug_json: write JSON lines
+        :type debug_json: bool
+        """
+        self.__logger = logs.setup_logging(debug_filename, debug_level, debug_json)
+
+    def activate_stdout_logging(self, json_format=False):
+        """
+        Display logging messages in stdout, calling it again does not duplicate messages
+        :param json_format: display JSON lines
+        :type json_format: bool
+        """
+        logs.add_stdout_handler(json_format)
@@ -0,0 +1,1432 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Local stand-in for the FCU, LBU, ICU and OSU APIs, to run OCB without network.
+
+FCU and LBU calls use the query protocol, ICU calls the JSON protocol
+(X-Amz-Target: TinaIcuService.*), OSU calls the S3 REST protocol with path style
+URLs (objects, ranged GET and multipart uploads). Ressources live in memory and change state
+after MockCloud.transition_delay seconds, so waiters behave like on the real cloud.
+Latency, error rate and size of reference data responses are configurable.
+
+    with MockServer(latency=0.01, error_rate=0.01) as server:
+        server.write_settings('/tmp/mock_services.ini')
+        ocb = OCBConnections('mock', ['/tmp/mock_services.ini'], is_secure=False, use_environment=False)
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import urlparse
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+OWNER_ID = '123456789012'
+AVAILABILITY_ZONE = 'mock-1a'
+FCU_NAMESPACE = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+LBU_NAMESPACE = 'http://elasticloadbalancing.amazonaws.com/doc/2012-06-01/'
+OSU_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+ICU_TARGET_PREFIX = 'TinaIcuService.'
+
+INSTANCE_STATE_CODES = {
+    'pending': 0,
+    'running': 16,
+    'shutting-down': 32,
+    'terminated': 48,
+    'stopping': 64,
+    'stopped': 80,
+}
+
+# ressource kind -> error code when an unknown ID is requested
+NOT_FOUND_CODES = {
+    'instance': 'InvalidInstanceID.NotFound',
+    'vpc': 'InvalidVpcID.NotFound',
+    'subnet': 'InvalidSubnetID.NotFound',
+    'security_group': 'InvalidGroup.NotFound',
+    'internet_gateway': 'InvalidInternetGatewayID.NotFound',
+    'route_table': 'InvalidRouteTableID.NotFound',
+    'nat_gateway': 'NatGatewayNotFound',
+    'address': 'InvalidAllocationID.NotFound',
+    'network_interface': 'InvalidNetworkInterfaceID.NotFound',
+    'snapshot': 'InvalidSnapshot.NotFound',
+    'snapshot_export_task': 'InvalidSnapshotExportTaskID.NotFound',
+    'image_export_task': 'InvalidImageExportTaskID.NotFound',
+    'load_balancer': 'LoadBalancerNotFound',
+}
+
+# quota name -> (ressource kind, maximum), the global quotas of the account
+QUOTA_LIMITS = {
+    'vm_limit': ('instance', 1000),
+    'eip_limit': ('address', 100),
+    'vpc_limit': ('vpc', 50),
+    'subnet_limit': ('subnet', 200),
+    'security_group_limit': ('security_group', 500),
+    'igw_limit': ('internet_gateway', 50),
+    'nat_gateway_limit': ('nat_gateway', 50),
+    'lbu_limit': ('load_balancer', 50),
+}
+
+# ressource kind -> filter name -> ressource key
+FILTER_KEYS = {
+    'instance': {'vpc-id': 'vpc_id', 'subnet-id': 'subnet_id', 'instance-id': 'id', 'instance-state-name': 'state'},
+    'vpc': {'vpc-id': 'id', 'cidr': 'cidr'},
+    'subnet': {'vpc-id': 'vpc_id', 'subnet-id': 'id', 'cidr': 'cidr'},
+    'security_group': {'vpc-id': 'vpc_id', 'group-id': 'id', 'group-name': 'name'},
+    'internet_gateway': {'attachment.vpc-id': 'vpc_id', 'internet-gateway-id': 'id'},
+    'route_table': {'vpc-id': 'vpc_id', 'route-table-id': 'id'},
+    'nat_gateway': {'vpc-id': 'vpc_id', 'subnet-id': 'subnet_id', 'nat-gateway-id': 'id', 'state': 'state'},
+    'address': {'instance-id': 'instance_id', 'allocation-id': 'id', 'public-ip': 'public_ip'},
+    'network_interface': {'vpc-id': 'vpc_id', 'subnet-id': 'subnet_id', 'network-interface-id': 'id'},
+    'snapshot': {'snapshot-id': 'id', 'volume-id': 'volume_id', 'status': 'state'},
+    'snapshot_export_task': {'snapshot-export-task-id': 'id', 'state': 'state', 'snapshot-id': 'snapshot_id'},
+    'image_export_task': {'image-export-task-id': 'id', 'state': 'state', 'image-id': 'image_id'},
+}
+
+
+class MockError(Exception):
+    """
+    API error returned to the client
+    """
+    def __init__(self, code, message='', status=400):
+        super(MockError, self).__init__(message or code)
+        self.code = code
+        self.message = message or code
+        self.status = status
+
+
+class Items(list):
+    """
+    List of values rendered as repeated <item> (or tag) elements
+    """
+    def __init__(self, values=(), tag='item'):
+        super(Items, self).__init__(values)
+        self.tag = tag
+
+
+def render(value):
+    """
+    Render a value as XML: lists of (name, value) pairs are elements, Items are repeated elements
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, Items):
+        return ''.join(['<{0}>{1}</{0}>'.format(value.tag, render(item)) for item in value])
+    if isinstance(value, list):
+        return ''.join(['<{0}>{1}</{0}>'.format(name, render(item)) for name, item in value])
+    return escape(unicode(value)).encode('utf-8')
+
+
+def list_param(params, prefix):
+    """
+    Values of prefix.1, prefix.2... ordered by index
+    """
+    start = len(prefix) + 1
+    indexed = []
+    for name, value in params.items():
+        if name.startswith(prefix + '.') and name[start:].isdigit():
+            indexed.append((int(name[start:]), value))
+    return [value for _, value in sorted(indexed)]
+
+
+def filter_params(params):
+    """
+    :return dict: filter name -> list of values
+    """
+    filters = {}
+    index = 1
+    while 'Filter.{0}.Name'.format(index) in params:
+        name = params['Filter.{0}.Name'.format(index)]
+        filters[name] = list_param(params, 'Filter.{0}.Value'.format(index))
+        index += 1
+    return filters
+
+
+def _new_id(prefix):
+    return '{0}-{1}'.format(prefix, uuid.uuid4().hex[:8])
+
+
+class MockCloud(object):
+    """
+    In memory ressources of the mock server
+    """
+
+    def __init__(self, result_size=100, transition_delay=1.0, export_duration=5.0):
+        """
+        :param int result_size: number of items in reference data responses (quotas, instance types, catalog...)
+        :param float transition_delay: seconds before a ressource reaches its next state
+        :param float export_duration: seconds for an export task to complete
+        """
+        self.result_size = result_size
+        self.transition_delay = transition_delay
+        self.export_duration = export_duration
+        self.lock = threading.RLock()
+        self.ressources = dict((kind, {}) for kind in NOT_FOUND_CODES)
+        self.tags = {}
+        self.vn_options = {}
+        self.access_keys = {}
+        # bucket -> key -> (content, etag), upload id -> (bucket, key, part number -> (content, etag))
+        self.buckets = {}
+        self.uploads = {}
+        # quota name -> maximum, overrides QUOTA_LIMITS
+        self.quota_limits = {}
+        # client token -> IDs of the instances of the RunInstances call
+        self.client_tokens = {}
+        self.calls = {}
+        self._ips = 0
+
+    # -- state
+
+    def count(self, action):
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+
+    def _transition(self, ressource, *states):
+        """
+        Next states of the ressource, each reached transition_delay after the previous one
+        """
+        now = time.time()
+        ressource['states'] = [(now + index * self.transition_delay, state) for index, state in enumerate(states)]
+
+    @staticmethod
+    def state(ressource):
+        states = ressource.get('states')
+        if not states:
+            return ressource.get('state')
+        now = time.time()
+        current = states[0][1]
+        for reached, state in states:
+            if reached <= now:
+                current = state
+        return current
+
+    def _add(self, kind, ressource):
+        self.ressources[kind][ressource['id']] = ressource
+        return ressource
+
+    def _get(self, kind, ressource_id):
+        try:
+            return self.ressources[kind][ressource_id]
+        except KeyError:
+            raise MockError(NOT_FOUND_CODES[kind], 'The {0} ID {1} does not exist'.format(kind, ressource_id))
+
+    def _private_ip(self, cidr):
+        self._ips += 1
+        base = cidr.split('/')[0].split('.')
+        return '{0}.{1}.{2}.{3}'.format(base[0], base[1], (self._ips // 250) % 256, 4 + self._ips % 250)
+
+    def _public_ip(self):
+        self._ips += 1
+        return '171.33.{0}.{1}'.format((self._ips // 250) % 256, 1 + self._ips % 250)
+
+    def select(self, kind, ids=None, filters=None):
+        """
+        Ressources of kind matching ids and filters, unknown filters are ignored
+        :raises MockError: when one of ids does not exist
+        """
+        with self.lock:
+            if ids:
+                selected = [self._get(kind, ressource_id) for ressource_id in ids]
+            else:
+                selected = list(self.ressources[kind].values())
+            keys = FILTER_KEYS.get(kind, {})
+            for name, values in (filters or {}).items():
+                if name in keys:
+                    key = keys[name]
+                    values = set(values)
+                    if key == 'state':
+                        selected = [ressource for ressource in selected if self.state(ressource) in values]
+                    else:
+                        selected = [ressource for ressource in selected if ressource.get(key) in values]
+            return selected
+
+    # -- ressource creation, also used to seed the cloud without API calls
+
+    def create_vpc(self, cidr='10.0.0.0/16'):
+        with self.lock:
+            vpc = self._add('vpc', {'id': _new_id('vpc'), 'cidr': cidr, 'state': 'available'})
+            self._add('route_table', {'id': _new_id('rtb'), 'vpc_id': vpc['id'], 'routes': [(cidr, 'local')],
+                                      'associations': [(_new_id('rtbassoc'), None, True)]})
+            group = self.create_security_group(vpc['id'], 'default', 'default VPC security group')
+            group['egress'].append(('-1', None, None, None, '0.0.0.0/0'))
+            self.vn_options[vpc['id']] = {'enabled': False, 'host': None, 'rate_limit': None}
+            return vpc
+
+    def create_subnet(self, vpc_id, cidr):
+        with self.lock:
+            self._get('vpc', vpc_id)
+            return self._add('subnet', {'id': _new_id('subnet'), 'vpc_id': vpc_id, 'cidr': cidr, 'state': 'available'})
+
+    def create_security_group(self, vpc_id, name, description):
+        with self.lock:
+            return self._add('security_group', {'id': _new_id('sg'), 'vpc_id': vpc_id, 'name': name,
+                                                'description': description, 'rules': [], 'egress': []})
+
+    def run_instances(self, subnet_id, count=1, image_id='ami-mock', instance_type='t2.small',
+                      private_ips=None, group_ids=None, key_name=None):
+        with self.lock:
+            subnet = self._get('subnet', subnet_id)
+            used = set([instance['private_ip'] for instance in self.ressources['instance'].values()
+                        if instance['subnet_id'] == subnet_id and self.state(instance) != 'terminated'])
+            for private_ip in private_ips or []:
+                if private_ip in used:
+                    raise MockError('InvalidIPAddress.InUse', 'Address {0} is in use'.format(private_ip))
+            reservation_id = _new_id('r')
+            instances = []
+            for index in range(count):
+                private_ip = private_ips[index] if private_ips else self._private_ip(subnet['cidr'])
+                instance = {'id': _new_id('i'), 'reservation_id': reservation_id, 'subnet_id': subnet_id,
+                            'vpc_id': subnet['vpc_id'], 'image_id': image_id, 'instance_type': instance_type,
+                            'private_ip': private_ip, 'group_ids': group_ids or [], 'key_name': key_name,
+                            'launch_time': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+                self._transition(instance, 'pending', 'running')
+                instances.append(self._add('instance', instance))
+            return instances
+
+    def create_internet_gateway(self, vpc_id=None):
+        with self.lock:
+            return self._add('internet_gateway', {'id': _new_id('igw'), 'vpc_id': vpc_id})
+
+    def create_route_table(self, vpc_id):
+        with self.lock:
+            return self._add('route_table', {'id': _new_id('rtb'), 'vpc_id': vpc_id, 'routes': [], 'associations': []})
+
+    def allocate_address(self):
+        with self.lock:
+            return self._add('address', {'id': _new_id('eipalloc'), 'public_ip': self._public_ip(),
+                                         'instance_id': None, 'association_id': None, 'private_ip': None})
+
+    def associate_address(self, allocation_id, instance_id):
+        with self.lock:
+            address = self._get('address', allocation_id)
+            instance = self._get('instance', instance_id)
+            address.update({'instance_id': instance_id, 'association_id': _new_id('eipassoc'),
+                            'private_ip': instance['private_ip']})
+            return address
+
+    def create_nat_gateway(self, subnet_id, allocation_id):
+        with self.lock:
+            subnet = self._get('subnet', subnet_id)
+            address = self._get('address', allocation_id)
+            nat_gateway = {'id': _new_id('nat'), 'subnet_id': subnet_id, 'vpc_id': subnet['vpc_id'],
+                           'allocation_id': allocation_id, 'public_ip': address['public_ip']}
+            self._transition(nat_gateway, 'pending', 'available')
+            return self._add('nat_gateway', nat_gateway)
+
+    def create_network_interface(self, subnet_id):
+        with self.lock:
+            subnet = self._get('subnet', subnet_id)
+            return self._add('network_interface', {'id': _new_id('eni'), 'subnet_id': subnet_id, 'vpc_id': subnet['vpc_id'],
+                                                   'private_ip': self._private_ip(subnet['cidr'])})
+
+    def create_load_balancer(self, name, subnet_ids):
+        with self.lock:
+            return self._add('load_balancer', {'id': name, 'subnets': list(subnet_ids), 'deleted_at': None,
+                                               'dns_name': '{0}.lbu.mock'.format(name)})
+
+    def create_snapshot(self, volume_size=10):
+        with self.lock:
+            return self._add('snapshot', {'id': _new_id('snap'), 'volume_id': _new_id('vol'), 'state': 'completed',
+                                          'volume_size': volume_size})
+
+    def seed_vpc(self, subnets=2, instances=4, security_groups=2, addresses=2, nics=2, nat_gateway=True, load_balancers=1):
+        """
+        Create a populated VPC without API calls, instances are running right away
+        :return str: vpc id
+        """
+        with self.lock:
+            vpc = self.create_vpc()
+            subnet_ids = [self.create_subnet(vpc['id'], '10.0.{0}.0/24'.format(index))['id'] for index in range(subnets)]
+            groups = [self.create_security_group(vpc['id'], 'sg-{0}'.format(index), 'group {0}'.format(index))
+                      for index in range(security_groups)]
+            for group in groups:
+                group['rules'].append(('tcp', 22, 22, None, '0.0.0.0/0'))
+                group['rules'].append(('tcp', 0, 65535, groups[0]['id'], None))
+            created = []
+            for index in range(instances):
+                created.extend(self.run_instances(subnet_ids[index % subnets], group_ids=[groups[0]['id']] if groups else None))
+            for instance in created:
+                instance['states'] = None
+                instance['state'] = 'running'
+            for index in range(min(addresses, len(created))):
+                self.associate_address(self.allocate_address()['id'], created[index]['id'])
+            for index in range(nics):
+                self.create_network_interface(subnet_ids[index % subnets])
+            gateway = self.create_internet_gateway(vpc['id'])
+            route_table = self.create_route_table(vpc['id'])
+            route_table['routes'].append(('0.0.0.0/0', gateway['id']))
+            route_table['associations'].append((_new_id('rtbassoc'), subnet_ids[0], False))
+            if nat_gateway:
+                nat = self.create_nat_gateway(subnet_ids[0], self.allocate_address()['id'])
+                nat['states'] = None
+                nat['state'] = 'available'
+            for index in range(load_balancers):
+                self.create_load_balancer('lbu-{0}-{1}'.format(vpc['id'], index), subnet_ids)
+            return vpc['id']
+
+    # -- reference data
+
+    def quotas(self):
+        """
+        :return list: (name, maximum, used) of the quotas, QUOTA_LIMITS first then filler quotas up to result_size
+        """
+        quotas = []
+        with self.lock:
+            for name, (kind, maximum) in sorted(QUOTA_LIMITS.items()):
+                used = [ressource for ressource in self.ressources[kind].values()
+                        if self.state(ressource) not in ('terminated', 'deleted')]
+                quotas.append((name, self.quota_limits.get(name, maximum), len(used)))
+        for index in range(len(quotas), self.result_size):
+            quotas.append(('quota_{0}'.format(index), 100, index % 100))
+        return quotas
+
+    def instance_types(self):
+        return ['tinav{0}.c{1}r{2}'.format(1 + index % 4, 1 + index % 16, 1 + index % 64) for index in range(self.result_size)]
+
+    def catalog(self):
+        return [{'Category': 'compute', 'Flags': '', 'Operation': 'RunInstances-OD',
+                 'Service': 'TinaOS-FCU', 'SubregionName': 'eu-west-2', 'Title': 'Product {0}'.format(index),
+                 'Type': 'BoxUsage:tinav{0}'.format(index), 'UnitPrice': round(0.01 * (1 + index % 50), 4)}
+                for index in range(self.result_size)]
+
+
+class FCUHandler(object):
+    """
+    FCU and LBU query protocol actions, each returns the XML content of the response
+    """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    # -- instances
+
+    def _render_instance(self, instance):
+        state = self.cloud.state(instance)
+        public_ip = None
+        for address in self.cloud.ressources['address'].values():
+            if address['instance_id'] == instance['id']:
+                public_ip = address['public_ip']
+        return [('instanceId', instance['id']), ('imageId', instance['image_id']),
+                ('instanceState', [('code', INSTANCE_STATE_CODES[state]), ('name', state)]),
+                ('privateDnsName', ''), ('dnsName', ''), ('keyName', instance['key_name']),
+                ('amiLaunchIndex', 0), ('instanceType', instance['instance_type']),
+                ('launchTime', instance['launch_time']),
+                ('placement', [('availabilityZone', AVAILABILITY_ZONE), ('tenancy', 'default')]),
+                ('monitoring', [('state', 'disabled')]), ('subnetId', instance['subnet_id']),
+                ('vpcId', instance['vpc_id']), ('privateIpAddress', instance['private_ip']),
+                ('ipAddress', public_ip),
+                ('groupSet', Items([[('groupId', group_id)] for group_id in instance['group_ids']])),
+                ('tagSet', self._render_tags(instance['id']))]
+
+    def _render_tags(self, ressource_id):
+        tags = self.cloud.tags.get(ressource_id, {})
+        return Items([[('key', key), ('value', value)] for key, value in sorted(tags.items())])
+
+    def _render_reservations(self, instances):
+        reservations = {}
+        for instance in instances:
+            reservations.setdefault(instance['reservation_id'], []).append(instance)
+        return Items([[('reservationId', reservation_id), ('ownerId', OWNER_ID), ('groupSet', Items()),
+                       ('instancesSet', Items([self._render_instance(instance) for instance in members]))]
+                      for reservation_id, members in sorted(reservations.items())])
+
+    def DescribeInstances(self, params):
+        instances = self.cloud.select('instance', list_param(params, 'InstanceId'), filter_params(params))
+        return [('reservationSet', self._render_reservations(instances))]
+
+    def RunInstances(self, params):
+        count = int(params.get('MaxCount', 1))
+        private_ips = list_param(params, 'PrivateIpAddresses') or None
+        if 'PrivateIpAddress' in params:
+            private_ips = [params['PrivateIpAddress']]
+        if private_ips and len(private_ips) != count:
+            raise MockError('InvalidParameterCombination', 'PrivateIpAddresses size must match MaxCount')
+        token = params.get('ClientToken')
+        with self.cloud.lock:
+            if token in self.cloud.client_tokens:
+                # same token, same call: instances of the first call are returned
+                instances = [self.cloud.ressources['instance'][instance_id] for instance_id in self.cloud.client_tokens[token]]
+            else:
+                instances = self.cloud.run_instances(params.get('SubnetId'), count, params.get('ImageId'),
+                                                     params.get('InstanceType', 't2.small'), private_ips,
+                                                     list_param(params, 'SecurityGroupId'), params.get('KeyName'))
+                if token:
+                    self.cloud.client_tokens[token] = [instance['id'] for instance in instances]
+        return [('reservationId', instances[0]['reservation_id']), ('ownerId', OWNER_ID), ('groupSet', Items()),
+                ('instancesSet', Items([self._render_instance(instance) for instance in instances]))]
+
+    def _change_instances(self, params, transitions):
+        changes = []
+        with self.cloud.lock:
+            for instance in self.cloud.select('instance', list_param(params, 'InstanceId')):
+                previous = self.cloud.state(instance)
+                states = transitions.get(previous)
+                if states:
+                    self.cloud._transition(instance, *states)
+                current = self.cloud.state(instance)
+                changes.append([('instanceId', instance['id']),
+                                ('currentState', [('code', INSTANCE_STATE_CODES[current]), ('name', current)]),
+                                ('previousState', [('code', INSTANCE_STATE_CODES[previous]), ('name', previous)])])
+        return [('instancesSet', Items(changes))]
+
+    def StopInstances(self, params):
+        return self._change_instances(params, {'running': ('stopping', 'stopped'), 'pending': ('stopping', 'stopped')})
+
+    def StartInstances(self, params):
+        return self._change_instances(params, {'stopped': ('pending', 'running')})
+
+    def TerminateInstances(self, params):
+        terminate = ('shutting-down', 'terminated')
+        return self._change_instances(params, dict((state, terminate) for state in INSTANCE_STATE_CODES
+                                                   if state not in ('shutting-down', 'terminated')))
+
+    def ModifyInstanceKeypair(self, params):
+        with self.cloud.lock:
+            self.cloud._get('instance', params.get('InstanceId'))['key_name'] = params.get('KeyName')
+        return [('return', True)]
+
+    # -- network
+
+    def _render_vpc(self, vpc):
+        return [('vpcId', vpc['id']), ('state', vpc['state']), ('cidrBlock', vpc['cidr']),
+                ('dhcpOptionsId', 'default'), ('instanceTenancy', 'default'), ('isDefault', False),
+                ('tagSet', self._render_tags(vpc['id']))]
+
+    def CreateVpc(self, params):
+        return [('vpc', self._render_vpc(self.cloud.create_vpc(params.get('CidrBlock', '10.0.0.0/16'))))]
+
+    def DescribeVpcs(self, params):
+        vpcs = self.cloud.select('vpc', list_param(params, 'VpcId'), filter_params(params))
+        return [('vpcSet', Items([self._render_vpc(vpc) for vpc in vpcs]))]
+
+    def DeleteVpc(self, params):
+        with self.cloud.lock:
+            vpc_id = self.cloud._get('vpc', params.get('VpcId'))['id']
+            dependencies = [subnet for subnet in self.cloud.select('subnet', filters={'vpc-id': [vpc_id]})]
+            dependencies += self.cloud.select('internet_gateway', filters={'attachment.vpc-id': [vpc_id]})
+            dependencies += [group for group in self.cloud.select('security_group', filters={'vpc-id': [vpc_id]})
+                             if group['name'] != 'default']
+            if dependencies:
+                raise MockError('DependencyViolation', 'The vpc {0} has dependencies and cannot be deleted'.format(vpc_id))
+            for kind in ('route_table', 'security_group'):
+                for ressource in self.cloud.select(kind, filters={'vpc-id': [vpc_id]}):
+                    del self.cloud.ressources[kind][ressource['id']]
+            del self.cloud.ressources['vpc'][vpc_id]
+        return [('return', True)]
+
+    def _render_subnet(self, subnet):
+        return [('subnetId', subnet['id']), ('state', subnet['state']), ('vpcId', subnet['vpc_id']),
+                ('cidrBlock', subnet['cidr']), ('availableIpAddressCount', 250),
+                ('availabilityZone', AVAILABILITY_ZONE), ('tagSet', self._render_tags(subnet['id']))]
+
+    def CreateSubnet(self, params):
+        return [('subnet', self._render_subnet(self.cloud.create_subnet(params.get('VpcId'), params.get('CidrBlock'))))]
+
+    def DescribeSubnets(self, params):
+        subnets = self.cloud.select('subnet', list_param(params, 'SubnetId'), filter_params(params))
+        return [('subnetSet', Items([self._render_subnet(subnet) for subnet in subnets]))]
+
+    def DeleteSubnet(self, params):
+        with self.cloud.lock:
+            subnet_id = self.cloud._get('subnet', params.get('SubnetId'))['id']
+            instances = [instance for instance in self.cloud.select('instance', filters={'subnet-id': [subnet_id]})
+                         if self.cloud.state(instance) != 'terminated']
+            nics = self.cloud.select('network_interface', filters={'subnet-id': [subnet_id]})
+            if instances or nics:
+                raise MockError('DependencyViolation', 'The subnet {0} has dependencies and cannot be deleted'.format(subnet_id))
+            del self.cloud.ressources['subnet'][subnet_id]
+        return [('return', True)]
+
+    def _render_rules(self, rules):
+        return Items([[('ipProtocol', protocol), ('fromPort', from_port), ('toPort', to_port),
+                       ('groups', Items([[('userId', OWNER_ID), ('groupId', group_id)]] if group_id else [])),
+                       ('ipRanges', Items([[('cidrIp', cidr)]] if cidr else []))]
+                      for protocol, from_port, to_port, group_id, cidr in rules])
+
+    def _render_security_group(self, group):
+        return [('ownerId', OWNER_ID), ('groupId', group['id']), ('groupName', group['name']),
+                ('groupDescription', group['description']), ('vpcId', group['vpc_id']),
+                ('ipPermissions', self._render_rules(group['rules'])),
+                ('ipPermissionsEgress', self._render_rules(group['egress'])),
+                ('tagSet', self._render_tags(group['id']))]
+
+    def CreateSecurityGroup(self, params):
+        group = self.cloud.create_security_group(params.get('VpcId'), params.get('GroupName'), params.get('GroupDescription'))
+        return [('return', True), ('groupId', group['id'])]
+
+    def DescribeSecurityGroups(self, params):
+        groups = self.cloud.select('security_group', list_param(params, 'GroupId'), filter_params(params))
+        return [('securityGroupInfo', Items([self._render_security_group(group) for group in groups]))]
+
+    def DeleteSecurityGroup(self, params):
+        with self.cloud.lock:
+            group = self.cloud._get('security_group', params.get('GroupId'))
+            for instance in self.cloud.ressources['instance'].values():
+                if group['id'] in instance['group_ids'] and self.cloud.state(instance) != 'terminated':
+                    raise MockError('DependencyViolation', 'The security group {0} is in use'.format(group['id']))
+            del self.cloud.ressources['security_group'][group['id']]
+        return [('return', True)]
+
+    @staticmethod
+    def _rule(params):
+        from_port = params.get('IpPermissions.1.FromPort')
+        to_port = params.get('IpPermissions.1.ToPort')
+        return (params.get('IpPermissions.1.IpProtocol'),
+                int(from_port) if from_port else None,
+                int(to_port) if to_port else None,
+                params.get('IpPermissions.1.Groups.1.GroupId'),
+                params.get('IpPermissions.1.IpRanges.1.CidrIp'))
+
+    def _change_rules(self, params, rules_key, add):
+        with self.cloud.lock:
+            group = self.cloud._get('security_group', params.get('GroupId'))
+            rule = self._rule(params)
+            if add:
+                if rule in group[rules_key]:
+                    raise MockError('InvalidPermission.Duplicate', 'The permission already exists')
+                group[rules_key].append(rule)
+            else:
+                if rule not in group[rules_key]:
+                    raise MockError('InvalidPermission.NotFound', 'The permission does not exist')
+                group[rules_key].remove(rule)
+        return [('return', True)]
+
+    def AuthorizeSecurityGroupIngress(self, params):
+        return self._change_rules(params, 'rules', True)
+
+    def AuthorizeSecurityGroupEgress(self, params):
+        return self._change_rules(params, 'egress', True)
+
+    def RevokeSecurityGroupIngress(self, params):
+        return self._change_rules(params, 'rules', False)
+
+    def RevokeSecurityGroupEgress(self, params):
+        return self._change_rules(params, 'egress', False)
+
+    def _render_internet_gateway(self, gateway):
+        attachments = [[('vpcId', gateway['vpc_id']), ('state', 'available')]] if gateway['vpc_id'] else []
+        return [('internetGatewayId', gateway['id']), ('attachmentSet', Items(attachments)),
+                ('tagSet', self._render_tags(gateway['id']))]
+
+    def CreateInternetGateway(self, params):
+        return [('internetGateway', self._render_internet_gateway(self.cloud.create_internet_gateway()))]
+
+    def DescribeInternetGateways(self, params):
+        gateways = self.cloud.select('internet_gateway', list_param(params, 'InternetGatewayId'), filter_params(params))
+        return [('internetGatewaySet', Items([self._render_internet_gateway(gateway) for gateway in gateways]))]
+
+    def AttachInternetGateway(self, params):
+        with self.cloud.lock:
+            gateway = self.cloud._get('internet_gateway', params.get('InternetGatewayId'))
+            self.cloud._get('vpc', params.get('VpcId'))
+            if gateway['vpc_id']:
+                raise MockError('Resource.AlreadyAssociated', 'The gateway {0} is already attached'.format(gateway['id']))
+            gateway['vpc_id'] = params.get('VpcId')
+        return [('return', True)]
+
+    def DetachInternetGateway(self, params):
+        with self.cloud.lock:
+            gateway = self.cloud._get('internet_gateway', params.get('InternetGatewayId'))
+            for address in self.cloud.ressources['address'].values():
+                if address['instance_id'] and self.cloud.ressources['instance'][address['instance_id']]['vpc_id'] == gateway['vpc_id']:
+                    raise MockError('DependencyViolation', 'The gateway has mapped public addresses')
+            gateway['vpc_id'] = None
+        return [('return', True)]
+
+    def DeleteInternetGateway(self, params):
+        with self.cloud.lock:
+            gateway = self.cloud._get('internet_gateway', params.get('InternetGatewayId'))
+            if gateway['vpc_id']:
+                raise MockError('DependencyViolation', 'The gateway {0} is attached'.format(gateway['id']))
+            del self.cloud.ressources['internet_gateway'][gateway['id']]
+        return [('return', True)]
+
+    def _render_route_table(self, route_table):
+        return [('routeTableId', route_table['id']), ('vpcId', route_table['vpc_id']),
+                ('routeSet', Items([[('destinationCidrBlock', destination), ('gatewayId', gateway_id), ('state', 'active')]
+                                    for destination, gateway_id in route_table['routes']])),
+                ('associationSet', Items([[('routeTableAssociationId', association_id), ('routeTableId', route_table['id']),
+                                           ('subnetId', subnet_id), ('main', main)]
+                                          for association_id, subnet_id, main in route_table['associations']])),
+                ('tagSet', self._render_tags(route_table['id']))]
+
+    def CreateRouteTable(self, params):
+        return [('routeTable', self._render_route_table(self.cloud.create_route_table(params.get('VpcId'))))]
+
+    def DescribeRouteTables(self, params):
+        route_tables = self.cloud.select('route_table', list_param(params, 'RouteTableId'), filter_params(params))
+        return [('routeTableSet', Items([self._render_route_table(route_table) for route_table in route_tables]))]
+
+    def DeleteRouteTable(self, params):
+        with self.cloud.lock:
+            route_table = self.cloud._get('route_table', params.get('RouteTableId'))
+            if route_table['associations']:
+                raise MockError('DependencyViolation', 'The route table {0} has associations'.format(route_table['id']))
+            del self.cloud.ressources['route_table'][route_table['id']]
+        return [('return', True)]
+
+    def CreateRoute(self, params):
+        with self.cloud.lock:
+            route_table = self.cloud._get('route_table', params.get('RouteTableId'))
+            target = params.get('GatewayId') or params.get('NatGatewayId') or params.get('InstanceId')
+            route_table['routes'].append((params.get('DestinationCidrBlock'), target))
+        return [('return', True)]
+
+    def DeleteRoute(self, params):
+        with self.cloud.lock:
+            route_table = self.cloud._get('route_table', params.get('RouteTableId'))
+            routes = [route for route in route_table['routes'] if route[0] != params.get('DestinationCidrBlock')]
+            if len(routes) == len(route_table['routes']):
+                raise MockError('InvalidRoute.NotFound', 'No route for {0}'.format(params.get('DestinationCidrBlock')))
+            route_table['routes'] = routes
+        return [('return', True)]
+
+    def AssociateRouteTable(self, params):
+        with self.cloud.lock:
+            route_table = self.cloud._get('route_table', params.get('RouteTableId'))
+            self.cloud._get('subnet', params.get('SubnetId'))
+            association_id = _new_id('rtbassoc')
+            route_table['associations'].append((association_id, params.get('SubnetId'), False))
+        return [('associationId', association_id)]
+
+    def DisassociateRouteTable(self, params):
+        with self.cloud.lock:
+            for route_table in self.cloud.ressources['route_table'].values():
+                associations = [association for association in route_table['associations']
+                                if association[0] != params.get('AssociationId')]
+                if len(associations) != len(route_table['associations']):
+                    route_table['associations'] = associations
+                    return [('return', True)]
+        raise MockError('InvalidAssociationID.NotFound', 'Association {0} not found'.format(params.get('AssociationId')))
+
+    def _render_nat_gateway(self, nat_gateway):
+        return [('natGatewayId', nat_gateway['id']), ('subnetId', nat_gateway['subnet_id']),
+                ('vpcId', nat_gateway['vpc_id']), ('state', self.cloud.state(nat_gateway)),
+                ('natGatewayAddressSet', Items([[('allocationId', nat_gateway['allocation_id']),
+                                                 ('publicIp', nat_gateway['public_ip'])]]))]
+
+    def CreateNatGateway(self, params):
+        nat_gateway = self.cloud.create_nat_gateway(params.get('SubnetId'), params.get('AllocationId'))
+        return [('natGateway', self._render_nat_gateway(nat_gateway))]
+
+    def DescribeNatGateways(self, params):
+        nat_gateways = self.cloud.select('nat_gateway', list_param(params, 'NatGatewayId'), filter_params(params))
+        return [('natGatewaySet', Items([self._render_nat_gateway(nat_gateway) for nat_gateway in nat_gateways]))]
+
+    def DeleteNatGateway(self, params):
+        with self.cloud.lock:
+            nat_gateway = self.cloud._get('nat_gateway', params.get('NatGatewayId'))
+            self.cloud._transition(nat_gateway, 'deleting', 'deleted')
+        return [('natGatewayId', nat_gateway['id'])]
+
+    def _render_address(self, address):
+        return [('publicIp', address['public_ip']), ('allocationId', address['id']), ('domain', 'vpc'),
+                ('instanceId', address['instance_id']), ('associationId', address['association_id']),
+                ('privateIpAddress', address['private_ip'])]
+
+    def AllocateAddress(self, params):
+        address = self.cloud.allocate_address()
+        return [('publicIp', address['public_ip']), ('domain', 'vpc'), ('allocationId', address['id'])]
+
+    def DescribeAddresses(self, params):
+        addresses = self.cloud.select('address', list_param(params, 'AllocationId'), filter_params(params))
+        return [('addressesSet', Items([self._render_address(address) for address in addresses]))]
+
+    def AssociateAddress(self, params):
+        address = self.cloud.associate_address(params.get('AllocationId'), params.get('InstanceId'))
+        return [('return', True), ('associationId', address['association_id'])]
+
+    def DisassociateAddress(self, params):
+        with self.cloud.lock:
+            for address in self.cloud.ressources['address'].values():
+                if address['association_id'] == params.get('AssociationId'):
+                    address.update({'instance_id': None, 'association_id': None, 'private_ip': None})
+                    return [('return', True)]
+        raise MockError('InvalidAssociationID.NotFound', 'Association {0} not found'.format(params.get('AssociationId')))
+
+    def ReleaseAddress(self, params):
+        with self.cloud.lock:
+            address = self.cloud._get('address', params.get('AllocationId'))
+            if address['association_id']:
+                raise MockError('InvalidIPAddress.InUse', 'Address {0} is in use'.format(address['public_ip']))
+            for nat_gateway in self.cloud.ressources['nat_gateway'].values():
+                if nat_gateway['allocation_id'] == address['id'] and self.cloud.state(nat_gateway) != 'deleted':
+                    raise MockError('InvalidIPAddress.InUse', 'Address {0} is in use'.format(address['public_ip']))
+            del self.cloud.ressources['address'][address['id']]
+        return [('return', True)]
+
+    def DescribeNetworkInterfaces(self, params):
+        nics = self.cloud.select('network_interface', list_param(params, 'NetworkInterfaceId'), filter_params(params))
+        return [('networkInterfaceSet', Items([[('networkInterfaceId', nic['id']), ('subnetId', nic['subnet_id']),
+                                                 ('vpcId', nic['vpc_id']), ('availabilityZone', AVAILABILITY_ZONE),
+                                                 ('ownerId', OWNER_ID), ('status', 'available'),
+                                                 ('privateIpAddress', nic['private_ip'])] for nic in nics]))]
+
+    def DeleteNetworkInterface(self, params):
+        with self.cloud.lock:
+            nic = self.cloud._get('network_interface', params.get('NetworkInterfaceId'))
+            del self.cloud.ressources['network_interface'][nic['id']]
+        return [('return', True)]
+
+    def DescribeVpcPeeringConnections(self, params):
+        return [('vpcPeeringConnectionSet', Items())]
+
+    def DescribeVpcEndpoints(self, params):
+        return [('vpcEndpointSet', Items())]
+
+    def DeleteVpcEndpoints(self, params):
+        return [('unsuccessful', Items())]
+
+    def _taggable(self, ressource_ids):
+        for ressource_id in ressource_ids:
+            if not [kind for kind in self.cloud.ressources if ressource_id in self.cloud.ressources[kind]]:
+                raise MockError('InvalidID.NotFound', 'The ID {0} does not exist'.format(ressource_id))
+
+    def CreateTags(self, params):
+        with self.cloud.lock:
+            self._taggable(list_param(params, 'ResourceId'))
+            for ressource_id in list_param(params, 'ResourceId'):
+                tags = self.cloud.tags.setdefault(ressource_id, {})
+                index = 1
+                while 'Tag.{0}.Key'.format(index) in params:
+                    tags[params['Tag.{0}.Key'.format(index)]] = params.get('Tag.{0}.Value'.format(index), '')
+                    index += 1
+        return [('return', True)]
+
+    def DeleteTags(self, params):
+        with self.cloud.lock:
+            for ressource_id in list_param(params, 'ResourceId'):
+                tags = self.cloud.tags.get(ressource_id, {})
+                index = 1
+                while 'Tag.{0}.Key'.format(index) in params:
+                    tags.pop(params['Tag.{0}.Key'.format(index)], None)
+                    index += 1
+        return [('return', True)]
+
+    def DescribeSnapshots(self, params):
+        snapshots = self.cloud.select('snapshot', list_param(params, 'SnapshotId'), filter_params(params))
+        return [('snapshotSet', Items([[('snapshotId', snapshot['id']), ('volumeId', snapshot['volume_id']),
+                                        ('status', snapshot['state']), ('startTime', '2016-01-01T00:00:00.000Z'),
+                                        ('progress', '100%'), ('ownerId', OWNER_ID),
+                                        ('volumeSize', snapshot['volume_size']), ('description', ''),
+                                        ('tagSet', self._render_tags(snapshot['id']))] for snapshot in snapshots]))]
+
+    # -- fcuext
+
+    def DescribeInstanceTypes(self, params):
+        return [('instanceTypeInfo', Items([[('name', name), ('vcpu', 1 + index % 16), ('memory', 1024 * (1 + index % 64)),
+                                             ('storageSize', 0), ('storageCount', 0), ('maxIpAddresses', 16),
+                                             ('ebsOptimizedAvailable', index % 2 == 0)]
+                                            for index, name in enumerate(self.cloud.instance_types())]))]
+
+    def _product_types(self):
+        return Items([[('productTypeId', '{0:04d}'.format(index)), ('description', 'Product type {0}'.format(index)),
+                       ('vendor', 'mock')] for index in range(self.cloud.result_size)])
+
+    def DescribeProductTypes(self, params):
+        return [('productTypeSet', self._product_types())]
+
+    def GetProductTypes(self, params):
+        return [('productTypeSet', self._product_types())]
+
+    def DescribeQuotas(self, params):
+        quotas = self.cloud.quotas()
+        references = [quotas[start:start + 10] for start in range(0, len(quotas), 10)]
+        start = int(params.get('NextToken') or 0)
+        end = start + int(params.get('MaxResults') or len(references))
+        page = [[('reference', 'global' if index == 0 else 'ref-{0}'.format(index)),
+                 ('quotaSet', Items([[('ownerId', OWNER_ID), ('name', name), ('displayName', name.replace('_', ' ')),
+                                      ('description', 'Quota {0}'.format(name)), ('groupName', 'Compute'),
+                                      ('maxQuotaValue', maximum), ('usedQuotaValue', used)]
+                                     for name, maximum, used in references[index]]))]
+                for index in range(start, min(end, len(references)))]
+        content = [('referenceQuotaSet', Items(page))]
+        if end < len(references):
+            content.append(('nextToken', str(end)))
+        return content
+
+    def _create_export_task(self, kind, source_key, source_id, params, aksk):
+        with self.cloud.lock:
+            task = {'id': _new_id(kind == 'snapshot_export_task' and 'snap-export' or 'image-export'),
+                    source_key: source_id, 'started': time.time(),
+                    'format': params.get('ExportToOsu.DiskImageFormat'), 'bucket': params.get('ExportToOsu.OsuBucket'),
+                    'prefix': params.get('ExportToOsu.OsuPrefix', ''),
+                    'access_key': params.get('ExportToOsu.{0}.AccessKey'.format(aksk))}
+            task['states'] = [(task['started'], 'pending'),
+                              (task['started'] + self.cloud.transition_delay, 'active'),
+                              (task['started'] + self.cloud.transition_delay + self.cloud.export_duration, 'completed')]
+            return self.cloud._add(kind, task)
+
+    def _completion(self, task):
+        elapsed = time.time() - task['states'][1][0]
+        return max(0, min(100, int(100 * elapsed / max(self.cloud.export_duration, 0.001))))
+
+    def _render_snapshot_export_task(self, task):
+        return [('snapshotExportTaskId', task['id']), ('state', self.cloud.state(task)), ('statusMessage', ''),
+                ('completion', self._completion(task)), ('snapshotExport', [('snapshotId', task['snapshot_id'])]),
+                ('exportToOsu', [('diskImageFormat', task['format']), ('osuBucket', task['bucket']),
+                                 ('osuKey', '{0}{1}.{2}'.format(task['prefix'], task['id'], task['format']))])]
+
+    def CreateSnapshotExportTask(self, params):
+        task = self._create_export_task('snapshot_export_task', 'snapshot_id', params.get('SnapshotId'), params, 'aksk')
+        return [('snapshotExportTask', self._render_snapshot_export_task(task))]
+
+    def DescribeSnapshotExportTasks(self, params):
+        tasks = self.cloud.select('snapshot_export_task', list_param(params, 'SnapshotExportTaskId'), filter_params(params))
+        return [('snapshotExportTaskSet', Items([self._render_snapshot_export_task(task) for task in tasks]))]
+
+    def _render_image_export_task(self, task):
+        return [('imageExportTaskId', task['id']), ('state', self.cloud.state(task)), ('statusMessage', ''),
+                ('completion', self._completion(task)), ('imageExport', [('imageId', task['image_id'])]),
+                ('exportToOsu', [('diskImageFormat', task['format']), ('osuBucket', task['bucket']),
+                                 ('osuManifestUrl', 'https://osu.mock/{0}/{1}{2}/manifest'.format(task['bucket'], task['prefix'], task['id']))])]
+
+    def CreateImageExportTask(self, params):
+        task = self._create_export_task('image_export_task', 'image_id', params.get('ImageId'), params, 'OsuAkSk')
+        return [('imageExportTask', self._render_image_export_task(task))]
+
+    def DescribeImageExportTasks(self, params):
+        tasks = self.cloud.select('image_export_task', list_param(params, 'ImageExportTaskId'), filter_params(params))
+        return [('imageExportTaskSet', Items([self._render_image_export_task(task) for task in tasks]))]
+
+    def _render_vn_options(self, vn_id):
+        with self.cloud.lock:
+            if vn_id not in self.cloud.vn_options:
+                raise MockError(NOT_FOUND_CODES['vpc'], 'The vpc ID {0} does not exist'.format(vn_id))
+            options = self.cloud.vn_options[vn_id]
+            return [('vnId', vn_id), ('fwLog', [('enabled', options['enabled']), ('rateLimit', options['rate_limit']),
+                                                ('host', options['host'])])]
+
+    def ReadVnOptions(self, params):
+        return self._render_vn_options(params.get('VnId'))
+
+    def UpdateVnOptions(self, params):
+        self._render_vn_options(params.get('VnId'))
+        with self.cloud.lock:
+            options = self.cloud.vn_options[params.get('VnId')]
+            if 'FwLog.Enabled' in params:
+                options['enabled'] = params['FwLog.Enabled'] == 'true'
+            if 'FwLog.Host' in params:
+                options['host'] = params['FwLog.Host'] or None
+            if 'FwLog.RateLimit' in params:
+                options['rate_limit'] = params['FwLog.RateLimit'] or None
+        return self._render_vn_options(params.get('VnId'))
+
+    # -- LBU
+
+    def _load_balancers(self, names=None):
+        now = time.time()
+        with self.cloud.lock:
+            for name, load_balancer in list(self.cloud.ressources['load_balancer'].items()):
+                if load_balancer['deleted_at'] is not None and load_balancer['deleted_at'] <= now:
+                    del self.cloud.ressources['load_balancer'][name]
+            return self.cloud.select('load_balancer', names)
+
+    def _render_load_balancer(self, load_balancer):
+        return [('LoadBalancerName', load_balancer['id']), ('DNSName', load_balancer['dns_name']),
+                ('Subnets', Items(load_balancer['subnets'], 'member')), ('ListenerDescriptions', Items([], 'member')),
+                ('Instances', Items([], 'member')), ('AvailabilityZones', Items([AVAILABILITY_ZONE], 'member')),
+                ('Scheme', 'internet-facing')]
+
+    def CreateLoadBalancer(self, params):
+        load_balancer = self.cloud.create_load_balancer(params.get('LoadBalancerName'), list_param(params, 'Subnets.member'))
+        return [('CreateLoadBalancerResult', [('DNSName', load_balancer['dns_name'])])]
+
+    def DescribeLoadBalancers(self, params):
+        load_balancers = self._load_balancers(list_param(params, 'LoadBalancerNames.member'))
+        return [('DescribeLoadBalancersResult', [('LoadBalancerDescriptions', Items(
+            [self._render_load_balancer(load_balancer) for load_balancer in load_balancers], 'member'))])]
+
+    def DeleteLoadBalancer(self, params):
+        with self.cloud.lock:
+            load_balancer = self.cloud.ressources['load_balancer'].get(params.get('LoadBalancerName'))
+            if load_balancer is not None and load_balancer['deleted_at'] is None:
+                load_balancer['deleted_at'] = time.time() + self.cloud.transition_delay
+        return [('DeleteLoadBalancerResult', [])]
+
+
+class ICUHandler(object):
+    """
+    ICU JSON protocol actions, each returns the JSON response as a dict
+    """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def _access_keys(self):
+        with self.cloud.lock:
+            if not self.cloud.access_keys:
+                for index in range(self.cloud.result_size):
+                    self._create_access_key()
+            return sorted(self.cloud.access_keys.values(), key=lambda key: key['AccessKeyId'])
+
+    def _create_access_key(self, tags=None):
+        access_key = {'AccessKeyId': uuid.uuid4().hex[:20].upper(), 'SecretAccessKey': uuid.uuid4().hex,
+                      'Status': 'ACTIVE', 'OwnerId': OWNER_ID, 'Tags': tags or [],
+                      'CreateDate': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+        self.cloud.access_keys[access_key['AccessKeyId']] = access_key
+        return access_key
+
+    def _access_key(self, params):
+        try:
+            return self.cloud.access_keys[params.get('AccessKeyId')]
+        except KeyError:
+            raise MockError('NoSuchEntity', 'Access key {0} does not exist'.format(params.get('AccessKeyId')))
+
+    def GetAccount(self, params):
+        return {'Account': {'AccountPid': OWNER_ID, 'Email': 'mock@example.com', 'FirstName': 'Mock',
+                            'LastName': 'Account', 'City': 'Paris', 'ZipCode': '75000', 'Country': 'France',
+                            'CompanyName': 'Mock'}}
+
+    def AuthenticateAccount(self, params):
+        return {}
+
+    def CheckSignature(self, params):
+        self._access_keys()
+        with self.cloud.lock:
+            access_key = self._access_key(params)
+        key = ('AWS4' + access_key['SecretAccessKey']).encode('utf-8')
+        for part in (params.get('AmzDate', '')[:8], params.get('Region', ''), params.get('ServiceName', ''), 'aws4_request'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, params.get('StringToSign', '').encode('utf-8'), hashlib.sha256).hexdigest()
+        if access_key['Status'] != 'ACTIVE' or signature != params.get('Signature'):
+            raise MockError('SignatureDoesNotMatch', 'The request signature does not match')
+        return {}
+
+    def ListAccessKeys(self, params):
+        access_keys = self._access_keys()
+        start = 0
+        if params.get('Marker'):
+            start = [key['AccessKeyId'] for key in access_keys].index(params['Marker'])
+        end = start + int(params.get('MaxItems') or len(access_keys))
+        response = {'accessKeys': access_keys[start:end], 'isTruncated': end < len(access_keys)}
+        if end < len(access_keys):
+            response['marker'] = access_keys[end]['AccessKeyId']
+        return response
+
+    def GetAccessKey(self, params):
+        self._access_keys()
+        with self.cloud.lock:
+            return {'accessKey': self._access_key(params)}
+
+    def CreateAccessKey(self, params):
+        self._access_keys()
+        with self.cloud.lock:
+            return {'accessKey': self._create_access_key(params.get('Tags'))}
+
+    def DeleteAccessKey(self, params):
+        self._access_keys()
+        with self.cloud.lock:
+            del self.cloud.access_keys[self._access_key(params)['AccessKeyId']]
+        return {}
+
+    def UpdateAccessKey(self, params):
+        self._access_keys()
+        with self.cloud.lock:
+            access_key = self._access_key(params)
+            access_key['Status'] = params.get('Status', access_key['Status'])
+            return {'accessKey': access_key}
+
+    def ReadConsumptionAccount(self, params):
+        entries = []
+        for index, product in enumerate(self.cloud.catalog()):
+            entries.append({'Category': product['Category'], 'Operation': product['Operation'],
+                            'Service': product['Service'], 'Title': product['Title'], 'Type': product['Type'],
+                            'ZoneName': AVAILABILITY_ZONE, 'Value': float(1 + index % 24),
+                            'FromDate': params.get('FromDate'), 'ToDate': params.get('ToDate')})
+        return {'Entries': entries}
+
+    def ReadCatalog(self, params):
+        return {'Catalog': {'Entries': self.cloud.catalog()}}
+
+    def ReadPublicCatalog(self, params):
+        return {'Catalog': {'Entries': self.cloud.catalog()}}
+
+
+class OSUHandler(object):
+    """
+    OSU (S3 REST) requests, each returns (status, headers, body)
+    """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    @staticmethod
+    def _xml(name, content):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<{0} xmlns="{1}">{2}</{0}>'.format(name, OSU_NAMESPACE, render(content))
+
+    @staticmethod
+    def _etag(content):
+        return '"{0}"'.format(hashlib.md5(content).hexdigest())
+
+    def _bucket(self, bucket):
+        try:
+            return self.cloud.buckets[bucket]
+        except KeyError:
+            raise MockError('NoSuchBucket', 'The specified bucket does not exist', 404)
+
+    def _upload(self, upload_id):
+        try:
+            return self.cloud.uploads[upload_id]
+        except KeyError:
+            raise MockError('NoSuchUpload', 'The specified upload does not exist', 404)
+
+    def handle(self, method, bucket, key, query, headers, body):
+        """
+        :param str method: HTTP method
+        :param str bucket: bucket name
+        :param str key: object key, empty for bucket requests
+        :param dict query: query string parameters
+        :param headers: request headers
+        :param str body: request body
+        """
+        with self.cloud.lock:
+            if not key:
+                if method == 'PUT':
+                    self.cloud.buckets.setdefault(bucket, {})
+                    return 200, {}, ''
+                if method == 'DELETE':
+                    self._bucket(bucket)
+                    del self.cloud.buckets[bucket]
+                    return 204, {}, ''
+                prefix = query.get('prefix', '')
+                names = sorted(name for name in self._bucket(bucket) if name.startswith(prefix) and name > query.get('marker', ''))
+                listed = names[:int(query.get('max-keys') or 1000)]
+                return 200, {}, self._xml('ListBucketResult', [('Name', bucket), ('Prefix', prefix), ('IsTruncated', len(listed) < len(names))] +
+                                          [('Contents', [('Key', name), ('Size', len(self.cloud.buckets[bucket][name][0])),
+                                                         ('ETag', self.cloud.buckets[bucket][name][1]),
+                                                         ('LastModified', '2017-01-01T00:00:00.000Z')])
+                                           for name in listed])
+            objects = self._bucket(bucket)
+            if 'uploads' in query and method == 'POST':
+                upload_id = uuid.uuid4().hex
+                self.cloud.uploads[upload_id] = (bucket, key, {})
+                return 200, {}, self._xml('InitiateMultipartUploadResult', [('Bucket', bucket), ('Key', key), ('UploadId', upload_id)])
+            if 'uploadId' in query:
+                parts = self._upload(query['uploadId'])[2]
+                if method == 'PUT':
+                    parts[int(query['partNumber'])] = (body, self._etag(body))
+                    return 200, {'ETag': self._etag(body)}, ''
+                if method == 'GET':
+                    return 200, {}, self._xml('ListPartsResult', [('Bucket', bucket), ('Key', key), ('UploadId', query['uploadId']),
+                                                                 ('IsTruncated', 'false')] +
+                                              [('Part', [('PartNumber', number), ('ETag', etag), ('Size', len(content)),
+                                                         ('LastModified', '2017-01-01T00:00:00.000Z')])
+                                               for number, (content, etag) in sorted(parts.items())])
+                if method == 'DELETE':
+                    del self.cloud.uploads[query['uploadId']]
+                    return 204, {}, ''
+                content = ''.join(parts[number][0] for number in sorted(parts))
+                etag = '"{0}-{1}"'.format(hashlib.md5(''.join(parts[number][1] for number in sorted(parts))).hexdigest(), len(parts))
+                objects[key] = (content, etag)
+                del self.cloud.uploads[query['uploadId']]
+                return 200, {}, self._xml('CompleteMultipartUploadResult', [('Bucket', bucket), ('Key', key), ('ETag', etag)])
+            if method == 'PUT':
+                objects[key] = (body, self._etag(body))
+                return 200, {'ETag': self._etag(body)}, ''
+            if key not in objects:
+                raise MockError('NoSuchKey', 'The specified key does not exist.', 404)
+            if method == 'DELETE':
+                del objects[key]
+                return 204, {}, ''
+            content, etag = objects[key]
+        response_headers = {'ETag': etag, 'Last-Modified': 'Sun, 01 Jan 2017 00:00:00 GMT', 'Accept-Ranges': 'bytes'}
+        requested = headers.get('Range')
+        if requested and requested.startswith('bytes='):
+            start, _, end = requested[len('bytes='):].partition('-')
+            start, end = int(start), min(int(end) if end else len(content) - 1, len(content) - 1)
+            response_headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, len(content))
+            return 206, response_headers, content[start:end + 1]
+        return 200, response_headers, content
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """
+    Dispatch HTTP requests to FCUHandler, ICUHandler or OSUHandler
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, do not let them wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections[self.connection] = threading.current_thread()
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.pop(self.connection, None)
+        BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._handle()
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _handle(self):
+        mock = self.server.mock
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        target = self.headers.get('X-Amz-Target')
+        url = urlparse.urlparse(self.path)
+        osu = not target and url.path != '/'
+        if target:
+            action = target[len(ICU_TARGET_PREFIX):] if target.startswith(ICU_TARGET_PREFIX) else target
+            params = json.loads(body) if body else {}
+        elif osu:
+            params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+            action = 'OSU{0}'.format(self.command)
+        else:
+            params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+            if body:
+                params.update(urlparse.parse_qsl(body, keep_blank_values=True))
+            action = params.get('Action', '')
+        mock.cloud.count(action)
+        mock.delay()
+        request_id = str(uuid.uuid4())
+        try:
+            if mock.failing():
+                raise MockError('RequestLimitExceeded', 'Request limit exceeded.', mock.error_status)
+            if target:
+                self._handle_icu(action, params)
+            elif osu:
+                bucket, _, key = urlparse.unquote(url.path).lstrip('/').partition('/')
+                status, headers, content = mock.osu.handle(self.command, bucket, key, params, self.headers, body)
+                self._send(status, content, 'application/xml' if content.startswith('<?xml') else 'binary/octet-stream', headers)
+            else:
+                self._handle_query(action, params, request_id)
+        except Exception as err:
+            if not isinstance(err, MockError):
+                err = MockError('InternalError', '{0}: {1}'.format(err.__class__.__name__, err), 500)
+            if osu:
+                self._send(err.status, ('<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{0}</Code><Message>{1}</Message>'
+                                        '<RequestId>{2}</RequestId></Error>').format(err.code, escape(err.message), request_id),
+                           'application/xml')
+            elif target:
+                self._send(err.status, json.dumps({'__type': err.code, 'message': err.message}), 'application/x-amz-json-1.1')
+            else:
+                self._send(err.status, ('<?xml version="1.0" encoding="UTF-8"?>\n<Response><Errors><Error><Code>{0}</Code>'
+                                        '<Message>{1}</Message></Error></Errors><RequestID>{2}</RequestID></Response>'
+                                        ).format(err.code, escape(err.message), request_id), 'text/xml')
+
+    def _handle_query(self, action, params, request_id):
+        method = getattr(self.server.mock.fcu, action, None) if action[:1].isupper() else None
+        if method is None:
+            raise MockError('InvalidAction', 'The action {0} is not valid for this web service.'.format(action))
+        content = render(method(params))
+        namespace = LBU_NAMESPACE if 'LoadBalancer' in action else FCU_NAMESPACE
+        if 'LoadBalancer' in action:
+            content += '<ResponseMetadata><RequestId>{0}</RequestId></ResponseMetadata>'.format(request_id)
+        else:
+            content = '<requestId>{0}</requestId>{1}'.format(request_id, content)
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n<{0}Response xmlns="{1}">{2}</{0}Response>'.format(action, namespace, content)
+        self._send(200, body, 'text/xml')
+
+    def _handle_icu(self, action, params):
+        method = getattr(self.server.mock.icu, action, None) if action[:1].isupper() else None
+        if method is None:
+            raise MockError('InvalidAction', 'The action {0} is not valid for this web service.'.format(action))
+        self._send(200, json.dumps(method(params)), 'application/x-amz-json-1.1')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.lock = threading.Lock()
+        # kept alive client connections -> handler thread, closed on stop
+        self.connections = {}
+
+    def handle_error(self, request, client_address):
+        # clients closing kept alive connections, or connections closed by stop
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def close_connections(self):
+        with self.lock:
+            connections = list(self.connections.items())
+        for connection, _ in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for _, thread in connections:
+            thread.join(1)
+
+
+class MockServer(object):
+    """
+    HTTP server answering FCU, LBU, ICU and OSU calls from a MockCloud
+    """
+
+    def __init__(self, cloud=None, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503):
+        """
+        :param MockCloud cloud: ressources, a new MockCloud if None
+        :param str host: listening address
+        :param int port: listening port, a free port if 0
+        :param float latency: seconds added to every call
+        :param float jitter: random seconds added to latency, uniformly drawn in [0, jitter]
+        :param float error_rate: ratio of calls failing with RequestLimitExceeded
+        :param int error_status: HTTP status of failing calls
+        """
+        self.cloud = cloud or MockCloud()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fcu = FCUHandler(self.cloud)
+        self.icu = ICUHandler(self.cloud)
+        self.osu = OSUHandler(self.cloud)
+        self._random = random.Random()
+        self._httpd = _ThreadingHTTPServer((host, port), MockRequestHandler)
+        self._httpd.mock = self
+        self._thread = None
+
+    def __repr__(self):
+        return 'MockServer:{0}'.format(self.endpoint)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def endpoint(self):
+        host, port = self._httpd.server_address[:2]
+        return '{0}:{1}'.format(host, port)
+
+    @property
+    def url(self):
+        return 'http://{0}'.format(self.endpoint)
+
+    def delay(self):
+        pause = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if pause > 0:
+            time.sleep(pause)
+
+    def failing(self):
+        return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='mock-server')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._httpd.close_connections()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write_settings(self, path, section='mock'):
+        """
+        Write a services.ini with a section using the mock server for FCU, LBU, ICU and OSU
+        Connections must be created with is_secure=False.
+        :param str path: services.ini path
+        :param str section: region name to give to OCBConnections
+        """
+        with open(path, 'w') as settings:
+            settings.write('[{0}]\n'.format(section))
+            settings.write('access_key_id = MOCKACCESSKEY\n')
+            settings.write('secret_access_key = MOCKSECRETKEY\n')
+            settings.write('fcu_endpoint = {0}\n'.format(self.endpoint))
+            settings.write('lbu_endpoint = {0}\n'.format(self.endpoint))
+            settings.write('osu_endpoint = {0}\n'.format(self.endpoint))
+            settings.write('icu_endpoint = {0}\n'.format(self.url))
+            settings.write('icu_login = \n')
+            settings.write('icu_password = \n')
+        return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a mock FCU/LBU/ICU API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of throttled calls')
+    parser.add_argument('--result-size', type=int, default=100, help='items in reference data responses')
+    parser.add_argument('--transition-delay', type=float, default=1.0, help='seconds between ressource states')
+    parser.add_argument('--seed-vpcs', type=int, default=0, help='populated VPCs created at start')
+    args = parser.parse_args()
+    cloud = MockCloud(args.result_size, args.transition_delay)
+    for _ in range(args.seed_vpcs):
+        print('Seeded {0}'.format(cloud.seed_vpc()))
+    server = MockServer(cloud, port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    print('Serving on {0}'.format(server.url))
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compare boto EC2Object parsing with compact records on large Describe responses.
+
+    python -m osc_cloud_builder.benchmark.parsing --items 10000
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import argparse
+import gc
+import sys
+import time
+import xml.sax
+
+import boto.handler
+from boto.resultset import ResultSet
+from osc_cloud_builder.vendor.outscale.fcu.instance_type import InstanceType
+from osc_cloud_builder.vendor.outscale.fcu.product_type import ProductType
+from osc_cloud_builder.vendor.outscale.fcu.quota import ReferenceQuota
+from osc_cloud_builder.vendor.outscale.fcu import records
+
+NAMESPACE = 'http://ec2.amazonaws.com/doc/2017-06-01/'
+
+INSTANCE_TYPE_ITEM = ('<item><name>tinav{0}.c2r4</name><vcpu>2</vcpu><memory>4096</memory>'
+                      '<storageSize>0</storageSize><storageCount>0</storageCount>'
+                      '<maxIpAddresses>16</maxIpAddresses>'
+                      '<ebsOptimizedAvailable>true</ebsOptimizedAvailable></item>')
+
+QUOTA_ITEM = ('<item><ownerId>123456789012</ownerId><name>quota_{0}</name>'
+              '<displayName>Quota {0}</displayName><description>Quota number {0}</description>'
+              '<groupName>Compute</groupName><maxQuotaValue>100</maxQuotaValue>'
+              '<usedQuotaValue>{1}</usedQuotaValue></item>')
+
+# non-ASCII text, parsed as unicode
+PRODUCT_TYPE_ITEM = ('<item><productTypeId>{0:04d}</productTypeId>'
+                     '<description>Système d\'exploitation n°{0}</description><vendor>Société</vendor></item>')
+
+
+def instance_types_response(items):
+    """
+    DescribeInstanceTypes response body with items instance types
+    """
+    body = ''.join([INSTANCE_TYPE_ITEM.format(i) for i in range(items)])
+    return ('<DescribeInstanceTypesResponse xmlns="{0}"><requestId>bench</requestId>'
+            '<instanceTypeSet>{1}</instanceTypeSet></DescribeInstanceTypesResponse>').format(NAMESPACE, body)
+
+
+def product_types_response(items):
+    """
+    DescribeProductTypes response body with items product types
+    """
+    body = ''.join([PRODUCT_TYPE_ITEM.format(i) for i in range(items)])
+    return ('<DescribeProductTypesResponse xmlns="{0}"><requestId>bench</requestId>'
+            '<productTypeSet>{1}</productTypeSet></DescribeProductTypesResponse>').format(NAMESPACE, body)
+
+
+def quotas_response(items, quotas_per_reference=10):
+    """
+    DescribeQuotas response body with items quotas, grouped by quotas_per_reference
+    """
+    references = []
+    for start in range(0, items, quotas_per_reference):
+        quotas = ''.join([QUOTA_ITEM.format(i, i % 100) for i in range(start, min(items, start + quotas_per_reference))])
+        references.append('<item><reference>ref-{0}</reference><quotaSet>{1}</quotaSet></item>'.format(start, quotas))
+    return ('<DescribeQuotasResponse xmlns="{0}"><requestId>bench</requestId>'
+            '<referenceQuotaSet>{1}</referenceQuotaSet></DescribeQuotasResponse>').format(NAMESPACE, ''.join(references))
+
+
+def deep_size(obj, seen=None):
+    """
+    Approximate memory held by obj, following containers, __dict__ and __slots__
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size += deep_size(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, '__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+def parse_boto(body, cls):
+    result = ResultSet([('item', cls)])
+    xml.sax.parseString(body, boto.handler.XmlHandler(result, None))
+    return result
+
+
+def parse_compact(body, record_class):
+    return records.parse_records(body, record_class)
+
+
+def measure(parser, body, model, repeat):
+    """
+    :return tuple: best parse time in seconds, approximate size of the result in bytes
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        result = parser(body, model)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # connection is shared by every object, do not count it
+    seen = set([id(None)])
+    return best, deep_size(result, seen)
+
+
+def run(items=10000, repeat=3):
+    """
+    Parse the generated responses with both parsers and return the report lines
+    """
+    cases = [
+        ('DescribeInstanceTypes', instance_types_response(items), InstanceType, records.InstanceTypeRecord),
+        ('DescribeQuotas', quotas_response(items), ReferenceQuota, records.ReferenceQuotaRecord),
+        ('DescribeProductTypes', product_types_response(items), ProductType, records.ProductTypeRecord),
+    ]
+    lines = ['{0:<22} {1:>8} {2:>10} {3:>12}'.format('response', 'parser', 'time (s)', 'size (KiB)')]
+    for name, body, model, record_class in cases:
+        boto_time, boto_size = measure(parse_boto, body, model, repeat)
+        compact_time, compact_size = measure(parse_compact, body, record_class, repeat)
+        lines.append('{0:<22} {1:>8} {2:>10.3f} {3:>12}'.format(name, 'boto', boto_time, boto_size // 1024))
+        lines.append('{0:<22} {1:>8} {2:>10.3f} {3:>12}'.format(name, 'compact', compact_time, compact_size // 1024))
+        lines.append('{0:<22} {1:>8} {2:>9.1f}x {3:>11.1f}x'.format(name, 'gain', boto_time / compact_time,
+                                                                     float(boto_size) / compact_size))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare boto and compact record parsing')
+    parser.add_argument('--items', type=int, default=10000, help='items per response')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per parser, best time is kept')
+    args = parser.parse_args()
+    for line in run(args.items, args.repeat):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
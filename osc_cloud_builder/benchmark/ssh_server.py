@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+In-process SSH server, to run osc_cloud_builder.tools.ssh_fanout without instances.
+
+Commands are run by a handler, a local shell by default, and direct-tcpip channels
+are forwarded, so one server can play the bouncer of others:
+
+    with MockSSHServer() as bouncer, MockSSHServer(handler=lambda command: (0, 'ok\\n', '')) as instance:
+        with SSHFanout(key_filename=key_path, bouncer=bouncer.endpoint) as fanout:
+            fanout.map([instance.endpoint], 'uptime')
+
+Any public key is accepted.
+
+Requirements:
+    pip install paramiko
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import socket
+import subprocess
+import threading
+import paramiko
+
+_HOST_KEY = []
+_HOST_KEY_LOCK = threading.Lock()
+
+
+def _host_key():
+    # generating a key takes a while, all servers of the process share one
+    with _HOST_KEY_LOCK:
+        if not _HOST_KEY:
+            _HOST_KEY.append(paramiko.RSAKey.generate(2048))
+        return _HOST_KEY[0]
+
+
+def shell(command):
+    """
+    Default handler, run the command in a local shell
+    :param str command: shell command
+    :return tuple: (exit status, stdout, stderr)
+    """
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+
+class _Interface(paramiko.ServerInterface):
+
+    def __init__(self, server):
+        self.server = server
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.server.count('commands')
+        thread = threading.Thread(target=self.server._execute, args=(channel, command), name='mock-ssh-exec')
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class MockSSHServer(object):
+    """
+    SSH server running commands with a handler and forwarding direct-tcpip channels
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, handler=shell):
+        """
+        :param str host: listening address
+        :param int port: listening port, a free port if 0
+        :param callable handler: called with the command, returns (exit status, stdout, stderr)
+        """
+        self.handler = handler
+        self.stats = {'connections': 0, 'commands': 0, 'forwards': 0}
+        self._stats_lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(128)
+        self._transports = []
+        self._running = False
+        self._thread = None
+
+    def __repr__(self):
+        return 'MockSSHServer:{0}'.format(self.endpoint)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def endpoint(self):
+        host, port = self._socket.getsockname()[:2]
+        return '{0}:{1}'.format(host, port)
+
+    def count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def start(self):
+        _host_key()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='mock-ssh-server')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._socket.close()
+        for transport in list(self._transports):
+            transport.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                connection, _ = self._socket.accept()
+            except socket.error:
+                return
+            self.count('connections')
+            thread = threading.Thread(target=self._session, args=(connection,), name='mock-ssh-session')
+            thread.daemon = True
+            thread.start()
+
+    def _session(self, connection):
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(_host_key())
+        interface = _Interface(self)
+        self._transports.append(transport)
+        try:
+            transport.start_server(server=interface)
+            while transport.is_active():
+                channel = transport.accept(1.0)
+                if channel is None:
+                    continue
+                destination = interface.destinations.pop(channel.get_id(), None)
+                if destination is not None:
+                    self.count('forwards')
+                    thread = threading.Thread(target=self._forward, args=(channel, destination), name='mock-ssh-forward')
+                    thread.daemon = True
+                    thread.start()
+        except (paramiko.SSHException, EOFError, socket.error):
+            pass
+        finally:
+            self._transports.remove(transport)
+            transport.close()
+
+    def _execute(self, channel, command):
+        try:
+            status, stdout, stderr = self.handler(command)
+        except Exception as err:
+            status, stdout, stderr = 255, '', str(err)
+        try:
+            if stdout:
+                channel.sendall(stdout)
+            if stderr:
+                channel.sendall_stderr(stderr)
+            channel.send_exit_status(status)
+            # the exec request may not be acknowledged yet: a close now would fail it on the client,
+            # send EOF and let the client close the channel
+            channel.shutdown_write()
+        except (socket.error, EOFError):
+            # the client closed the channel, on timeout
+            pass
+
+    @staticmethod
+    def _forward(channel, destination):
+        try:
+            upstream = socket.create_connection(destination)
+        except socket.error:
+            channel.close()
+            return
+
+        def pump(source, target, receive, send):
+            try:
+                while True:
+                    data = receive(32768)
+                    if not data:
+                        break
+                    send(data)
+            except (socket.error, EOFError):
+                pass
+            finally:
+                source.close()
+                target.close()
+
+        thread = threading.Thread(target=pump, args=(upstream, channel, upstream.recv, channel.sendall), name='mock-ssh-pump')
+        thread.daemon = True
+        thread.start()
+        pump(channel, upstream, channel.recv, upstream.sendall)
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmarks of the connection, parsing, waiting, teardown and signature paths against the mock server.
+
+    python -m osc_cloud_builder.benchmark.suite --latency 0.005 --result-size 1000
+    python -m osc_cloud_builder.benchmark.suite --json current.json --baseline reference.json
+
+With --baseline, the exit status is 1 when a scenario p50 latency regressed more than --tolerance.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from functools import partial
+
+from osc_cloud_builder.OCBase import OCBConnections, OCBError
+from osc_cloud_builder.benchmark.mock_server import MockCloud, MockServer
+from osc_cloud_builder.sample.vpc.vpc_teardown import _discover, build_teardown_graph
+from osc_cloud_builder.tools.wait_for import wait_state
+from osc_cloud_builder.vendor.outscale.fcu import connect_fcu_endpoint
+from osc_cloud_builder.vendor.outscale.icu import signature
+
+Measurement = namedtuple('Measurement', ['scenario', 'iterations', 'calls', 'duration', 'p50', 'p99', 'memory'])
+
+SCENARIOS = ('startup', 'connection', 'parsing', 'waiting', 'teardown', 'signature')
+
+
+def percentile(values, ratio):
+    """
+    :param list values: measures
+    :param float ratio: between 0 and 1
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(ratio * len(ordered)))]
+
+
+def peak_memory():
+    """
+    :return int: peak resident memory of the process in KiB
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+class Benchmark(object):
+    """
+    Run scenarios against a mock server and collect their measurements
+    """
+
+    def __init__(self, server, ocb):
+        """
+        :param MockServer server: running mock server
+        :param OCBConnections ocb: connections to the mock server
+        """
+        self.server = server
+        self.ocb = ocb
+        self.measurements = []
+
+    def measure(self, scenario, operation, iterations, threads=1):
+        """
+        Call operation iterations times from threads threads
+        :param str scenario: name of the measurement
+        :param callable operation: function without parameters
+        :return Measurement:
+        """
+        latencies = []
+        lock = threading.Lock()
+        remaining = [iterations]
+
+        def worker():
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                start = time.time()
+                operation()
+                elapsed = time.time() - start
+                with lock:
+                    latencies.append(elapsed)
+
+        calls_before = sum(self.server.cloud.calls.values())
+        memory_before = peak_memory()
+        start = time.time()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        duration = time.time() - start
+        measurement = Measurement(scenario, iterations, sum(self.server.cloud.calls.values()) - calls_before, duration,
+                                  percentile(latencies, 0.5), percentile(latencies, 0.99), peak_memory() - memory_before)
+        self.measurements.append(measurement)
+        return measurement
+
+    def startup(self, iterations=10):
+        """
+        New interpreters importing OCBase, then also doing one FCU call, as short scripts do
+        """
+        directory = tempfile.mkdtemp(prefix='ocb-startup-')
+        try:
+            settings = self.server.write_settings(os.path.join(directory, 'services.ini'))
+            package = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            environment = dict(os.environ, PYTHONPATH=os.pathsep.join([package, os.environ.get('PYTHONPATH', '')]))
+            scripts = (
+                ('startup.import', 'import osc_cloud_builder.OCBase'),
+                ('startup.fcu_call', 'from osc_cloud_builder.OCBase import OCBConnections; '
+                                     'OCBConnections("mock", [{0!r}], is_secure=False, use_environment=False)'
+                                     '.fcu.get_all_vpcs()'.format(settings)),
+            )
+            for scenario, script in scripts:
+                self.measure(scenario, partial(subprocess.check_call, [sys.executable, '-c', script], env=environment), iterations)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def connection(self, iterations=200, threads=8):
+        """
+        DescribeInstances with a new connection per call, then with the per thread connections of the pool
+        """
+        def new_connection():
+            fcu = connect_fcu_endpoint(self.server.url, 'MOCKACCESSKEY', 'MOCKSECRETKEY', is_secure=False)
+            fcu.get_all_instances()
+
+        self.measure('connection.new', new_connection, iterations, threads)
+        self.measure('connection.pooled', lambda: self.ocb.fcu.get_all_instances(), iterations, threads)
+
+    def parsing(self, iterations=20):
+        """
+        Reference data responses parsed as boto objects and as compact records
+        """
+        self.measure('parsing.quotas', lambda: self.ocb.fcu.get_all_quotas(), iterations)
+        self.measure('parsing.quotas.compact', lambda: self.ocb.fcu.get_all_quotas(compact=True), iterations)
+        self.measure('parsing.instance_types', lambda: self.ocb.fcu.get_all_instance_types(), iterations)
+        self.measure('parsing.instance_types.compact', lambda: self.ocb.fcu.get_all_instance_types(compact=True), iterations)
+
+    def waiting(self, iterations=3, instances=20):
+        """
+        Run instances and wait for all of them to be running
+        """
+        subnet_id = self.server.cloud.create_subnet(self.server.cloud.create_vpc()['id'], '10.0.0.0/24')['id']
+
+        def run_and_wait():
+            reservation = self.ocb.fcu.run_instances('ami-mock', subnet_id=subnet_id, min_count=instances, max_count=instances)
+            wait_state(reservation.instances, 'running', timeout=60)
+
+        self.measure('waiting.{0}_instances'.format(instances), run_and_wait, iterations)
+
+    def teardown(self, iterations=3, max_workers=8):
+        """
+        Discover and delete populated VPCs
+        """
+        def teardown_vpc():
+            vpc_id = self.server.cloud.seed_vpc()
+            ressources = _discover(self.ocb, vpc_id, max_workers)
+            graph = build_teardown_graph(self.ocb, vpc_id, ressources)
+            graph.run(max_workers)
+            if vpc_id in self.server.cloud.ressources['vpc']:
+                self.ocb.log('Teardown of {0} failed: {1}'.format(vpc_id, graph.failed()), 'warning')
+
+        self.measure('teardown.vpc', teardown_vpc, iterations)
+
+    def signature(self, iterations=200, threads=8):
+        """
+        Signatures checked by ICU CheckSignature, then verified locally
+        """
+        access_key = self.ocb.icu.get_all_access_keys()['accessKeys'][0]
+        stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        string_to_sign = '\n'.join([signature.ALGORITHM, stamp, signature.credential_scope(stamp[:8], 'mock', 'fcu'),
+                                    hashlib.sha256(b'').hexdigest()])
+        key = signature.signing_key(access_key['SecretAccessKey'], stamp[:8], 'mock', 'fcu')
+        signed = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        params = (access_key['AccessKeyId'], signed, string_to_sign, 'mock', 'fcu', stamp[:8])
+
+        self.measure('signature.remote', lambda: self.ocb.icu.check_signature(*params), iterations, threads)
+        verifier = signature.get_verifier(self.ocb.icu)
+        remote, rejected = verifier.remote, verifier.rejected
+        self.measure('signature.local', lambda: self.ocb.icu.verify_signature(*params), iterations * 100, threads)
+        # calls/s only counts the key lookup, iter/s is the local verification throughput
+        if verifier.remote != remote or verifier.rejected != rejected:
+            raise OCBError('Signatures were not verified locally: {0}'.format(verifier))
+
+
+def report(measurements):
+    """
+    :return list: table lines
+    """
+    lines = ['{0:<32} {1:>6} {2:>9} {3:>7} {4:>9} {5:>9} {6:>9} {7:>10}'.format(
+        'scenario', 'iter', 'iter/s', 'calls', 'calls/s', 'p50 (ms)', 'p99 (ms)', 'mem (KiB)')]
+    for measurement in measurements:
+        lines.append('{0:<32} {1:>6} {2:>9.1f} {3:>7} {4:>9.1f} {5:>9.1f} {6:>9.1f} {7:>10}'.format(
+            measurement.scenario, measurement.iterations,
+            measurement.iterations / measurement.duration if measurement.duration else 0.0, measurement.calls,
+            measurement.calls / measurement.duration if measurement.duration else 0.0,
+            measurement.p50 * 1000, measurement.p99 * 1000, measurement.memory))
+    return lines
+
+
+def regressions(measurements, baseline, tolerance=0.2):
+    """
+    :param list measurements: current measurements
+    :param dict baseline: scenario -> measurement as dict, from a previous --json output
+    :param float tolerance: allowed p50 increase ratio
+    :return list: messages of regressed scenarios
+    """
+    messages = []
+    for measurement in measurements:
+        reference = baseline.get(measurement.scenario)
+        if reference and reference['p50'] and measurement.p50 > reference['p50'] * (1 + tolerance):
+            messages.append('{0}: p50 {1:.1f}ms, was {2:.1f}ms'.format(
+                measurement.scenario, measurement.p50 * 1000, reference['p50'] * 1000))
+    return messages
+
+
+def run(scenarios=SCENARIOS, latency=0.0, jitter=0.0, error_rate=0.0, result_size=1000, transition_delay=0.5):
+    """
+    Start a mock server and run scenarios against it
+    :return list: measurements
+    """
+    cloud = MockCloud(result_size=result_size, transition_delay=transition_delay)
+    directory = tempfile.mkdtemp(prefix='ocb-benchmark-')
+    try:
+        with MockServer(cloud, latency=latency, jitter=jitter, error_rate=error_rate) as server:
+            settings = server.write_settings(os.path.join(directory, 'services.ini'))
+            ocb = OCBConnections('mock', [settings], is_secure=False, use_environment=False)
+            benchmark = Benchmark(server, ocb)
+            for scenario in scenarios:
+                getattr(benchmark, scenario)()
+            return benchmark.measurements
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark OCB against a local mock server')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated list among {0}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of throttled calls')
+    parser.add_argument('--result-size', type=int, default=1000, help='items in reference data responses')
+    parser.add_argument('--transition-delay', type=float, default=0.5, help='seconds between ressource states')
+    parser.add_argument('--json', help='write measurements to this file')
+    parser.add_argument('--baseline', help='measurements of a previous --json run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p50 increase ratio against the baseline')
+    args = parser.parse_args()
+
+    measurements = run([scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()],
+                       args.latency, args.jitter, args.error_rate, args.result_size, args.transition_delay)
+    for line in report(measurements):
+        print(line)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(dict((measurement.scenario, measurement._asdict()) for measurement in measurements), output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            messages = regressions(measurements, json.load(baseline), args.tolerance)
+        for message in messages:
+            print('Regression {0}'.format(message))
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+ocb command line.
+
+    ocb stats [--spans FILE] [--top N]
+        slowest API actions recorded by a SpanSink (instrument_spans_file in the boto config)
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import sys
+import json
+import argparse
+import boto
+from osc_cloud_builder.vendor.outscale.instrument import CallRecord, HistogramSink
+
+
+def load_spans(path):
+    """
+    :param path: JSON lines file written by a SpanSink
+    :type path: str
+    :return: histogram of the API call spans, trace() blocks excluded
+    :rtype: osc_cloud_builder.vendor.outscale.instrument.HistogramSink
+    """
+    histogram = HistogramSink()
+    with open(path) as spans_file:
+        for line in spans_file:
+            if not line.strip():
+                continue
+            span = json.loads(line)
+            attributes = span['attributes']
+            if attributes['rpc.service'] == 'trace':
+                continue
+            start = span['start_time_unix_nano'] / 1e9
+            histogram.add(CallRecord(attributes['rpc.service'], attributes['rpc.method'], attributes['net.peer.name'],
+                                     attributes['http.status_code'], attributes['ocb.error'], start,
+                                     span['end_time_unix_nano'] / 1e9 - start,
+                                     attributes['http.request_content_length'], attributes['http.response_content_length'],
+                                     attributes['ocb.retries'], span['trace_id'], span['span_id'], span['parent_span_id']))
+    return histogram
+
+
+def stats(args):
+    spans = args.spans or boto.config.get('Boto', 'instrument_spans_file', None)
+    if not spans:
+        sys.stderr.write('No spans file, use --spans or set instrument_spans_file in the Boto section of the boto config\n')
+        return 1
+    print(load_spans(spans).report(args.top))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='ocb', description='OSC Cloud Builder')
+    commands = parser.add_subparsers(dest='command')
+    stats_parser = commands.add_parser('stats', help='slowest API actions')
+    stats_parser.add_argument('--spans', help='JSON lines file of a SpanSink, instrument_spans_file of the boto config by default')
+    stats_parser.add_argument('--top', type=int, default=10, help='number of actions')
+    stats_parser.set_defaults(func=stats)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Logging pipeline of OCB.
+
+Records are put in a queue by a QueueHandler and written by a QueueListener thread,
+so file and console I/O never block the threads doing API calls. Records carry the
+ressource IDs they are about (given with resource_ids or found in the message), and
+can be written as JSON lines with JsonFormatter.
+
+Records of the boto logger go through the same listener, as they went to the OCB
+log file when OCB configured the root logger.
+
+Python 2.6 and 2.7 have no logging.handlers.QueueHandler, hence the classes below.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import re
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+import Queue
+
+LOGGER_NAME = 'osc_cloud_builder'
+BOTO_LOGGER_NAME = 'boto'
+
+TEXT_FORMAT = '%(asctime)s.%(msecs)d %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Outscale ressource IDs: vpc-12345678, i-12345678, eipalloc-12345678...
+RESOURCE_ID = re.compile(r'\b(?:ami|eipalloc|eni|i|igw|nat|rtb|rtbassoc|sg|snap|subnet|vol|vpc|vgw|dopt|pcx|key)-[0-9a-f]{8}\b')
+
+
+class LazyMessage(object):
+    """
+    Message formatted with str.format only when a handler writes it
+    """
+    __slots__ = ('module_name', 'message', 'args')
+
+    def __init__(self, module_name, message, args):
+        self.module_name = module_name
+        self.message = message
+        self.args = args
+
+    def __str__(self):
+        message = self.message.format(*self.args) if self.args else self.message
+        return '{0} - {1}'.format(self.module_name, message)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Put records in a queue instead of writing them, see QueueListener.
+    The message is formatted by the calling thread, records are dropped when the queue is full.
+    """
+
+    def __init__(self, queue):
+        """
+        :param queue: Queue.Queue, bounded to limit the memory used when writes are slow
+        :type queue: Queue.Queue
+        """
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Format the message now, arguments may change once the record is queued
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Thread writing the records of a queue to handlers
+    """
+    _SENTINEL = None
+
+    def __init__(self, queue, *handlers):
+        """
+        :param queue: queue filled by a QueueHandler
+        :type queue: Queue.Queue
+        :param handlers: handlers writing the records, their level is honoured
+        :type handlers: logging.Handler
+        """
+        self.queue = queue
+        self.handlers = list(handlers)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._monitor, name='ocb-log-listener')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """
+        Write the queued records and stop the thread
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(self._SENTINEL)
+            thread.join()
+
+    def add_handler(self, handler):
+        with self._lock:
+            self.handlers = self.handlers + [handler]
+
+    def remove_handler(self, handler):
+        with self._lock:
+            self.handlers = [known for known in self.handlers if known is not handler]
+        handler.close()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._SENTINEL:
+                break
+            self.handle(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: time, level, module, message, resource_ids, thread and exception
+    """
+
+    def format(self, record):
+        message = record.getMessage()
+        module_name = getattr(record, 'ocb_module', '')
+        if message.startswith(module_name + ' - '):
+            message = message[len(module_name) + 3:]
+        resource_ids = list(getattr(record, 'resource_ids', None) or [])
+        for resource_id in RESOURCE_ID.findall(message):
+            if resource_id not in resource_ids:
+                resource_ids.append(resource_id)
+        document = {
+            'time': '{0}.{1:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)), int(record.msecs)),
+            'level': record.levelname,
+            'module': module_name,
+            'message': message,
+            'resource_ids': resource_ids,
+            'thread': record.threadName,
+        }
+        if record.exc_text:
+            document['exception'] = record.exc_text
+        return json.dumps(document, sort_keys=True)
+
+
+class NullHandler(logging.Handler):
+    """
+    logging.NullHandler, missing from Python 2.6
+    """
+
+    def emit(self, record):
+        pass
+
+
+# no "No handlers could be found" warning when OCB logs before setup_logging
+logging.getLogger(LOGGER_NAME).addHandler(NullHandler())
+
+_LISTENER = []
+_LISTENER_LOCK = threading.Lock()
+
+
+def _listener():
+    with _LISTENER_LOCK:
+        if not _LISTENER:
+            queue = Queue.Queue(maxsize=10000)
+            listener = QueueListener(queue)
+            listener.start()
+            atexit.register(listener.stop)
+            handler = QueueHandler(queue)
+            logger = logging.getLogger(LOGGER_NAME)
+            logger.addHandler(handler)
+            logger.propagate = False
+            logging.getLogger(BOTO_LOGGER_NAME).addHandler(handler)
+            _LISTENER.append(listener)
+        return _LISTENER[0]
+
+
+def _replace(kind, handler):
+    listener = _listener()
+    for known in listener.handlers:
+        if getattr(known, 'ocb_kind', None) == kind:
+            listener.remove_handler(known)
+    handler.ocb_kind = kind
+    listener.add_handler(handler)
+    return handler
+
+
+def setup_logging(filename='/tmp/ocb.log', level='INFO', json_format=False):
+    """
+    Write OCB and boto records to filename through the background listener.
+    Calling it again replaces the file handler, it never adds a second one.
+    :param filename: file records are appended to, no file if None
+    :type filename: str
+    :param level: level name of the osc_cloud_builder and boto loggers
+    :type level: str
+    :param json_format: write JSON lines instead of text
+    :type json_format: bool
+    :return: osc_cloud_builder logger
+    :rtype: logging.Logger
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(getattr(logging, level))
+    logging.getLogger(BOTO_LOGGER_NAME).setLevel(getattr(logging, level))
+    if filename:
+        handler = logging.FileHandler(filename, mode='a')
+        handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+        _replace('file', handler)
+    else:
+        _listener()
+    return logger
+
+
+def add_stdout_handler(json_format=False):
+    """
+    Write OCB records of any level to stdout through the background listener, once however often it is called
+    :param json_format: write JSON lines instead of text
+    :type json_format: bool
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(JsonFormatter() if json_format else
+                         logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    return _replace('stdout', handler)
+
+
+def log(message, level='debug', module_name='', args=(), resource_ids=None):
+    """
+    Log message on the osc_cloud_builder logger, formatted only if the level is enabled
+    :param message: message, formatted with str.format(*args) if args are given
+    :type message: str
+    :param level: level name (debug, info, warning, error, critical)
+    :type level: str
+    :param module_name: module the message is coming from
+    :type module_name: str
+    :param args: str.format arguments of message
+    :type args: tuple
+    :param resource_ids: IDs of the ressources involved, IDs found in message are added by JsonFormatter
+    :type resource_ids: list
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    levelno = logging.getLevelName(level.upper())
+    if not isinstance(levelno, int):
+        levelno = logging.DEBUG
+    if not logger.isEnabledFor(levelno):
+        return
+    logger.log(levelno, LazyMessage(module_name, message, args),
+               extra={'ocb_module': module_name, 'resource_ids': list(resource_ids or [])})
@@ -39,7 +39,9 @@ import urllib2
 import json
 from osc_cloud_builder.OCBase import OCBase
 from osc_cloud_builder.sample.vpc.vpc_with_two_subnets import setup_vpc
+from osc_cloud_builder.tools.tagging import Tagger
 from osc_cloud_builder.tools.wait_for import wait_state
+from osc_cloud_builder.tools.access_log_ingest import AccessLogIngestor
 from boto.ec2.elb.attributes import AccessLogAttribute
 
 S3_BUCKET_NAME = 'sample'
@@ -56,15 +58,18 @@ def prepare_infra(listeners=[(80, 80, 'TCP')], tag_prefix='', key_name=None, omi
     ocb = OCBase()
     ocb.activate_stdout_logging()
     vpc, instance_bouncer, instance_private_1 = setup_vpc(tag_prefix=tag_prefix, key_name=key_name, omi_id=omi_id, instance_type=instance_type)
-    sg_public = ocb.fcu.get_all_security_groups(group_ids=[instance_bouncer.groups[0].id])[0]
-    sg_private = ocb.fcu.get_all_security_groups(group_ids=[instance_private_1.groups[0].id])[0]
+    group_ids = [instance_bouncer.groups[0].id, instance_private_1.groups[0].id]
+    groups = dict((sg.id, sg) for sg in ocb.fcu.get_all_security_groups(group_ids=group_ids))
+    sg_public = groups[group_ids[0]]
+    sg_private = groups[group_ids[1]]
     instance_private_2 = ocb.fcu.run_instances(omi_id,
                                                key_name = instance_private_1.key_name,
                                                instance_type = instance_private_1.instance_type,
                                                subnet_id = instance_private_1.subnet_id,
                                                security_group_ids = [sg_private.id]).instances[0]
     wait_state([instance_private_2], 'running')
-    ocb.fcu.create_tags([instance_private_2.id], {'Name': tag_prefix})
+    tagger = Tagger(ocb)
+    tagger.tag([instance_private_2.id], {'Name': tag_prefix})
     #
     lb = ocb.lbu.create_load_balancer('int-fac-{0}'.format(str(uuid.uuid4().fields[0])), None,
                                       listeners=listeners,
@@ -80,6 +85,7 @@ def prepare_infra(listeners=[(80, 80, 'TCP')], tag_prefix='', key_name=None, omi
         current_location_ip = '0.0.0.0/0'
     sg_public.authorize(ip_protocol='tcp', from_port=80, to_port=80, cidr_ip=current_location_ip)
     sg_private.authorize(ip_protocol='tcp', from_port=80, to_port=80, src_group=sg_public)
+    tagger.close()
     #
     ocb.log('Start your service on backends {0} and {1} on ports {2} then go to {3}'.format(instance_private_1.id, instance_private_2.id, listeners, lb.dns_name),
             level='info',
@@ -96,3 +102,25 @@ def setup_access_log(listeners=[(80, 80, 'TCP')], tag_prefix='', key_name=None,
     log_config.s3_bucket_prefix = S3_BUCKET_PREFIX
     log_config.emit_interval = 5
     ocb.lbu.modify_lb_attribute(lb.name, 'accessLog', log_config)
+
+
+def read_access_log(cursor_path=None, follow=None):
+    """
+    Ingest the access logs written by setup_access_log and log their aggregates
+    :param cursor_path: JSON file keeping the last ingested log between runs
+    :type cursor_path: str
+    :param follow: ingest new logs every follow seconds, once if None
+    :type follow: float
+    :return: aggregates of the last minutes
+    :rtype: dict
+    """
+    ocb = OCBase()
+    ingestor = AccessLogIngestor(S3_BUCKET_NAME, S3_BUCKET_PREFIX, cursor_path, ocb=ocb)
+
+    def show(summary):
+        ocb.log('Access log: {0:.1f} req/s, p95 {1:.3f}s, top backends {2}'.format(
+            summary['requests_per_second'], summary['latency_p95'], summary['top_backends'][:3]),
+                level='info', module_name='simple-access-log')
+
+    ingestor.follow(follow or 0, None if follow else 1, show)
+    return ingestor.stats.summary()
@@ -26,9 +26,9 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
-Create a VPC and connect it with Fabric
+Create a VPC and run a command on its instances over SSH, the private one through the bouncer
 Requirements:
-    pip install Fabric
+    pip install paramiko
 """
 
 __author__      = "Heckle"
@@ -36,28 +36,27 @@ __copyright__   = "BSD"
 
 from osc_cloud_builder.OCBase import OCBase
 from osc_cloud_builder.tools.create_key_pair import create_key_pair
-from vpc import vpc_with_two_subnets, vpc_teardown
-from fabric.api import run, env
+from osc_cloud_builder.tools.ssh_fanout import SSHFanout
+from osc_cloud_builder.sample.vpc import vpc_with_two_subnets, vpc_teardown
 
 
-def connect_to_instance_in_ssh(address, keypair_path, user='root'):
+def connect_to_instance_in_ssh(addresses, keypair_path, user='root', bouncer=None):
     """
-    Run the command LS on a given instance
-    :param address: ip or dns name of a machine
-    :type address: str
+    Run the command LS on given instances
+    :param addresses: ips or dns names of machines
+    :type addresses: list
     :param keypair_path: keypair path
     :type keypair_path: str
+    :param bouncer: ip or dns name of the machine forwarding the connections, direct connections if None
+    :type bouncer: str
+    :return: HostResult by address
+    :rtype: dict
     """
+    def output(host, stream, line):
+        ocb.log('{0} {1}: {2}'.format(host, stream, line), level='INFO')
 
-    env.host_string = address
-    env.user = user
-    env.parallel = False
-    env.key_filename = keypair_path
-    env.disable_known_hosts = True
-    env.connection_attempts = 10
-    env.timeout = 120
-
-    ocb.log(run('ls -la /root'), level='INFO')
+    with SSHFanout(keypair_path, user=user, bouncer=bouncer, connect_timeout=120, output=output, ocb=ocb) as fanout:
+        return fanout.map(addresses, 'ls -la /root')
 
 if __name__ == '__main__':
     ocb = OCBase(debug_level='INFO')
@@ -66,12 +65,12 @@ if __name__ == '__main__':
                                           'architecture': 'x86_64',
                                           'name': ['centos6*', 'centos-7*', 'Centos7*', 'Centos-7*']})[0]
     kp = create_key_pair()
-    vpc, instance_nat, instance_bouncer, instance_private = vpc_with_two_subnets.setup_vpc('ami-2472c655', kp['name'])
+    vpc, instance_bouncer, instance_private = vpc_with_two_subnets.setup_vpc(tag_prefix='test-connect-to-instance',
+                                                                             key_name=kp['name'], omi_id=omi.id)
     ocb.log('vpc {0} created'.format(vpc.id), level='INFO')
-    try:
-        connect_to_instance_in_ssh(instance_bouncer.ip_address, kp['path'], tag_prefix='test-connect-to-instance')
-    except Exception as err:
-        ocb.log('Can not connect to instance {0} with address {1} because {2}'.format(instance_bouncer.id, instance_bouncer.ip_address, err), level='INFO')
+    for result in connect_to_instance_in_ssh([instance_private.private_ip_address], kp['path'],
+                                             bouncer=instance_bouncer.ip_address).values():
+        if result.error:
+            ocb.log('Can not connect to instance {0} with address {1} because {2}'.format(instance_private.id, result.host, result.error), level='INFO')
     if raw_input('Teardown VPC {0} ? [Y/n] '.format(vpc.id)) != 'n':
         vpc_teardown.teardown(vpc.id, terminate_instances=True)
-
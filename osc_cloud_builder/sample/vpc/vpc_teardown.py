@@ -26,184 +26,305 @@
 
 """
 Destroy a VPC and all attached ressources
+
+Deletions are organized as a dependency graph: independent deletions
+(EIP releases, NIC deletions, security group rules revocations...) run
+concurrently and each deletion only waits for its real predecessors.
 """
 
 __author__      = "Heckle"
 __copyright__   = "BSD"
 
 
-import time
+from concurrent.futures import ThreadPoolExecutor
 from boto.ec2.ec2object import EC2Object
 from osc_cloud_builder.OCBase import OCBase, SLEEP_SHORT
-from osc_cloud_builder.tools.wait_for import wait_state
+from osc_cloud_builder.tools.task_graph import TaskGraph
+from osc_cloud_builder.tools.wait_for import wait_state, wait_until
 from boto.exception import EC2ResponseError
 
-def teardown(vpc_to_delete, terminate_instances=False):
+LBU_DELETION_TIMEOUT = 2100
+
+
+def _discover(ocb, vpc_id, max_workers):
     """
-    Clean all ressouces attached to the vpc_to_delete
-    :param vpc_to_delete: vpc id to delete
-    :type vpc_to_delete: str
-    :param terminate_instances: continue teardown even if instances exists in the VPC
-    :type terminate_instances: bool
+    Describe all ressources attached to the VPC, describe calls are done concurrently
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_id: vpc id
+    :type vpc_id: str
+    :return: ressources lists by kind
+    :rtype: dict
     """
-    ocb = OCBase()
-
-    if terminate_instances is False and \
-       ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete, 'instance-state-name': 'running'}) and \
-       ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete, 'instance-state-name': 'stopped'}) :
-        ocb.log('Instances still exist in {0}, teardown will not be executed. Add terminate_instances=True to teardown() method.'.format(vpc_to_delete) ,'error')
-        return
+    def vpc_endpoints():
+        params = {}
+        ocb.fcu.build_filter_params(params, {'vpc-id': vpc_id, 'vpc-endpoint-state': 'available'})
+        return ocb.fcu.get_list('DescribeVpcEndpoints', params, [('item', EC2Object)])
+
+    def nat_gateways():
+        params = {}
+        ocb.fcu.build_filter_params(params, {'vpc-id': vpc_id})
+        with ocb.fcu.api_version(ocb.fcu.NatGatewayAPIVersion):
+            nat_gws = ocb.fcu.get_list('DescribeNatGateways', params, [('item', EC2Object)])
+        return [nat_gw for nat_gw in nat_gws if getattr(nat_gw, 'state', None) != 'deleted']
+
+    def load_balancers():
+        return ocb.lbu.get_all_load_balancers() if ocb.lbu else []
+
+    queries = {
+        'instances': lambda: ocb.fcu.get_only_instances(filters={'vpc-id': vpc_id}),
+        'peerings': lambda: ocb.fcu.get_all_vpc_peering_connections(filters={'requester-vpc-info.vpc-id': vpc_id}),
+        'vpc_endpoints': vpc_endpoints,
+        'nics': lambda: ocb.fcu.get_all_network_interfaces(filters={'vpc-id': vpc_id}),
+        'internet_gateways': lambda: ocb.fcu.get_all_internet_gateways(filters={'attachment.vpc-id': vpc_id}),
+        'nat_gateways': nat_gateways,
+        'route_tables': lambda: ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc_id}),
+        'subnets': lambda: ocb.fcu.get_all_subnets(filters={'vpc-id': vpc_id}),
+        'security_groups': lambda: ocb.fcu.get_all_security_groups(filters={'vpc-id': vpc_id}),
+        'load_balancers': load_balancers,
+    }
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = dict((kind, executor.submit(query)) for kind, query in queries.items())
+        ressources = dict((kind, future.result()) for kind, future in futures.items())
+    finally:
+        executor.shutdown(wait=True)
 
-    ocb.log('Deleting VPC {0}'.format(vpc_to_delete), 'info', __file__)
-    vpc_instances = ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete})
-    ocb.log('Termating VMs {0}'.format(vpc_instances), 'info')
+    ressources['instances'] = [instance for instance in ressources['instances'] if instance.state != 'terminated']
+    ressources['addresses'] = []
+    if ressources['instances']:
+        ressources['addresses'] = ocb.fcu.get_all_addresses(filters={'instance-id': [instance.id for instance in ressources['instances']]})
+    subnets = set([subnet.id for subnet in ressources['subnets']])
+    ressources['load_balancers'] = [lb for lb in ressources['load_balancers'] if set(lb.subnets).intersection(subnets)]
+    return ressources
 
-    # Stop instances
-    if [instance for instance in vpc_instances if instance.state != 'stopped' or instance.state != 'terminated']:
-        try:
-            ocb.fcu.stop_instances([instance.id for instance in vpc_instances])
-        except EC2ResponseError as err:
-            ocb.log('Stop instance error: {0}'.format(err.message), 'warning')
-
-    time.sleep(SLEEP_SHORT)
 
+def _stop_instances(ocb, instances):
+    try:
+        ocb.fcu.stop_instances([instance.id for instance in instances if instance.state != 'stopped'])
+    except EC2ResponseError as err:
+        ocb.log('Stop instance error: {0}'.format(err.message), 'warning')
     # Force stop instances (if ACPI STOP does not work)
-    if [instance for instance in vpc_instances if instance.state != 'stopped' or instance.state != 'terminated']:
+    not_stopped = wait_state(instances, 'stopped', timeout=SLEEP_SHORT)
+    if not_stopped:
         try:
-            ocb.fcu.stop_instances([instance.id for instance in vpc_instances], force=True)
+            ocb.fcu.stop_instances([instance.id for instance in not_stopped], force=True)
         except EC2ResponseError as err:
             ocb.log('Force stop instance error: {0}'.format(err.message), 'warning')
+        wait_state(not_stopped, 'stopped')
+
+
+def _terminate_instances(ocb, instances):
+    try:
+        ocb.fcu.terminate_instances([instance.id for instance in instances])
+    except EC2ResponseError as err:
+        ocb.log('Terminate instance error: {0}'.format(err.message), 'warning')
+    wait_state(instances, 'terminated')
+
 
-    # Wait instance to be stopped
-    wait_state(vpc_instances, 'stopped')
+def _delete_vpc_endpoints(ocb, vpc_endpoints):
+    params = {}
+    ocb.fcu.build_list_params(params, [vpc_endpoint.vpcEndpointId for vpc_endpoint in vpc_endpoints], 'VpcEndpointId')
+    try:
+        ocb.fcu.get_status('DeleteVpcEndpoints', params)
+    except EC2ResponseError as err:
+        ocb.log('Can not delete Vpc Endpoints: {0}'.format(err.message), 'warning')
 
-    # Terminate instances
-    if [instance for instance in vpc_instances if instance.state != 'terminated']:
+
+def _release_address(ocb, address):
+    if address.association_id:
         try:
-            ocb.fcu.terminate_instances([instance.id for instance in vpc_instances])
+            ocb.fcu.disassociate_address(association_id=address.association_id)
         except EC2ResponseError as err:
-            ocb.log('Terminate instance error: {0}'.format(err.message), 'warning')
+            ocb.log('Disassociate EIP error: {0}'.format(err.message), 'warning')
+    try:
+        ocb.fcu.release_address(allocation_id=address.allocation_id)
+    except EC2ResponseError as err:
+        ocb.log('Release EIP error: {0}'.format(err.message), 'warning')
 
-    # Wait instance to be terminated
-    wait_state(vpc_instances, 'terminated')
 
-    # Delete VPC-Peering connections
-    for peer in ocb.fcu.get_all_vpc_peering_connections(filters={'requester-vpc-info.vpc-id': vpc_to_delete}):
-        peer.delete()
+def _delete_internet_gateway(ocb, gw):
+    for attachment in gw.attachments:
+        ocb.fcu.detach_internet_gateway(gw.id, attachment.vpc_id)
+    ocb.fcu.delete_internet_gateway(gw.id)
 
-    # Delete VPC Endpoints - Not able to manage multiple vpce
-    try:
-        vpc_endpoint = ocb.fcu.get_object('DescribeVpcEndpoints', {'Filter.0.Name': 'vpc-id', 'Filter.0.Value': vpc_to_delete,
-                                                                   'Filter.1.Name': 'vpc-endpoint-state', 'Filter.1.Value': 'available'}, EC2Object)
-        ocb.fcu.make_request('DeleteVpcEndpoints', {'VpcEndpointId.0': vpc_endpoint.vpcEndpointId}).read()
-    except Exception as err:
-        ocb.log('Can not delete Vpc Endpoints', 'warning')
 
+def _delete_nat_gateway(ocb, nat_gw):
+    if getattr(nat_gw, 'state', None) == 'deleting':
+        return
+    with ocb.fcu.api_version(ocb.fcu.NatGatewayAPIVersion):
+        ocb.fcu.get_status('DeleteNatGateway', {'NatGatewayId': nat_gw.natGatewayId})
+    ocb.log('Deleting natGateway {0}'.format(nat_gw.natGatewayId), 'info')
 
-    # Release EIPs
-    for instance in vpc_instances:
-        addresses = ocb.fcu.get_all_addresses(filters={'instance-id': instance.id})
-        for address in addresses:
-            try:
-                ocb.fcu.disassociate_address(association_id=address.association_id)
-            except EC2ResponseError as err:
-                ocb.log('Disassociate EIP error: {0}'.format(err.message), 'warning')
-            time.sleep(SLEEP_SHORT)
-            try:
-                ocb.fcu.release_address(allocation_id=address.allocation_id)
-            except EC2ResponseError as err:
-                ocb.log('Release EIP error: {0}'.format(err.message), 'warning')
 
-        time.sleep(SLEEP_SHORT)
+def _wait_nat_gateways(ocb, nat_gws):
+    remaining = wait_state(nat_gws, 'deleted', timeout=LBU_DELETION_TIMEOUT)
+    if remaining:
+        ocb.log('NatGateways {0} are not deleted'.format([nat_gw.natGatewayId for nat_gw in remaining]), 'warning')
+
 
-    # Flush all nic
-    for nic in ocb.fcu.get_all_network_interfaces(filters={'vpc-id': vpc_to_delete}):
-        nic.delete()
+def _delete_routes(ocb, rt):
+    for route in rt.routes:
+        if route.gateway_id != 'local':
+            try:
+                ocb.fcu.delete_route(rt.id, route.destination_cidr_block)
+            except Exception as err:
+                ocb.log('Can not delete route {0} because {1}'.format(route.destination_cidr_block, err), 'warning')
 
 
-    # Delete internet gateways
-    for gw in ocb.fcu.get_all_internet_gateways(filters={'attachment.vpc-id': vpc_to_delete}):
-        for attachment in gw.attachments:
-            ocb.fcu.detach_internet_gateway(gw.id, attachment.vpc_id)
-            time.sleep(SLEEP_SHORT)
-        ocb.fcu.delete_internet_gateway(gw.id)
+def _disassociate_route_table(ocb, rt):
+    for association in rt.associations:
+        if association.subnet_id:
+            ocb.fcu.disassociate_route_table(association.id)
 
-    time.sleep(SLEEP_SHORT)
 
-    try:
-        # Delete nat gateways
-        # get_object is not able to manage a collection, so using subnet-id as differentiating
-        ocb.fcu.APIVersion = '2016-11-15'
-        for msubnet in ocb.fcu.get_all_subnets(filters={'vpc-id': vpc_to_delete}):
-            nat_gateway = ocb.fcu.get_object('DescribeNatGateways', {'Filter.1.Name': 'vpc-id', 'Filter.1.Value.1': vpc_to_delete, 'Filter.2.Name': 'subnet-id', 'Filter.2.Value.1': msubnet.id}, EC2Object)
-            if hasattr(nat_gateway, 'natGatewayId'):
-                ocb.fcu.make_request('DeleteNatGateway', params={'NatGatewayId': nat_gateway.natGatewayId})
-                ocb.log('Deleting natGateway {0}'.format(nat_gateway.natGatewayId), 'info')
-    except Exception as err:
-        ocb.log('Can not delete natgateway because: {0}'.format(err.message), 'warning')
-
-    # Delete routes
-    for rt in ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc_to_delete}):
-        for route in rt.routes:
-            if route.gateway_id != 'local':
-                try:
-                    ocb.fcu.delete_route(rt.id, route.destination_cidr_block)
-                except Exception as err:
-                    ocb.log('Can not delete route {0} because {1}'.format(route.destination_cidr_block, err), 'warning')
-
-
-    # Delete Load Balancers
-    if ocb.lbu:
-        subnets = set([sub.id for sub in ocb.fcu.get_all_subnets(filters={'vpc-id': vpc_to_delete})])
-        for lb in [lb for lb in ocb.lbu.get_all_load_balancers() if set(lb.subnets).intersection(subnets)]:
-            lb.delete()
-            time.sleep(SLEEP_SHORT)
-
-        # Wait for load balancers to disapear
-        for i in range(1, 420):          # 42 ? Because F...
-            lbs = [lb for lb in ocb.lbu.get_all_load_balancers() if set(lb.subnets).intersection(subnets)]
-            if not lbs:
-                break
-            time.sleep(SLEEP_SHORT)
+def _wait_load_balancers(ocb, names):
+    def deleted():
+        lbs = [lb for lb in ocb.lbu.get_all_load_balancers() if lb.name in names]
+        if lbs:
             ocb.log('Waiting for LBU {0} to be removed'.format(lbs), 'info')
+        return not lbs
+    if not wait_until(deleted, timeout=LBU_DELETION_TIMEOUT, max_sleep=SLEEP_SHORT):
+        ocb.log('LBU {0} are not removed'.format(names), 'warning')
 
-    for vpc in ocb.fcu.get_all_vpcs([vpc_to_delete]):
-        # Delete route tables
-        for route_table in ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc.id}):
-            for association in route_table.associations:
-                if association.subnet_id:
-                    ocb.fcu.disassociate_route_table(association.id)
-        for route_table in [route_table for route_table
-                            in ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc.id})
-                            if len([association for association in route_table.associations if association.main]) == 0]:
-            ocb.fcu.delete_route_table(route_table.id)
-
-        # Delete subnets
-        for subnet in ocb.fcu.get_all_subnets(filters={'vpc-id': vpc.id}):
-            ocb.fcu.delete_subnet(subnet.id)
-
-    time.sleep(SLEEP_SHORT)
-
-    # Flush all rules
-    for group in ocb.fcu.get_all_security_groups(filters={'vpc-id': vpc.id}):
-        for rule in group.rules:
-            for grant in rule.grants:
-                ocb.fcu.revoke_security_group(group_id=group.id, ip_protocol=rule.ip_protocol, from_port=rule.from_port, to_port=rule.to_port, src_security_group_group_id=grant.group_id, cidr_ip=grant.cidr_ip)
-            for rule in group.rules_egress:
-                for grant in rule.grants:
-                    ocb.fcu.revoke_security_group_egress(group.id, rule.ip_protocol, rule.from_port, rule.to_port, grant.group_id, grant.cidr_ip)
-
-    # Delete Security Groups
-    for sg in ocb.fcu.get_all_security_groups(filters={'vpc-id': vpc.id}):
-        if 'default' not in sg.name:
-            try:
-                ocb.fcu.delete_security_group(group_id=sg.id)
-            except EC2ResponseError as err:
-                ocb.log('Can not delete Security Group: {0}'.format(err.message), 'warning')
+
+def _revoke_security_group_rules(ocb, group):
+    for rule in group.rules:
+        for grant in rule.grants:
+            ocb.fcu.revoke_security_group(group_id=group.id, ip_protocol=rule.ip_protocol, from_port=rule.from_port, to_port=rule.to_port, src_security_group_group_id=grant.group_id, cidr_ip=grant.cidr_ip)
+    for rule in group.rules_egress:
+        for grant in rule.grants:
+            ocb.fcu.revoke_security_group_egress(group.id, rule.ip_protocol, rule.from_port, rule.to_port, grant.group_id, grant.cidr_ip)
+
+
+def _delete_security_group(ocb, sg):
+    try:
+        ocb.fcu.delete_security_group(group_id=sg.id)
+    except EC2ResponseError as err:
+        ocb.log('Can not delete Security Group: {0}'.format(err.message), 'warning')
 
 
-    # Delete VPC
+def _delete_vpc(ocb, vpc_id):
     try:
-        ocb.fcu.delete_vpc(vpc.id)
+        ocb.fcu.delete_vpc(vpc_id)
     except EC2ResponseError as err:
         ocb.log('Can not delete VPC: {0}'.format(err.message), 'error')
+
+
+def build_teardown_graph(ocb, vpc_to_delete, ressources):
+    """
+    Build the deletion graph of the VPC
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param ressources: ressources attached to the VPC as returned by _discover
+    :type ressources: dict
+    :rtype: osc_cloud_builder.tools.task_graph.TaskGraph
+    """
+    graph = TaskGraph()
+
+    instances = []
+    if ressources['instances']:
+        graph.add('stop_instances', _stop_instances, (ocb, ressources['instances']), cost=30)
+        graph.add('terminate_instances', _terminate_instances, (ocb, ressources['instances']), requires=['stop_instances'], cost=30)
+        instances = ['terminate_instances']
+
+    for peer in ressources['peerings']:
+        graph.add('peering:{0}'.format(peer.id), peer.delete)
+
+    if ressources['vpc_endpoints']:
+        graph.add('vpc_endpoints', _delete_vpc_endpoints, (ocb, ressources['vpc_endpoints']))
+
+    addresses = []
+    for address in ressources['addresses']:
+        addresses.append(graph.add('eip:{0}'.format(address.allocation_id), _release_address, (ocb, address), cost=2).name)
+
+    nics = []
+    for nic in ressources['nics']:
+        # ENIs of NAT gateways and LBUs, and the ones deleted with their instance, go away with their owner
+        if nic.requester_managed:
+            continue
+        if instances and nic.attachment is not None and nic.attachment.delete_on_termination:
+            continue
+        nics.append(graph.add('nic:{0}'.format(nic.id), nic.delete, requires=instances + addresses).name)
+
+    nat_gws = []
+    for nat_gw in ressources['nat_gateways']:
+        nat_gws.append(graph.add('nat:{0}'.format(nat_gw.natGatewayId), _delete_nat_gateway, (ocb, nat_gw)).name)
+    if nat_gws:
+        graph.add('wait_nat_gateways', _wait_nat_gateways, (ocb, ressources['nat_gateways']), requires=nat_gws, cost=30)
+        nat_gws = ['wait_nat_gateways']
+
+    for gw in ressources['internet_gateways']:
+        graph.add('igw:{0}'.format(gw.id), _delete_internet_gateway, (ocb, gw), requires=addresses + nat_gws, cost=2)
+
+    lbus = []
+    for lb in ressources['load_balancers']:
+        lbus.append(graph.add('lbu:{0}'.format(lb.name), lb.delete).name)
+    if lbus:
+        graph.add('wait_load_balancers', _wait_load_balancers, (ocb, [lb.name for lb in ressources['load_balancers']]), requires=lbus, cost=60)
+        lbus = ['wait_load_balancers']
+
+    disassociations = {}
+    for rt in ressources['route_tables']:
+        routes = graph.add('routes:{0}'.format(rt.id), _delete_routes, (ocb, rt)).name
+        disassociation = graph.add('disassociate:{0}'.format(rt.id), _disassociate_route_table, (ocb, rt)).name
+        for association in rt.associations:
+            if association.subnet_id:
+                disassociations.setdefault(association.subnet_id, []).append(disassociation)
+        if not [association for association in rt.associations if association.main]:
+            graph.add('route_table:{0}'.format(rt.id), ocb.fcu.delete_route_table, (rt.id,), requires=[routes, disassociation])
+
+    for subnet in ressources['subnets']:
+        graph.add('subnet:{0}'.format(subnet.id), ocb.fcu.delete_subnet, (subnet.id,),
+                  requires=instances + nics + nat_gws + lbus + disassociations.get(subnet.id, []))
+
+    rules = []
+    for group in ressources['security_groups']:
+        rules.append(graph.add('sg_rules:{0}'.format(group.id), _revoke_security_group_rules, (ocb, group)).name)
+    for group in ressources['security_groups']:
+        if 'default' not in group.name:
+            graph.add('sg:{0}'.format(group.id), _delete_security_group, (ocb, group), requires=instances + nics + lbus + rules)
+
+    graph.add('vpc:{0}'.format(vpc_to_delete), _delete_vpc, (ocb, vpc_to_delete), requires=list(graph.order))
+    return graph
+
+
+def teardown(vpc_to_delete, terminate_instances=False, dry_run=False, max_workers=8):
+    """
+    Clean all ressouces attached to the vpc_to_delete
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param terminate_instances: continue teardown even if instances exists in the VPC
+    :type terminate_instances: bool
+    :param dry_run: only log the deletion plan and its critical path
+    :type dry_run: bool
+    :param max_workers: maximum number of concurrent deletions
+    :type max_workers: int
+    :return: deletion graph
+    :rtype: osc_cloud_builder.tools.task_graph.TaskGraph
+    """
+    ocb = OCBase()
+
+    if terminate_instances is False and \
+       ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete, 'instance-state-name': ['running', 'stopped']}):
+        ocb.log('Instances still exist in {0}, teardown will not be executed. Add terminate_instances=True to teardown() method.'.format(vpc_to_delete) ,'error')
+        return
+
+    ressources = _discover(ocb, vpc_to_delete, max_workers)
+    graph = build_teardown_graph(ocb, vpc_to_delete, ressources)
+
+    if dry_run:
+        ocb.log('Teardown plan of VPC {0}'.format(vpc_to_delete), 'info', __file__)
+        for line in graph.describe():
+            ocb.log(line, 'info', __file__)
+        return graph
+
+    ocb.log('Deleting VPC {0}'.format(vpc_to_delete), 'info', __file__)
+    ocb.log('Termating VMs {0}'.format(ressources['instances']), 'info')
+    for task in graph.run(max_workers):
+        ocb.log('Teardown task {0} {1}: {2}'.format(task.name, task.status, task.error), 'warning')
+    length, path = graph.critical_path(actual=True)
+    ocb.log('Teardown of VPC {0} done, critical path {1:.1f}s: {2}'.format(vpc_to_delete, length, ' -> '.join(path)), 'info', __file__)
+    return graph
@@ -26,13 +26,16 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
-Create a VPC with 2 subnets and a nat instance
+Create a VPC with 2 subnets and a nat gateway
     - First subnet is public
         - Instance to Bounce
-        - Instance to nat (blackbox)
    - Second subnet is private
         - Instance for fun
 
+The stack is described by a declarative spec (see stack_spec) compiled into a
+dependency graph: ressources which do not depend on each other (security groups,
+internet gateway, nat EIP...) are created at the same time.
+
 Simply use setup_vpc() function in your scripts
 """
 
@@ -40,197 +43,291 @@ __author__      = "Heckle"
 __copyright__   = "BSD"
 
 
-import time
 import urllib2
 import json
 from boto.ec2.ec2object import EC2Object
-from osc_cloud_builder.OCBase import OCBase, SLEEP_SHORT
+from osc_cloud_builder.OCBase import OCBase, OCBError
+from osc_cloud_builder.tools import quota_planner
+from osc_cloud_builder.tools.tagging import Tagger
+from osc_cloud_builder.tools.task_graph import TaskGraph
 from osc_cloud_builder.tools.wait_for import wait_state
 
 
-def _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_prefix):
+def stack_spec(vpc_cidr='10.0.0.0/16', subnet_public_cidr='10.0.1.0/24', subnet_private_cidr='10.0.2.0/24', tag_prefix='', key_name=None, omi_id=None, instance_type='c4.large'):
     """
-    Create all networks
-    :param ocb: connection object
-    :type ocb: OCBase.OCBase
+    Spec of a VPC with a public and a private subnet, a bouncer in the public subnet and an instance in the private one.
+    Security group rules are tuples (protocol, from_port, to_port, source) where source is
+    a cidr, 'current_location' for the public IP of the caller or 'sg:<name>' for a security group of the stack.
+    Instances are only created when both key_name and omi_id are given.
     :param vpc_cidr: vpc cidr
     :type vpc_cidr: str
-    :param subnet_public_cidr: subnet_public_cidr cidr
+    :param subnet_public_cidr: public subnet cidr
     :type subnet_public_cidr: str
-    :param subnet_private_cidr: subnet_private_cidr cidr
+    :param subnet_private_cidr: private subnet cidr
     :type subnet_private_cidr: str
     :param tag_prefix: prefix to be applied on all tags
     :type tag_prefix: str
-    :returns: Networks objects
-    :rtype: boto.vpc.vpc.VPC, boto.vpc.vpc.SUBNET, boto.vpc.vpc.SUBNET
-    """
-    vpc = ocb.fcu.create_vpc(vpc_cidr)
-    ocb.log('VPC {0} created'.format(vpc.id), level='info')
-    time.sleep(SLEEP_SHORT)
-    subnet_public = ocb.fcu.create_subnet(vpc.id, subnet_public_cidr)
-    ocb.log('Subnet Public {0} created'.format(subnet_public.id), level='info')
-    subnet_private = ocb.fcu.create_subnet(vpc.id, subnet_private_cidr)
-    ocb.log('Subnet Private {0} created'.format(subnet_private.id), level='info')
-    #
-    ocb.fcu.create_tags([vpc.id], {'Name': '{0}'.format(tag_prefix)})
-    ocb.fcu.create_tags([subnet_public.id], {'Name': '{0}-public'.format(tag_prefix)})
-    ocb.fcu.create_tags([subnet_private.id], {'Name': '{0}-private'.format(tag_prefix)})
-    return vpc, subnet_public, subnet_private
-
-def _create_gateway(ocb, vpc):
-    """
-    Create Internet Gateway.
-    Create Route Table for Internet Access
-    Configure Main Route Table to redirect flows to NAT INSTANCE
-    :param ocb: connection object
-    :type ocb: OCBase.OCBase
-    :param vpc: vpc
-    :type vpc: boto.vpc.vpc.VPC
-    :returns: Internet Gateway
-    :rtype: boto.vpc.internetgateway.InternetGateway
+    :param key_name: key pair name
+    :type key_name: str
+    :param omi_id: OMI identified
+    :type omi_id: str
+    :param instance_type: instance type
+    :type instance_type: str
+    :return: stack spec
+    :rtype: dict
     """
-    gw = ocb.fcu.create_internet_gateway()
-    time.sleep(SLEEP_SHORT)
-    ocb.fcu.attach_internet_gateway(gw.id, vpc.id)
-    time.sleep(SLEEP_SHORT)
-    gw = ocb.fcu.get_all_internet_gateways(gw.id)[0]
-    ocb.log('Internet Gateway {0} created'.format(gw.id), level='info')
-    return gw
+    spec = {
+        'tag_prefix': tag_prefix,
+        'vpc_cidr': vpc_cidr,
+        'subnets': [
+            {'name': 'public', 'cidr': subnet_public_cidr, 'public': True},
+            {'name': 'private', 'cidr': subnet_private_cidr, 'public': False},
+        ],
+        'security_groups': [
+            {'name': 'public', 'description': 'public security group',
+             'rules': [('tcp', 22, 22, 'current_location'),
+                       ('tcp', 0, 65535, 'sg:private'),
+                       ('udp', 0, 65535, 'sg:private'),
+                       ('icmp', -1, -1, 'sg:private')]},
+            {'name': 'private', 'description': 'private security group',
+             'rules': [('tcp', 22, 22, 'sg:public')]},
+        ],
+        'instances': [],
+    }
+    if key_name and omi_id:
+        spec['instances'] = [
+            {'name': 'bouncer', 'subnet': 'public', 'security_group': 'public', 'public_ip': True,
+             'omi_id': omi_id, 'key_name': key_name, 'instance_type': instance_type},
+            {'name': 'instance-1', 'subnet': 'private', 'security_group': 'private', 'public_ip': False,
+             'omi_id': omi_id, 'key_name': key_name, 'instance_type': instance_type},
+        ]
+    return spec
+
 
-def _create_security_groups(ocb, vpc, tag_prefix):
+def stack_quotas(spec):
     """
-    Create Public and Private Security Group
-    Public security group will allow inbound:
-            - SSH from current location
-            - ALL protcols on all ports from sg_private
-    Private security group will allow inbound:
-            - SSH from sg_public
-    :param ocb: connection object
-    :type ocb: OCBase.OCBase
-    :param vpc: vpc
-    :type vpc: boto.vpc.vpc.VPC
-    :param tag_prefix: prefix to be applied on all tags
-    :type tag_prefix: str
-    :returns: Public and Private Security group
-    :rtype: boto.ec2.securitygroup.SecurityGroup
+    :param spec: stack spec, see stack_spec
+    :type spec: dict
+    :return: quota name -> number of ressources the stack creates
+    :rtype: dict
     """
+    public_subnets = [subnet for subnet in spec['subnets'] if subnet['public']]
+    return {
+        quota_planner.VPCS: 1,
+        quota_planner.SUBNETS: len(spec['subnets']),
+        quota_planner.SECURITY_GROUPS: len(spec['security_groups']),
+        quota_planner.INTERNET_GATEWAYS: 1,
+        quota_planner.NAT_GATEWAYS: 1 if public_subnets else 0,
+        quota_planner.ADDRESSES: (1 if public_subnets else 0) + len([instance for instance in spec['instances'] if instance['public_ip']]),
+        quota_planner.INSTANCES: len(spec['instances']),
+    }
+
+
+def _current_location():
     try:
         current_location_ip = urllib2.urlopen('https://ifconfig.io/all.json').read()
-        current_location_ip = '{0}/32'.format(json.loads(current_location_ip)['ip'])
+        return '{0}/32'.format(json.loads(current_location_ip)['ip'])
     except:
-        current_location_ip = '0.0.0.0/0'
-    ocb.log('Public Security Group allows SSH from {0}'.format(current_location_ip), level='info')
-    #
-    sg_public = ocb.fcu.create_security_group('{0}-public'.format(tag_prefix), 'public security group', vpc_id=vpc.id)
-    sg_private = ocb.fcu.create_security_group('{0}-private'.format(tag_prefix), 'private security group', vpc_id=vpc.id)
-    #
-    sg_public.authorize('tcp', 22, 22, current_location_ip)
-    sg_public.authorize('tcp', 0, 65535, src_group=sg_private)
-    sg_public.authorize('udp', 0, 65535, src_group=sg_private)
-    sg_public.authorize('icmp', -1, -1, src_group=sg_private)
-    # TODO Etre plus logique dans les flux et le documenter
-    sg_private.authorize('tcp', 22, 22, src_group=sg_public)
-    return sg_public, sg_private
-
-def _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_private, key_name, instance_type, tag_prefix):
-    """
-    Create BOUNCER instance in public subnet
-    Create 1 instance in the private subnet
-    :param ocb: connection object
-    :type ocb: OCBase.OCBase
-    :param subnet_public: subnet public
-    :type vpc: boto.vpc.vpc.SUBNET
-    :param subnet_public: subnet public
-    :type subnet_public: boto.vpc.vpc.SUBNET
-    :param subnet_private: subnet private
-    :type subnet_private: boto.vpc.vpc.SUBNET
-    :param sg_public: public security group
-    :type sg_public: boto.ec2.securitygroup.SecurityGroup
-    :param sg_private: private security group
-    :type sg_private: boto.ec2.securitygroup.SecurityGroup
-    :param tag_prefix: prefix to be applied on all tags
-    :type tag_prefix: str
-    :returns: 2 instances
-    :rtype: boto.ec2.instance
-    """
-    #
-    instance_bouncer = ocb.fcu.run_instances(image_id=omi_id,
-                                             min_count=1, max_count=1,
-                                             subnet_id=subnet_public.id,
-                                             security_group_ids=[sg_public.id],
-                                             instance_type=instance_type,
-                                             key_name=key_name).instances[0]
-    ocb.fcu.create_tags([instance_bouncer.id], {'Name': '{0}-bouncer'.format(tag_prefix)})
-    #
-    instance_private = ocb.fcu.run_instances(image_id=omi_id,
-                                             min_count=1, max_count=1,
-                                             subnet_id=subnet_private.id,
-                                             security_group_ids=[sg_private.id],
-                                             instance_type=instance_type,
-                                             key_name=key_name).instances[0]
-    ocb.fcu.create_tags([instance_private.id], {'Name': '{0}-instance-1'.format(tag_prefix)})
-    wait_state([instance_bouncer, instance_private], 'running')
-    return instance_bouncer, instance_private
-
-def _create_natgateway(ocb, subnet_public):
-    """
-    Create a natgateway, lease an EIP.
-    :param ocb: connection object
-    :type ocb: OCBase.OCBase
-    :param subnet_public: subnet public
-    :type subnet_public: boto.vpc.vpc.SUBNET
-    :returns: nat gateway identifier
-    :rtype: str
-    """
-    ocb.fcu.APIVersion = '2016-11-15'
-    eip = ocb.fcu.allocate_address(domain='vpc')
-    nat_gw = ocb.fcu.get_object('CreateNatGateway', {'AllocationId': eip.allocation_id, 'SubnetId': subnet_public.id}, EC2Object)
+        return '0.0.0.0/0'
+
+
+def _create_vpc(ocb, tagger, cidr, tag_prefix):
+    vpc = ocb.fcu.create_vpc(cidr)
+    ocb.log('VPC {0} created'.format(vpc.id), level='info')
+    wait_state([vpc], 'available')
+    tagger.tag([vpc.id], {'Name': '{0}'.format(tag_prefix)})
+    return vpc
+
+
+def _create_subnet(ocb, tagger, graph, subnet, tag_prefix):
+    vpc = graph.result('vpc')
+    sub = ocb.fcu.create_subnet(vpc.id, subnet['cidr'])
+    ocb.log('Subnet {0} {1} created'.format(subnet['name'], sub.id), level='info')
+    tagger.tag([sub.id], {'Name': '{0}-{1}'.format(tag_prefix, subnet['name'])})
+    return sub
+
+
+def _attach_internet_gateway(ocb, graph):
+    gw = graph.result('internet_gateway')
+    ocb.fcu.attach_internet_gateway(gw.id, graph.result('vpc').id)
+    ocb.log('Internet Gateway {0} created'.format(gw.id), level='info')
+    return ocb.fcu.get_all_internet_gateways(gw.id)[0]
+
+
+def _create_nat_gateway(ocb, graph, subnet_name):
+    eip = graph.result('nat_eip')
+    subnet = graph.result('subnet:{0}'.format(subnet_name))
+    with ocb.fcu.api_version(ocb.fcu.NatGatewayAPIVersion):
+        nat_gw = ocb.fcu.get_object('CreateNatGateway', {'AllocationId': eip.allocation_id, 'SubnetId': subnet.id}, EC2Object)
     ocb.log('Creating NatGateway {0}'.format(nat_gw.natGatewayId), level='info')
-    return nat_gw.natGatewayId
+    return nat_gw
 
-def _configure_network_flows(ocb, vpc, subnet_public, subnet_private, gw, tag_prefix):
-    """
-    Setup MAIN ROUTE TABLE to route flows to nat_instance
-    Create RouteTable for subnet_public to route flows to internet gateway
-    :param ocb: connection object
-    :type ocb: OCBase.OCBase
-    :param subnet_public: subnet public
-    :type vpc: boto.vpc.vpc.SUBNET
-    :param subnet_public: subnet public
-    :type subnet_public: boto.vpc.vpc.SUBNET
-    :param subnet_private: subnet private
-    :type subnet_private: boto.vpc.vpc.SUBNET
-    :param gw: Internet Gateway
-    :type gw: boto.vpc.internetgateway.InternetGateway
-    :param tag_prefix: prefix to be applied on all tags
-    :type tag_prefix: str
-    """
-    main_rt = ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc.id, 'association.main': 'true'})[0]
-    ocb.fcu.create_tags([main_rt.id], {'Name': 'local-'.format(tag_prefix)})
-    #
-    rt = ocb.fcu.create_route_table(vpc.id)
-    ocb.fcu.create_tags([rt.id], {'Name': 'public-'.format(tag_prefix)})
-    time.sleep(SLEEP_SHORT)
+
+def _create_nat_route(ocb, graph):
+    with ocb.fcu.api_version(ocb.fcu.NatGatewayAPIVersion):
+        ocb.fcu.create_route(graph.result('main_route_table').id, '0.0.0.0/0', graph.result('nat_gateway').natGatewayId)
+
+
+def _create_security_group(ocb, graph, group, tag_prefix):
+    return ocb.fcu.create_security_group('{0}-{1}'.format(tag_prefix, group['name']), group['description'], vpc_id=graph.result('vpc').id)
+
+
+def _authorize_security_group(ocb, graph, group):
+    sg = graph.result('sg:{0}'.format(group['name']))
+    for protocol, from_port, to_port, source in group['rules']:
+        if source == 'current_location':
+            ocb.log('Security Group {0} allows {1} {2}-{3} from {4}'.format(sg.id, protocol, from_port, to_port, graph.result('current_location')), level='info')
+            sg.authorize(protocol, from_port, to_port, graph.result('current_location'))
+        elif source.startswith('sg:'):
+            sg.authorize(protocol, from_port, to_port, src_group=graph.result(source))
+        else:
+            sg.authorize(protocol, from_port, to_port, source)
+
+
+def _main_route_table(ocb, tagger, graph, tag_prefix):
+    main_rt = ocb.fcu.get_all_route_tables(filters={'vpc-id': graph.result('vpc').id, 'association.main': 'true'})[0]
+    tagger.tag([main_rt.id], {'Name': 'local-{0}'.format(tag_prefix)})
+    return main_rt
+
+
+def _create_route_table(ocb, tagger, graph, tag_prefix):
+    rt = ocb.fcu.create_route_table(graph.result('vpc').id)
+    tagger.tag([rt.id], {'Name': 'public-{0}'.format(tag_prefix)})
     ocb.log('Creating Route Table {0}'.format(rt.id), level='info')
-    ocb.fcu.associate_route_table(rt.id, subnet_public.id)
-    time.sleep(SLEEP_SHORT)
-    ocb.fcu.create_route(rt.id, '0.0.0.0/0', gateway_id=gw.id)
-    natgw_id = _create_natgateway(ocb, subnet_public)
-    ocb.fcu.create_route(main_rt.id, '0.0.0.0/0', natgw_id)
+    return rt
+
+
+def _run_instance(ocb, tagger, graph, instance, tag_prefix):
+    reservation = ocb.fcu.run_instances(image_id=instance['omi_id'],
+                                        min_count=1, max_count=1,
+                                        subnet_id=graph.result('subnet:{0}'.format(instance['subnet'])).id,
+                                        security_group_ids=[graph.result('sg:{0}'.format(instance['security_group'])).id],
+                                        instance_type=instance['instance_type'],
+                                        key_name=instance['key_name'])
+    vm = reservation.instances[0]
+    tagger.tag([vm.id], {'Name': '{0}-{1}'.format(tag_prefix, instance['name'])})
+    return vm
 
-def _setup_public_ips(ocb, instance_bouncer):
+
+def _associate_public_ip(ocb, tagger, graph, instance_name):
+    vm = graph.result('instance:{0}'.format(instance_name))
+    public_ip = graph.result('eip:{0}'.format(instance_name))
+    ocb.fcu.associate_address(instance_id=vm.id, allocation_id=public_ip.allocation_id)
+    tagger.tag([vm.id], {'osc.fcu.eip.auto-attach': public_ip.public_ip})
+    ocb.log('Instance {0} has got IP {1}'.format(vm.id, public_ip.public_ip), level='info')
+
+
+def build_stack_graph(ocb, spec, tagger):
     """
-    Create and attach 2 publics IPs to nat and bouncer instances
+    Compile a stack spec into a dependency graph
     :param ocb: connection object
     :type ocb: OCBase.OCBase
-    :param instance_bouncer: Bouncer Instance
-    :type instance_bouncer: boto.ec2.instance
+    :param spec: stack spec, see stack_spec
+    :type spec: dict
+    :param tagger: tagger of the created ressources, tags are set when it is flushed
+    :type tagger: osc_cloud_builder.tools.tagging.Tagger
+    :rtype: osc_cloud_builder.tools.task_graph.TaskGraph
+    """
+    tag_prefix = spec['tag_prefix']
+    graph = TaskGraph()
+    graph.add('vpc', _create_vpc, (ocb, tagger, spec['vpc_cidr'], tag_prefix), cost=5)
+    for subnet in spec['subnets']:
+        graph.add('subnet:{0}'.format(subnet['name']), _create_subnet, (ocb, tagger, graph, subnet, tag_prefix), requires=['vpc'])
 
+    # Network flows
+    graph.add('internet_gateway', ocb.fcu.create_internet_gateway)
+    graph.add('attach_internet_gateway', _attach_internet_gateway, (ocb, graph), requires=['vpc', 'internet_gateway'])
+    graph.add('main_route_table', _main_route_table, (ocb, tagger, graph, tag_prefix), requires=['vpc'])
+    graph.add('route_table', _create_route_table, (ocb, tagger, graph, tag_prefix), requires=['vpc'])
+    graph.add('route:internet', lambda: ocb.fcu.create_route(graph.result('route_table').id, '0.0.0.0/0',
+                                                              gateway_id=graph.result('attach_internet_gateway').id),
+              requires=['route_table', 'attach_internet_gateway'])
+    public_subnets = [subnet['name'] for subnet in spec['subnets'] if subnet['public']]
+    for name in public_subnets:
+        graph.add('associate:{0}'.format(name),
+                  lambda name=name: ocb.fcu.associate_route_table(graph.result('route_table').id, graph.result('subnet:{0}'.format(name)).id),
+                  requires=['route_table', 'subnet:{0}'.format(name)])
+    if public_subnets:
+        graph.add('nat_eip', ocb.fcu.allocate_address, kwargs={'domain': 'vpc'})
+        # a NAT gateway needs the internet gateway and the route of its subnet
+        graph.add('nat_gateway', _create_nat_gateway, (ocb, graph, public_subnets[0]),
+                  requires=['nat_eip', 'subnet:{0}'.format(public_subnets[0]), 'attach_internet_gateway',
+                            'associate:{0}'.format(public_subnets[0])])
+        graph.add('route:nat', _create_nat_route, (ocb, graph), requires=['main_route_table', 'nat_gateway'])
+
+    # Security groups
+    if [rule for group in spec['security_groups'] for rule in group['rules'] if rule[3] == 'current_location']:
+        graph.add('current_location', _current_location)
+    for group in spec['security_groups']:
+        graph.add('sg:{0}'.format(group['name']), _create_security_group, (ocb, graph, group, tag_prefix), requires=['vpc'])
+    for group in spec['security_groups']:
+        sources = set([rule[3] for rule in group['rules'] if rule[3] == 'current_location' or rule[3].startswith('sg:')])
+        graph.add('sg_rules:{0}'.format(group['name']), _authorize_security_group, (ocb, graph, group),
+                  requires=['sg:{0}'.format(group['name'])] + sorted(sources))
+
+    # Instances
+    for instance in spec['instances']:
+        graph.add('instance:{0}'.format(instance['name']), _run_instance, (ocb, tagger, graph, instance, tag_prefix),
+                  requires=['subnet:{0}'.format(instance['subnet']), 'sg:{0}'.format(instance['security_group'])], cost=5)
+    if spec['instances']:
+        graph.add('wait_instances', lambda: wait_state([graph.result('instance:{0}'.format(instance['name'])) for instance in spec['instances']], 'running'),
+                  requires=['instance:{0}'.format(instance['name']) for instance in spec['instances']], cost=60)
+    for instance in spec['instances']:
+        if instance['public_ip']:
+            graph.add('eip:{0}'.format(instance['name']), ocb.fcu.allocate_address, ('vpc',))
+            graph.add('public_ip:{0}'.format(instance['name']), _associate_public_ip, (ocb, tagger, graph, instance['name']),
+                      requires=['eip:{0}'.format(instance['name']), 'wait_instances', 'attach_internet_gateway'])
+    return graph
+
+
+def deploy_stack(spec, max_workers=8, planner=None):
+    """
+    Create all ressources of a stack spec, independent ressources are created concurrently.
+    With a planner, the quotas are checked and reserved before the first creation.
+    :param spec: stack spec, see stack_spec
+    :type spec: dict
+    :param max_workers: maximum number of concurrent creations
+    :type max_workers: int
+    :param planner: quotas of the account, shared by the stacks deployed at the same time, no quota check if None
+    :type planner: osc_cloud_builder.tools.quota_planner.QuotaPlanner
+    :return: stack graph, results of the tasks are the created ressources
+    :rtype: osc_cloud_builder.tools.task_graph.TaskGraph
+    :raises OCBError: when the stack exceeds a quota or a ressource can not be created
     """
-    public_ip = ocb.fcu.allocate_address("vpc")
-    ocb.fcu.associate_address(instance_id=instance_bouncer.id, allocation_id=public_ip.allocation_id)
-    ocb.fcu.create_tags([instance_bouncer.id], {'osc.fcu.eip.auto-attach': public_ip.public_ip})
-    ocb.log('Boucner Instance {0} has got IP {1}'.format(instance_bouncer.id, public_ip.public_ip), level='info')
+    ocb = OCBase()
+    reservation = planner.reserve(stack_quotas(spec)) if planner is not None else None
+    graph = None
+    tagger = Tagger(ocb)
+    try:
+        graph = build_stack_graph(ocb, spec, tagger)
+        failed = graph.run(max_workers)
+    finally:
+        # tagging failures are reported with the failed steps, not instead of them
+        try:
+            tagger.close()
+            tagging_error = None
+        except OCBError as err:
+            tagging_error = err
+        if reservation is not None:
+            # capacity of a stack which failed before its first creation is given back
+            reservation.release(consumed=graph is not None and
+                                bool([task for task in graph.tasks.values() if task.status not in ('pending', 'skipped')]))
+    for name, duration in graph.timings():
+        ocb.log('Stack step {0} took {1:.2f}s'.format(name, duration), level='info')
+    length, path = graph.critical_path(actual=True)
+    ocb.log('Stack critical path {0:.2f}s: {1}'.format(length, ' -> '.join(path)), level='info')
+    errors = []
+    if failed:
+        for task in failed:
+            ocb.log('Stack step {0} {1}: {2}'.format(task.name, task.status, task.error), level='error')
+        errors.append('Stack creation failed on {0}'.format(', '.join([task.name for task in failed])))
+    if tagging_error is not None:
+        ocb.log('Stack {0}'.format(tagging_error), level='error')
+        errors.append(str(tagging_error))
+    if errors:
+        raise OCBError('; '.join(errors))
+    return graph
+
 
 def setup_vpc(vpc_cidr='10.0.0.0/16', subnet_public_cidr='10.0.1.0/24', subnet_private_cidr='10.0.2.0/24', tag_prefix='', key_name=None, omi_id=None, instance_type='c4.large'):
     """
@@ -253,15 +350,13 @@ def setup_vpc(vpc_cidr='10.0.0.0/16', subnet_public_cidr='10.0.1.0/24', subnet_p
     :param tag_prefix: prefix to be applied on all tags
     :type tag_prefix: str
     """
-    ocb = OCBase()
-    vpc, subnet_public, subnet_private = _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_prefix)
-    gw = _create_gateway(ocb, vpc)
-    sg_public, sg_private = _create_security_groups(ocb, vpc, tag_prefix) #TODO FAut les rendres pour only network
-    _configure_network_flows(ocb, vpc, subnet_public, subnet_private, gw, tag_prefix)
-    if not key_name or not omi_id:
-        return vpc, subnet_public, subnet_private                       #TODO Fera l'objet d'une deuxieme fonction
-    instance_bouncer, instance_private = _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_private, key_name, instance_type, tag_prefix)
-    _setup_public_ips(ocb, instance_bouncer)
+    spec = stack_spec(vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_prefix, key_name, omi_id, instance_type)
+    graph = deploy_stack(spec)
+    vpc = graph.result('vpc')
+    if not spec['instances']:
+        return vpc, graph.result('subnet:public'), graph.result('subnet:private')
+    instance_bouncer = graph.result('instance:bouncer')
+    instance_private = graph.result('instance:instance-1')
     instance_bouncer.update()
     instance_private.update()
     return vpc, instance_bouncer, instance_private
@@ -0,0 +1,441 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Incremental ingestion of LBU access logs written to OSU.
+
+New log objects are listed after a cursor saved in a JSON file, downloaded in parallel
+by batches and parsed into columns. LBU nodes deliver the files of an interval at
+different times, so a late file can sort before files already ingested: keys ingested
+during the last lookback seconds are listed again and skipped, the cursor only moves
+past them once they are older. Aggregates are
+rolling: requests per second, latency percentiles and top backends of the last
+minutes. Memory does not grow with the number of log files: one batch of files is
+held at once, latencies go to fixed histograms and backends to a bounded counter.
+
+    ingestor = AccessLogIngestor('sample', 'simple-access-log', cursor_path='/var/lib/ocb/access-log.json')
+    ingestor.follow(interval=300)
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import re
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import bisect
+import calendar
+import argparse
+import tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+# timestamp elb client:port backend:port request_time backend_time response_time elb_status backend_status received sent "request"...
+LINE = re.compile(r'^(\S+) \S+ \S+ (\S+) (\S+) (\S+) (\S+) (\S+) \S+ (\d+) (\d+)', re.M)
+
+# upper bounds of the latency histogram buckets, from 0.1ms to about 2 minutes
+LATENCY_BOUNDS = tuple(0.0001 * 1.15 ** index for index in range(101))
+
+CURSOR_VERSION = 1
+
+# keys ingested during the lookback kept in the cursor at most, older ones are dropped first
+MAX_RECENT = 10000
+
+
+class Columns(object):
+    """
+    Parsed access log lines, one array per field
+    """
+
+    def __init__(self):
+        self.timestamps = array('d')
+        self.latencies = array('d')
+        self.statuses = array('H')
+        self.received = array('d')
+        self.sent = array('d')
+        self.backends = []
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+def parse(content, columns=None):
+    """
+    Parse access log lines with one regular expression pass over the whole content
+    :param content: access log file content
+    :type content: str
+    :param columns: columns the lines are appended to, new columns if None
+    :type columns: Columns
+    :return: columns
+    :rtype: Columns
+    """
+    columns = columns or Columns()
+    matches = LINE.findall(content)
+    columns.skipped += content.count('\n') + (0 if content.endswith('\n') or not content else 1) - len(matches)
+    if not matches:
+        return columns
+    stamps, backends, request_times, backend_times, response_times, statuses, received, sent = zip(*matches)
+    seconds = {}
+
+    def epoch(stamp):
+        second = seconds.get(stamp[:19])
+        if second is None:
+            second = seconds[stamp[:19]] = calendar.timegm(time.strptime(stamp[:19], '%Y-%m-%dT%H:%M:%S'))
+        return second + float(stamp[19:-1]) if len(stamp) > 20 else second
+
+    columns.timestamps.extend(map(epoch, stamps))
+    # -1 times are requests the LBU could not send to a backend
+    columns.latencies.extend([request + backend + response if backend >= 0 else -1.0 for request, backend, response
+                              in zip(map(float, request_times), map(float, backend_times), map(float, response_times))])
+    columns.statuses.extend([int(status) if status.isdigit() else 0 for status in statuses])
+    columns.received.extend(map(float, received))
+    columns.sent.extend(map(float, sent))
+    columns.backends.extend([backend.rpartition(':')[0] or backend for backend in backends])
+    return columns
+
+
+class TopCounter(object):
+    """
+    Space-saving counter: keeps at most capacity keys, counts of the top keys are exact
+    when there are fewer than capacity keys, over-estimated by at most the smallest count otherwise
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, key, count=1):
+        if key in self.counts or len(self.counts) < self.capacity:
+            self.counts[key] = self.counts.get(key, 0) + count
+            return
+        smallest = min(self.counts, key=self.counts.get)
+        self.counts[key] = self.counts.pop(smallest) + count
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.add(key, count)
+
+    def top(self, count=10):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+class _Slot(object):
+    __slots__ = ('requests', 'errors', 'sent', 'latencies', 'backends')
+
+    def __init__(self, capacity):
+        self.requests = 0
+        self.errors = 0
+        self.sent = 0.0
+        self.latencies = array('L', [0] * (len(LATENCY_BOUNDS) + 1))
+        self.backends = TopCounter(capacity)
+
+
+class RollingStats(object):
+    """
+    Aggregates of the last window_slots slots of slot_seconds, by log timestamp
+    """
+
+    def __init__(self, slot_seconds=60, window_slots=15, backend_capacity=100):
+        """
+        :param slot_seconds: duration of a slot
+        :type slot_seconds: int
+        :param window_slots: slots kept, older slots are dropped
+        :type window_slots: int
+        :param backend_capacity: backends counted per slot
+        :type backend_capacity: int
+        """
+        self.slot_seconds = slot_seconds
+        self.window_slots = window_slots
+        self.backend_capacity = backend_capacity
+        self.slots = {}
+        self.total_requests = 0
+
+    def __repr__(self):
+        return 'RollingStats:{0}'.format(self.total_requests)
+
+    def add(self, columns):
+        """
+        :param columns: parsed lines
+        :type columns: Columns
+        """
+        slot_seconds = self.slot_seconds
+        newest = max(self.slots) if self.slots else None
+        for index in range(len(columns)):
+            start = int(columns.timestamps[index]) // slot_seconds * slot_seconds
+            if newest is not None and start <= newest - self.window_slots * slot_seconds:
+                continue
+            slot = self.slots.get(start)
+            if slot is None:
+                slot = self.slots[start] = _Slot(self.backend_capacity)
+                newest = max(newest, start) if newest is not None else start
+            slot.requests += 1
+            slot.sent += columns.sent[index]
+            if columns.statuses[index] >= 500 or columns.latencies[index] < 0:
+                slot.errors += 1
+            if columns.latencies[index] >= 0:
+                slot.latencies[bisect.bisect_left(LATENCY_BOUNDS, columns.latencies[index])] += 1
+            slot.backends.add(columns.backends[index])
+        self.total_requests += len(columns)
+        if newest is not None:
+            for start in [start for start in self.slots if start <= newest - self.window_slots * slot_seconds]:
+                del self.slots[start]
+
+    def requests_per_second(self):
+        """
+        :return: mean rate over the slots of the window
+        :rtype: float
+        """
+        if not self.slots:
+            return 0.0
+        return sum(slot.requests for slot in self.slots.values()) / float(len(self.slots) * self.slot_seconds)
+
+    def latency_percentile(self, ratio):
+        """
+        :param ratio: between 0 and 1
+        :type ratio: float
+        :return: upper bound of the histogram bucket holding the percentile, in seconds
+        :rtype: float
+        """
+        counts = [sum(slot.latencies[index] for slot in self.slots.values()) for index in range(len(LATENCY_BOUNDS) + 1)]
+        rank = int(math.ceil(ratio * sum(counts)))
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BOUNDS[min(index, len(LATENCY_BOUNDS) - 1)]
+        return 0.0
+
+    def top_backends(self, count=10):
+        """
+        :return: (backend IP, requests) of the busiest backends of the window
+        :rtype: list
+        """
+        backends = TopCounter(self.backend_capacity)
+        for slot in self.slots.values():
+            backends.merge(slot.backends)
+        return backends.top(count)
+
+    def summary(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'requests': sum(slot.requests for slot in self.slots.values()),
+            'errors': sum(slot.errors for slot in self.slots.values()),
+            'sent_bytes': sum(slot.sent for slot in self.slots.values()),
+            'requests_per_second': self.requests_per_second(),
+            'latency_p50': self.latency_percentile(0.5),
+            'latency_p95': self.latency_percentile(0.95),
+            'latency_p99': self.latency_percentile(0.99),
+            'top_backends': self.top_backends(),
+        }
+
+
+class AccessLogIngestor(object):
+    """
+    Ingest the new access log objects of a bucket prefix into RollingStats
+    """
+
+    def __init__(self, bucket_name, prefix='', cursor_path=None, ocb=None, max_workers=8, batch_size=32, stats=None,
+                 lookback=3600):
+        """
+        :param bucket_name: bucket of the access logs
+        :type bucket_name: str
+        :param prefix: s3_bucket_prefix of the LBU access log attribute
+        :type prefix: str
+        :param cursor_path: JSON file keeping the last ingested key between runs
+        :type cursor_path: str
+        :param ocb: connections, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :param max_workers: objects downloaded at once
+        :type max_workers: int
+        :param batch_size: objects held in memory at once
+        :type batch_size: int
+        :param stats: aggregates, new RollingStats if None
+        :type stats: RollingStats
+        :param lookback: seconds during which ingested keys are listed again, longer than the delivery delay of late files
+        :type lookback: float
+        """
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.cursor_path = cursor_path
+        self.ocb = ocb or OCBase()
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.stats = stats or RollingStats()
+        self.lookback = lookback
+        # marker: keys up to the marker are ingested, recent: keys after the marker ingested -> time of ingestion
+        self.cursor = {'marker': '', 'recent': {}, 'files': 0, 'lines': 0, 'skipped': 0}
+        if cursor_path and os.path.exists(cursor_path):
+            with open(cursor_path) as cursor_file:
+                saved = json.load(cursor_file)
+            if saved.get('version') == CURSOR_VERSION and saved.get('bucket') == bucket_name and saved.get('prefix') == prefix:
+                self.cursor = saved['cursor']
+                self.cursor.setdefault('recent', {})
+
+    def __repr__(self):
+        return 'AccessLogIngestor:{0}/{1}:{2}'.format(self.bucket_name, self.prefix, self.cursor['marker'])
+
+    def save(self):
+        """
+        Write the cursor file, atomically
+        """
+        if not self.cursor_path:
+            return
+        descriptor, path = tempfile.mkstemp(prefix='.access-log-', dir=os.path.dirname(os.path.abspath(self.cursor_path)))
+        with os.fdopen(descriptor, 'w') as cursor_file:
+            json.dump({'version': CURSOR_VERSION, 'bucket': self.bucket_name, 'prefix': self.prefix,
+                       'cursor': self.cursor}, cursor_file)
+        os.rename(path, self.cursor_path)
+
+    def _bucket(self):
+        return self.ocb.osu.get_bucket(self.bucket_name, validate=False)
+
+    def _fetch(self, name):
+        content = self._bucket().new_key(name).get_contents_as_string()
+        if name.endswith('.gz'):
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        return parse(content)
+
+    def pending(self):
+        """
+        :return: names of the log objects after the cursor and not ingested yet, listed lazily page by page
+        :rtype: generator
+        """
+        recent = self.cursor['recent']
+        for key in self._bucket().list(prefix=self.prefix, marker=self.cursor['marker']):
+            if (key.name.endswith('.log') or key.name.endswith('.log.gz')) and key.name not in recent:
+                yield key.name
+
+    def _advance(self):
+        """
+        Move the marker past the keys ingested before the lookback, in key order:
+        a key is forgotten only when no key before it is still in the lookback
+        """
+        recent = self.cursor['recent']
+        names = sorted(recent)
+        cutoff = time.time() - self.lookback
+        count = 0
+        while count < len(names) and (recent[names[count]] < cutoff or len(names) - count > MAX_RECENT):
+            count += 1
+        if count:
+            self.cursor['marker'] = names[count - 1]
+            for name in names[:count]:
+                del recent[name]
+
+    def _ingest(self, names, executor):
+        futures = [(name, executor.submit(self._fetch, name)) for name in names]
+        for name, future in futures:
+            try:
+                columns = future.result()
+            except Exception as err:
+                # the cursor stays before the failed object, it is fetched again by the next run
+                for _, other in futures:
+                    other.cancel()
+                raise OCBError('Access log {0} could not be ingested: {1}'.format(name, err))
+            self.stats.add(columns)
+            self.cursor['recent'][name] = time.time()
+            self.cursor['files'] += 1
+            self.cursor['lines'] += len(columns)
+            self.cursor['skipped'] += columns.skipped
+        self._advance()
+        self.save()
+
+    def run_once(self):
+        """
+        Ingest the log objects written since the last run
+        :return: number of ingested objects
+        :rtype: int
+        :raises OCBError: when an object can not be ingested, the cursor is saved before it
+        """
+        ingested = self.cursor['files']
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            batch = []
+            for name in self.pending():
+                batch.append(name)
+                if len(batch) >= self.batch_size:
+                    self._ingest(batch, executor)
+                    batch = []
+            if batch:
+                self._ingest(batch, executor)
+        finally:
+            self.save()
+            executor.shutdown(wait=True)
+        return self.cursor['files'] - ingested
+
+    def follow(self, interval=300, iterations=None, callback=None):
+        """
+        Ingest new log objects every interval seconds
+        :param interval: seconds between two runs, the emit_interval of the LBU in minutes * 60
+        :type interval: float
+        :param iterations: number of runs, forever if None
+        :type iterations: int
+        :param callback: called with the stats summary after each run
+        :type callback: callable
+        """
+        done = 0
+        while iterations is None or done < iterations:
+            try:
+                count = self.run_once()
+            except OCBError as err:
+                self.ocb.log(str(err), 'warning', __file__)
+                count = 0
+            self.ocb.log('{0} access logs ingested from {1}/{2}'.format(count, self.bucket_name, self.prefix), 'info', __file__)
+            if callback is not None:
+                callback(self.stats.summary())
+            done += 1
+            if iterations is None or done < iterations:
+                time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest LBU access logs from OSU')
+    parser.add_argument('bucket', help='bucket of the access logs')
+    parser.add_argument('--prefix', default='', help='s3_bucket_prefix of the access log attribute')
+    parser.add_argument('--cursor', help='JSON file keeping the last ingested key')
+    parser.add_argument('--follow', type=float, help='ingest new logs every FOLLOW seconds')
+    parser.add_argument('--workers', type=int, default=8, help='objects downloaded at once')
+    parser.add_argument('--lookback', type=float, default=3600, help='seconds during which ingested keys are listed again')
+    args = parser.parse_args()
+    ingestor = AccessLogIngestor(args.bucket, args.prefix, args.cursor, max_workers=args.workers, lookback=args.lookback)
+
+    def show(summary):
+        sys.stdout.write(json.dumps(summary, sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+    ingestor.follow(args.follow or 0, None if args.follow else 1, show)
+
+
+if __name__ == '__main__':
+    main()
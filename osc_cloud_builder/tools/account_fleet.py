@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Run the same function against many accounts or regions at once.
+Every section of services.ini gets its own independent connections.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from osc_cloud_builder.OCBase import OCBConnections, DEFAULT_SETTINGS_PATHS, load_settings
+
+
+AccountResult = namedtuple('AccountResult', ['section', 'result', 'error', 'duration'])
+
+
+class AccountFleet(object):
+    """
+    Set of accounts, one per services.ini section.
+    Connections of an account are created on first use and kept for next runs.
+    """
+
+    def __init__(self, sections=None, settings_paths=DEFAULT_SETTINGS_PATHS, max_workers=8, is_secure=True, boto_debug=0):
+        """
+        :param sections: services.ini sections to use, all sections if None
+        :type sections: list
+        :param settings_paths: paths where services.init should be
+        :type settings_paths: list
+        :param max_workers: maximum number of accounts processed at the same time
+        :type max_workers: int
+        :param is_secure: allow connector without ssl
+        :type is_secure: bool
+        :param boto_debug: debug level for boto
+        :type boto_debug: int
+        """
+        self.settings_paths = settings_paths
+        self.sections = sections if sections is not None else load_settings(settings_paths).sections()
+        self.max_workers = max_workers
+        self.is_secure = is_secure
+        self.boto_debug = boto_debug
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def account(self, section):
+        """
+        :param section: services.ini section
+        :type section: str
+        :return: connections of the section, environment variables are ignored
+        :rtype: osc_cloud_builder.OCBase.OCBConnections
+        """
+        with self._lock:
+            account = self._accounts.get(section)
+        if account is None:
+            account = OCBConnections(section, self.settings_paths, self.is_secure, self.boto_debug, use_environment=False)
+            with self._lock:
+                account = self._accounts.setdefault(section, account)
+        return account
+
+    def _run_one(self, section, function, args, kwargs):
+        started = time.time()
+        try:
+            result = function(self.account(section), *args, **kwargs)
+        except Exception as err:
+            return AccountResult(section, None, err, time.time() - started)
+        return AccountResult(section, result, None, time.time() - started)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call function(account, *args, **kwargs) for every account
+        :param function: callable whose first parameter is an OCBConnections
+        :type function: callable
+        :return: generator of AccountResult, in order of completion
+        :rtype: generator
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = [executor.submit(self._run_one, section, function, args, kwargs) for section in self.sections]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False)
+
+    def map(self, function, *args, **kwargs):
+        """
+        Like run() but wait for all accounts
+        :return: AccountResult by section
+        :rtype: dict
+        """
+        return dict((account_result.section, account_result) for account_result in self.run(function, *args, **kwargs))
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Export of the account consumption, window by window, to CSV files with costs.
+
+The period is split into windows of window_days days, aligned on a fixed grid so that
+two exports of overlapping periods share their windows. Windows are fetched concurrently
+by ReadConsumptionAccount calls, and each one is written to its own CSV file of the
+directory, with the unit price of the catalog and the cost of each entry.
+
+Windows ended more than settle_days ago are closed: their file is written once and
+listed in the manifest, next exports read it instead of calling ICU again. Only the
+windows still open are fetched again, their files are replaced.
+
+    exporter = ConsumptionExporter('~/consumption/my-account', window_days=7, max_workers=4)
+    exporter.export(datetime.date(2017, 1, 1), datetime.date(2018, 1, 1))
+    exporter.costs(group_by=('service', 'type'))
+
+Many accounts at once, with osc_cloud_builder.tools.account_fleet:
+
+    AccountFleet().map(lambda ocb: ConsumptionExporter(os.path.join('~/consumption', ocb.section), ocb).export(start, end))
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import csv
+import json
+import time
+import random
+import datetime
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from osc_cloud_builder.OCBase import OCBase, OCBError
+from osc_cloud_builder.vendor.outscale.icu import response_value
+
+MANIFEST_VERSION = 1
+MANIFEST = 'manifest.json'
+DAY_FORMAT = '%Y%m%d'
+# CSV column -> key of the consumption entry
+ENTRY_COLUMNS = (
+    ('category', 'Category'),
+    ('service', 'Service'),
+    ('operation', 'Operation'),
+    ('type', 'Type'),
+    ('title', 'Title'),
+    ('zone', 'ZoneName'),
+    ('value', 'Value'),
+)
+COLUMNS = ('from_date', 'to_date') + tuple([column for column, _ in ENTRY_COLUMNS]) + ('unit_price', 'cost')
+NUMERIC_COLUMNS = frozenset(['value', 'unit_price', 'cost'])
+
+
+def _day(value):
+    """
+    :param value: day
+    :type value: datetime.date or datetime.datetime
+    :rtype: datetime.date
+    """
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def windows(from_date, to_date, window_days):
+    """
+    :param from_date: first day of the period
+    :type from_date: datetime.date
+    :param to_date: day after the period
+    :type to_date: datetime.date
+    :param window_days: days per window
+    :type window_days: int
+    :return: (first day, day after) of the windows covering the period, aligned on multiples of window_days
+    :rtype: list
+    """
+    from_date = _day(from_date)
+    to_date = _day(to_date)
+    start = from_date.toordinal() - from_date.toordinal() % window_days
+    return [(datetime.date.fromordinal(ordinal), datetime.date.fromordinal(ordinal + window_days))
+            for ordinal in range(start, to_date.toordinal(), window_days)]
+
+
+def window_name(start, end):
+    """
+    :return: name of the window, and of its CSV file
+    :rtype: str
+    """
+    return '{0}-{1}'.format(start.strftime(DAY_FORMAT), end.strftime(DAY_FORMAT))
+
+
+class ConsumptionExporter(object):
+    """
+    Consumption of one account exported to a directory, see the module documentation
+    """
+
+    def __init__(self, directory, ocb=None, window_days=7, max_workers=4, settle_days=1, max_attempts=3, region=None):
+        """
+        :param directory: directory of the CSV files and of the manifest, one per account
+        :type directory: str
+        :param ocb: connections of the account, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :param window_days: days per ReadConsumptionAccount call
+        :type window_days: int
+        :param max_workers: maximum number of ReadConsumptionAccount calls at once
+        :type max_workers: int
+        :param settle_days: days after its end before a window is closed, consumption of the last days may still change
+        :type settle_days: int
+        :param max_attempts: attempts of a window before giving up
+        :type max_attempts: int
+        :param region: region of the catalog, current region if None
+        :type region: str
+        """
+        self.directory = os.path.expanduser(directory)
+        self.ocb = ocb or OCBase()
+        self.window_days = window_days
+        self.max_workers = max_workers
+        self.settle_days = settle_days
+        self.max_attempts = max_attempts
+        self.region = region
+        self.closed = {}
+        self._prices = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                saved = json.load(manifest_file)
+            if saved.get('version') == MANIFEST_VERSION:
+                # closed windows whose file was removed are fetched again
+                self.closed = dict((name, window) for name, window in saved['closed'].items()
+                                   if os.path.exists(self._path(name)))
+
+    def __repr__(self):
+        return 'ConsumptionExporter:{0}'.format(self.directory)
+
+    def _path(self, name, closed=True):
+        return os.path.join(self.directory, '{0}{1}.csv'.format('' if closed else 'open-', name))
+
+    def save(self):
+        """
+        Write the manifest, atomically
+        """
+        with self._lock:
+            content = {'version': MANIFEST_VERSION, 'closed': self.closed}
+            descriptor, path = tempfile.mkstemp(prefix='.consumption-', dir=self.directory)
+            with os.fdopen(descriptor, 'w') as manifest_file:
+                json.dump(content, manifest_file, indent=1, sort_keys=True)
+            os.rename(path, os.path.join(self.directory, MANIFEST))
+
+    def prices(self):
+        """
+        :return: (service, operation, type) -> unit price, from the catalog
+        :rtype: dict
+        """
+        if self._prices is None:
+            catalog = response_value(self.ocb.icu.get_catalog(self.region) or {}, 'Catalog', {})
+            self._prices = dict(((response_value(entry, 'Service'), response_value(entry, 'Operation'), response_value(entry, 'Type')),
+                                 float(response_value(entry, 'UnitPrice', 0.0)))
+                                for entry in response_value(catalog, 'Entries', []))
+        return self._prices
+
+    def is_closed(self, end, today=None):
+        """
+        :param end: day after the window
+        :type end: datetime.date
+        :rtype: bool
+        """
+        today = today or datetime.datetime.utcnow().date()
+        return end + datetime.timedelta(days=self.settle_days) <= today
+
+    def export(self, from_date, to_date):
+        """
+        Fetch the windows of the period which are not closed yet
+        :param from_date: first day of the period, rounded down to a window start
+        :type from_date: datetime.date
+        :param to_date: day after the period, rounded up to a window end
+        :type to_date: datetime.date
+        :return: number of windows fetched, read from closed files and failed, and entries fetched
+        :rtype: dict
+        """
+        today = datetime.datetime.utcnow().date()
+        pending = [(start, end) for start, end in windows(from_date, to_date, self.window_days)
+                   if window_name(start, end) not in self.closed]
+        summary = {'fetched': 0, 'cached': len(windows(from_date, to_date, self.window_days)) - len(pending),
+                   'failed': [], 'entries': 0}
+        if pending:
+            self.prices()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = dict((executor.submit(self._export_window, start, end, self.is_closed(end, today)), (start, end))
+                           for start, end in pending)
+            for future in as_completed(futures):
+                name = window_name(*futures[future])
+                try:
+                    entries = future.result()
+                except Exception as err:
+                    self.ocb.log('Consumption of {0} failed: {1}'.format(name, err), 'error', __file__)
+                    summary['failed'].append(name)
+                    continue
+                summary['fetched'] += 1
+                summary['entries'] += entries
+        self.ocb.log('Consumption exported to {0}: {1}'.format(self.directory, summary), 'info', __file__)
+        return summary
+
+    def _fetch(self, start, end):
+        delay = 1.0
+        for attempt in range(self.max_attempts):
+            try:
+                return self.ocb.icu.get_consumption_account(datetime.datetime.combine(start, datetime.time()),
+                                                            datetime.datetime.combine(end, datetime.time())) or {}
+            except Exception as err:
+                if attempt + 1 == self.max_attempts:
+                    raise
+                self.ocb.log('Consumption of {0} failed: {1}, retrying'.format(window_name(start, end), err), 'warning', __file__)
+                time.sleep(random.uniform(delay / 2, delay))
+                delay *= 2
+
+    def _export_window(self, start, end, closed):
+        name = window_name(start, end)
+        response = self._fetch(start, end)
+        prices = self.prices()
+        from_day = start.isoformat()
+        to_day = end.isoformat()
+        entries = 0
+        cost = 0.0
+        descriptor, path = tempfile.mkstemp(prefix='.consumption-', dir=self.directory)
+        with os.fdopen(descriptor, 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(COLUMNS)
+            for entry in response_value(response, 'Entries', []):
+                row = [from_day, to_day] + [response_value(entry, key) for _, key in ENTRY_COLUMNS]
+                value = float(response_value(entry, 'Value') or 0.0)
+                unit_price = prices.get((response_value(entry, 'Service'), response_value(entry, 'Operation'), response_value(entry, 'Type')))
+                row.append(unit_price)
+                row.append(value * unit_price if unit_price is not None else None)
+                if unit_price is not None:
+                    cost += value * unit_price
+                writer.writerow([_cell(cell) for cell in row])
+                entries += 1
+        os.rename(path, self._path(name, closed))
+        if closed:
+            if os.path.exists(self._path(name, False)):
+                os.remove(self._path(name, False))
+            with self._lock:
+                self.closed[name] = {'from_date': from_day, 'to_date': to_day, 'entries': entries, 'cost': round(cost, 6)}
+            self.save()
+        return entries
+
+    def read(self, from_date=None, to_date=None):
+        """
+        :param from_date: first day, windows starting before it are skipped, all windows if None
+        :type from_date: datetime.date
+        :param to_date: day after, windows ending after it are skipped, all windows if None
+        :type to_date: datetime.date
+        :return: generator of entries (dict of COLUMNS) of the exported windows, closed and open,
+                 value, unit_price and cost are floats or None
+        :rtype: generator
+        """
+        names = set([name for name in self.closed])
+        names.update([name[len('open-'):-len('.csv')] for name in os.listdir(self.directory)
+                      if name.startswith('open-') and name.endswith('.csv')])
+        for name in sorted(names):
+            start, _, end = name.partition('-')
+            if from_date and start < _day(from_date).strftime(DAY_FORMAT):
+                continue
+            if to_date and end > _day(to_date).strftime(DAY_FORMAT):
+                continue
+            path = self._path(name, name in self.closed)
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as csv_file:
+                for row in csv.DictReader(csv_file):
+                    for column in NUMERIC_COLUMNS:
+                        row[column] = float(row[column]) if row[column] else None
+                    yield row
+
+    def costs(self, from_date=None, to_date=None, group_by=('service', 'type')):
+        """
+        :param group_by: columns of the groups
+        :type group_by: tuple
+        :return: group values -> cost, entries without price are not counted
+        :rtype: dict
+        :raises OCBError: when a group_by column is unknown
+        """
+        unknown = [column for column in group_by if column not in COLUMNS]
+        if unknown:
+            raise OCBError('Unknown consumption columns {0}'.format(', '.join(unknown)))
+        totals = {}
+        for row in self.read(from_date, to_date):
+            if row['cost'] is not None:
+                key = tuple([row[column] for column in group_by])
+                totals[key] = totals.get(key, 0.0) + row['cost']
+        return totals
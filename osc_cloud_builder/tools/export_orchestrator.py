@@ -0,0 +1,362 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Export many snapshots or images to OSU with a bounded number of tasks in flight.
+
+All running tasks are polled with one Describe call per sweep. Progress is saved
+in a JSON state file after every change, a crashed run started again with the
+same state file polls the tasks already started instead of starting them again.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import json
+import os
+import tempfile
+import time
+from boto.exception import EC2ResponseError
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+STATE_VERSION = 1
+DESCRIBE_CHUNK = 200
+
+QUEUED = 'queued'
+COMPLETED = 'completed'
+FAILED = 'failed'
+IN_FLIGHT = ('pending', 'active')
+
+
+def _snapshot_sizes(fcu, ids):
+    return dict((snapshot.id, snapshot.volume_size) for snapshot in fcu.get_all_snapshots(snapshot_ids=ids))
+
+
+def _image_sizes(fcu, ids):
+    sizes = {}
+    for image in fcu.get_all_images(image_ids=ids):
+        mapping = image.block_device_mapping or {}
+        sizes[image.id] = sum([device.size for device in mapping.values() if device.size]) or None
+    return sizes
+
+
+def _export_snapshot(fcu, source_id, settings):
+    return fcu.export_snapshot(source_id, settings['bucket'], settings['disk_image_format'],
+                               settings.get('ak'), settings.get('sk'), settings['prefix'])
+
+
+def _export_image(fcu, source_id, settings):
+    return fcu.export_image(source_id, settings['bucket'], settings['disk_image_format'],
+                            settings.get('ak'), settings.get('sk'), settings['prefix'])
+
+
+def _describe_snapshot_exports(fcu, task_ids):
+    return fcu.get_all_snapshot_export_tasks(snapshot_export_ids=task_ids, compact=True)
+
+
+def _describe_image_exports(fcu, task_ids):
+    return fcu.get_all_image_export_tasks(image_export_ids=task_ids, compact=True)
+
+
+# kind -> (sizes of sources, start an export, describe export tasks)
+EXPORT_KINDS = {
+    'snapshot': (_snapshot_sizes, _export_snapshot, _describe_snapshot_exports),
+    'image': (_image_sizes, _export_image, _describe_image_exports),
+}
+
+
+class ExportOrchestrator(object):
+    """
+    Export snapshots or images to a bucket, keeping at most max_in_flight export tasks running
+    """
+
+    def __init__(self, source_ids, bucket, kind='snapshot', disk_image_format='qcow2', prefix='',
+                 ak=None, sk=None, max_in_flight=5, quota_name=None, state_file=None,
+                 poll_interval=30, max_attempts=3, ocb=None):
+        """
+        :param source_ids: snapshot or image ids to export
+        :type source_ids: list
+        :param bucket: destination bucket
+        :type bucket: str
+        :param kind: snapshot or image
+        :type kind: str
+        :param disk_image_format: vmdk, vdi or qcow2
+        :type disk_image_format: str
+        :param prefix: prefix of the destination keys
+        :type prefix: str
+        :param ak: access key of the bucket owner if not the exporting account
+        :type ak: str
+        :param sk: secret key of the bucket owner if not the exporting account
+        :type sk: str
+        :param max_in_flight: maximum number of export tasks running at once
+        :type max_in_flight: int
+        :param quota_name: quota limiting export tasks, in flight tasks never exceed its free value
+        :type quota_name: str
+        :param state_file: JSON file where progress is saved, an existing file is resumed
+        :type state_file: str
+        :param poll_interval: seconds between two sweeps
+        :type poll_interval: float
+        :param max_attempts: export attempts of a source before it is marked failed
+        :type max_attempts: int
+        :param ocb: connections, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :raises OCBError: when kind is unknown or state_file was written for other export settings
+        """
+        if kind not in EXPORT_KINDS:
+            raise OCBError('Unknown export kind {0}, use one of {1}'.format(kind, sorted(EXPORT_KINDS)))
+        self.ocb = ocb or OCBase()
+        self.kind = kind
+        self.settings = {'kind': kind, 'bucket': bucket, 'disk_image_format': disk_image_format, 'prefix': prefix or ''}
+        self.ak = ak
+        self.sk = sk
+        self.max_in_flight = max_in_flight
+        self.quota_name = quota_name
+        self.state_file = state_file
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.describe_calls = 0
+        self.jobs = {}
+        self.order = []
+        self._blocked_until = 0
+        self._started = None
+        self._gb_at_start = 0.0
+        if state_file and os.path.exists(state_file):
+            self._load()
+        for source_id in source_ids:
+            if source_id not in self.jobs:
+                self.jobs[source_id] = {'source_id': source_id, 'task_id': None, 'state': QUEUED, 'completion': 0,
+                                        'size_gb': None, 'attempts': 0, 'started': None, 'ended': None, 'error': None}
+                self.order.append(source_id)
+
+    def __repr__(self):
+        return 'ExportOrchestrator:{0}:{1}'.format(self.kind, len(self.jobs))
+
+    def _load(self):
+        with open(self.state_file) as state:
+            saved = json.load(state)
+        if saved.get('version') != STATE_VERSION or saved.get('settings') != self.settings:
+            raise OCBError('State file {0} was written for other export settings: {1}'.format(self.state_file, saved.get('settings')))
+        self.order = saved['order']
+        self.jobs = dict((job['source_id'], job) for job in saved['jobs'])
+        self.ocb.log('Resuming {0} exports from {1}'.format(len(self.jobs), self.state_file), 'info', __file__)
+
+    def save(self):
+        """
+        Write the state file, atomically
+        """
+        if not self.state_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        descriptor, path = tempfile.mkstemp(prefix='.export-', dir=directory)
+        with os.fdopen(descriptor, 'w') as state:
+            json.dump({'version': STATE_VERSION, 'settings': self.settings, 'order': self.order,
+                       'jobs': [self.jobs[source_id] for source_id in self.order]}, state, indent=1)
+        os.rename(path, self.state_file)
+
+    def jobs_in(self, *states):
+        return [self.jobs[source_id] for source_id in self.order if self.jobs[source_id]['state'] in states]
+
+    def _fetch_sizes(self):
+        sizes_of = EXPORT_KINDS[self.kind][0]
+        missing = [job['source_id'] for job in self.jobs_in(QUEUED, *IN_FLIGHT) if job['size_gb'] is None]
+        for start in range(0, len(missing), DESCRIBE_CHUNK):
+            chunk = missing[start:start + DESCRIBE_CHUNK]
+            try:
+                sizes = sizes_of(self.ocb.fcu, chunk)
+            except EC2ResponseError as err:
+                self.ocb.log('Can not get size of {0} {1}: {2}'.format(self.kind, chunk, err.message), 'warning', __file__)
+                continue
+            for source_id, size in sizes.items():
+                if source_id in self.jobs:
+                    self.jobs[source_id]['size_gb'] = size
+
+    def _capacity(self):
+        """
+        :return: number of tasks which can be started now
+        :rtype: int
+        """
+        if time.time() < self._blocked_until:
+            return 0
+        in_flight = len(self.jobs_in(*IN_FLIGHT))
+        capacity = self.max_in_flight - in_flight
+        if self.quota_name and capacity > 0:
+            for reference in self.ocb.fcu.get_all_quotas(quota_names=[self.quota_name], compact=True):
+                for quota in reference.quotas or []:
+                    if quota.name == self.quota_name and quota.max_quota_value is not None:
+                        capacity = min(capacity, quota.max_quota_value - (quota.used_quota_value or 0))
+        return max(0, capacity)
+
+    def _start(self, job):
+        start_export = EXPORT_KINDS[self.kind][1]
+        settings = dict(self.settings, ak=self.ak, sk=self.sk)
+        try:
+            task = start_export(self.ocb.fcu, job['source_id'], settings)
+        except EC2ResponseError as err:
+            if err.error_code and err.error_code.endswith('LimitExceeded'):
+                # quota or throttling: try again at next sweep, the attempt does not count
+                self._blocked_until = time.time() + self.poll_interval
+                self.ocb.log('Export of {0} delayed: {1}'.format(job['source_id'], err.error_code), 'info', __file__)
+                return False
+            job['attempts'] += 1
+            job['error'] = err.message
+            job['state'] = FAILED if job['attempts'] >= self.max_attempts else QUEUED
+            self.save()
+            self.ocb.log('Export of {0} not started: {1}'.format(job['source_id'], err.message), 'warning', __file__)
+            return True
+        job.update({'task_id': task.id, 'state': task.state or 'pending', 'completion': 0,
+                    'started': time.time(), 'ended': None, 'error': None})
+        job['attempts'] += 1
+        # saved right away: a crash before the end of the batch must not start this export twice
+        self.save()
+        self.ocb.log('Export of {0} started: {1}'.format(job['source_id'], task.id), 'info', __file__)
+        return True
+
+    def start_queued(self):
+        """
+        Start queued exports up to the in flight limit
+        :return: number of started exports
+        :rtype: int
+        """
+        started = 0
+        for job in self.jobs_in(QUEUED)[:self._capacity()]:
+            if not self._start(job):
+                break
+            started += 1
+        return started
+
+    def sweep(self):
+        """
+        Refresh all tasks in flight with one Describe call
+        :return: jobs still in flight
+        :rtype: list
+        """
+        in_flight = self.jobs_in(*IN_FLIGHT)
+        if not in_flight:
+            return in_flight
+        describe = EXPORT_KINDS[self.kind][2]
+        by_task = dict((job['task_id'], job) for job in in_flight)
+        try:
+            tasks = describe(self.ocb.fcu, list(by_task))
+        except EC2ResponseError as err:
+            if not (err.error_code and err.error_code.endswith('NotFound')):
+                raise
+            # a task of the state file is unknown: list all tasks, the missing ones are exported again
+            tasks = describe(self.ocb.fcu, None)
+        finally:
+            self.describe_calls += 1
+        seen = set()
+        for task in tasks:
+            job = by_task.get(task.id)
+            if job is None:
+                continue
+            seen.add(task.id)
+            job['state'] = task.state
+            job['completion'] = task.completion or 0
+            if task.state == COMPLETED:
+                job['completion'] = 100
+                job['ended'] = time.time()
+            elif task.state not in IN_FLIGHT:
+                job['error'] = task.status_message or task.state
+                job['ended'] = time.time()
+                job['state'] = FAILED if job['attempts'] >= self.max_attempts else QUEUED
+                self.ocb.log('Export {0} of {1} {2}: {3}'.format(task.id, job['source_id'], task.state, job['error']), 'warning', __file__)
+        for task_id, job in by_task.items():
+            if task_id not in seen:
+                self.ocb.log('Export {0} of {1} is unknown, it will be started again'.format(task_id, job['source_id']), 'warning', __file__)
+                job.update({'task_id': None, 'state': QUEUED, 'completion': 0})
+        self.save()
+        return self.jobs_in(*IN_FLIGHT)
+
+    def exported_gb(self):
+        """
+        :return: GB exported so far, running tasks count for their completion
+        :rtype: float
+        """
+        return sum([(job['size_gb'] or 0) * (100 if job['state'] == COMPLETED else job['completion']) / 100.0
+                    for job in self.jobs.values() if job['state'] != FAILED])
+
+    def progress(self):
+        """
+        :return: counts by state, GB exported and total, throughput in GB/hour since run() started, ETA in seconds
+        :rtype: dict
+        """
+        total_gb = sum([job['size_gb'] or 0 for job in self.jobs.values() if job['state'] != FAILED])
+        exported_gb = self.exported_gb()
+        elapsed = time.time() - self._started if self._started else 0
+        throughput = (exported_gb - self._gb_at_start) * 3600 / elapsed if elapsed > 0 else 0.0
+        eta = (total_gb - exported_gb) * 3600 / throughput if throughput > 0 else None
+        return {
+            'queued': len(self.jobs_in(QUEUED)),
+            'in_flight': len(self.jobs_in(*IN_FLIGHT)),
+            'completed': len(self.jobs_in(COMPLETED)),
+            'failed': len(self.jobs_in(FAILED)),
+            'exported_gb': exported_gb,
+            'total_gb': total_gb,
+            'throughput': throughput,
+            'eta': eta,
+        }
+
+    def describe(self):
+        """
+        :return: one line of progress per export in flight, then a summary line
+        :rtype: list
+        """
+        lines = []
+        for job in self.jobs_in(*IN_FLIGHT):
+            lines.append('{0} {1} {2} {3}% {4}GB'.format(job['source_id'], job['task_id'], job['state'],
+                                                        job['completion'], job['size_gb'] if job['size_gb'] is not None else '?'))
+        progress = self.progress()
+        eta = '{0:.0f}min'.format(progress['eta'] / 60) if progress['eta'] is not None else 'unknown'
+        lines.append('{0} completed, {1} in flight, {2} queued, {3} failed, {4:.1f}/{5:.1f}GB, {6:.1f}GB/hour, ETA {7}'.format(
+            progress['completed'], progress['in_flight'], progress['queued'], progress['failed'],
+            progress['exported_gb'], progress['total_gb'], progress['throughput'], eta))
+        return lines
+
+    def run(self, timeout=None):
+        """
+        Export all sources, returns when all exports are completed or failed
+        :param timeout: give up after this many seconds, exports in flight keep running
+        :type timeout: float
+        :return: jobs by source id
+        :rtype: dict
+        """
+        deadline = time.time() + timeout if timeout else None
+        self._fetch_sizes()
+        self._started = time.time()
+        self._gb_at_start = self.exported_gb()
+        self.save()
+        while True:
+            self.sweep()
+            self.start_queued()
+            for line in self.describe():
+                self.ocb.log(line, 'info', __file__)
+            if not self.jobs_in(QUEUED, *IN_FLIGHT):
+                return self.jobs
+            if deadline and time.time() + self.poll_interval > deadline:
+                self.ocb.log('Export timeout, {0} exports not done'.format(len(self.jobs_in(QUEUED, *IN_FLIGHT))), 'warning', __file__)
+                return self.jobs
+            time.sleep(self.poll_interval)
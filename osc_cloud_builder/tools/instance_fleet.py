@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Launch fleets of instances with concurrent RunInstances calls.
+
+The fleet is split into shards: one RunInstances call per shard, at most
+shard_size instances in one subnet, with their private IPs taken from an
+IP plan if any. Shards are launched concurrently and each has its own client
+token, so a shard sent again after a failure or a timeout never launches its
+instances twice. Only failed shards are sent again.
+
+    launcher = FleetLauncher(max_workers=8)
+    result = launcher.launch('ami-12345678', subnets=['subnet-1', 'subnet-2'],
+                             ip_plan={'subnet-1': ['10.0.1.10', '10.0.1.11'], 'subnet-2': ['10.0.2.10']},
+                             instance_type='tinav2.c2r4', key_name='fleet')
+    if result.failed:
+        result = launcher.run(result.failed, 'ami-12345678', instance_type='tinav2.c2r4', key_name='fleet')
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import time
+import uuid
+import random
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from boto.exception import EC2ResponseError
+from osc_cloud_builder.OCBase import OCBase, OCBError
+from osc_cloud_builder.tools.quota_planner import INSTANCES
+from osc_cloud_builder.vendor.outscale.throttle import THROTTLING_CODES
+
+# instances launched by one RunInstances call
+MAX_SHARD_SIZE = 100
+DEFAULT_SHARD_SIZE = 25
+# errors which do not depend on the request, the shard may succeed later
+RETRIABLE_CODES = THROTTLING_CODES | frozenset(['InsufficientInstanceCapacity', 'InternalError', 'Unavailable'])
+
+
+FleetResult = namedtuple('FleetResult', ['instances', 'shards', 'failed'])
+
+
+class FleetShard(object):
+    """
+    Instances of a fleet launched by one RunInstances call
+    """
+
+    def __init__(self, index, subnet_id, count, private_ips, client_token):
+        """
+        :param index: position of the shard in the fleet
+        :type index: int
+        :param subnet_id: subnet of the instances
+        :type subnet_id: str
+        :param count: number of instances
+        :type count: int
+        :param private_ips: private IP of each instance, None to let FCU choose
+        :type private_ips: list
+        :param client_token: idempotency token of the RunInstances call
+        :type client_token: str
+        """
+        self.index = index
+        self.subnet_id = subnet_id
+        self.count = count
+        self.private_ips = private_ips
+        self.client_token = client_token
+        self.instances = []
+        self.error = None
+        self.attempts = 0
+
+    def __repr__(self):
+        return 'FleetShard:{0}:{1}:{2}'.format(self.index, self.subnet_id, self.count)
+
+    @property
+    def retriable(self):
+        """
+        :return: True if the shard failed on an error which may not happen again
+        :rtype: bool
+        """
+        if self.error is None:
+            return False
+        if isinstance(self.error, EC2ResponseError):
+            return self.error.error_code in RETRIABLE_CODES or self.error.status >= 500
+        # connection errors: the client token makes a second call safe
+        return True
+
+
+class FleetLauncher(object):
+    """
+    Concurrent launch of the shards of a fleet, see the module documentation
+    """
+
+    def __init__(self, ocb=None, max_workers=8, shard_size=DEFAULT_SHARD_SIZE, max_attempts=3, base_delay=2.0, quota_name=INSTANCES,
+                 planner=None):
+        """
+        :param ocb: connections of the account, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :param max_workers: maximum number of RunInstances calls at once
+        :type max_workers: int
+        :param shard_size: maximum number of instances of a shard, at most MAX_SHARD_SIZE
+        :type shard_size: int
+        :param max_attempts: attempts of a shard failing on retriable errors
+        :type max_attempts: int
+        :param base_delay: seconds before sending failed shards again, doubled on each attempt
+        :type base_delay: float
+        :param quota_name: quota checked before launching, no check if None or if the account has no such quota
+        :type quota_name: str
+        :param planner: planner reserving the quota while the fleet is launched, concurrent launches
+                        of the process or of the host then do not go past the quota together
+        :type planner: osc_cloud_builder.tools.quota_planner.QuotaPlanner
+        """
+        self.ocb = ocb or OCBase()
+        self.max_workers = max_workers
+        self.shard_size = max(1, min(shard_size, MAX_SHARD_SIZE))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.quota_name = quota_name
+        self.planner = planner
+
+    def __repr__(self):
+        return 'FleetLauncher:{0}x{1}'.format(self.max_workers, self.shard_size)
+
+    def free_quota(self):
+        """
+        :return: number of instances which can still be launched, None if unknown
+        :rtype: int
+        """
+        if not self.quota_name:
+            return None
+        for reference in self.ocb.fcu.iter_quotas(quota_names=[self.quota_name], compact=True):
+            for quota in reference.quotas:
+                if quota.name == self.quota_name and quota.max_quota_value is not None:
+                    return quota.max_quota_value - (quota.used_quota_value or 0)
+        return None
+
+    def plan(self, subnets, count=None, ip_plan=None, client_token=None):
+        """
+        Split a fleet into shards
+        :param subnets: subnets of the fleet, instances are spread evenly over them
+        :type subnets: list
+        :param count: number of instances, the size of the IP plan if None
+        :type count: int
+        :param ip_plan: subnet ID -> private IPs of the instances of the subnet, the number
+                        of instances of each subnet is then the number of its IPs
+        :type ip_plan: dict
+        :param client_token: prefix of the client tokens of the shards, random if None.
+                             Planning the same fleet with the same token gives the same shards.
+        :type client_token: str
+        :return: shards of the fleet
+        :rtype: list
+        :raises OCBError: when count does not match the IP plan
+        """
+        client_token = client_token or uuid.uuid4().hex
+        if ip_plan:
+            subnets = [subnet_id for subnet_id in subnets if ip_plan.get(subnet_id)]
+            per_subnet = [(subnet_id, list(ip_plan[subnet_id])) for subnet_id in subnets]
+            planned = sum([len(ips) for _, ips in per_subnet])
+            if count is not None and count != planned:
+                raise OCBError('IP plan has {0} addresses for {1} instances'.format(planned, count))
+        else:
+            if not subnets or not count:
+                raise OCBError('A fleet needs subnets and a count or an IP plan')
+            per_subnet = [(subnet_id, [None] * (count // len(subnets) + (1 if index < count % len(subnets) else 0)))
+                          for index, subnet_id in enumerate(subnets)]
+        shards = []
+        for subnet_id, ips in per_subnet:
+            for start in range(0, len(ips), self.shard_size):
+                chunk = ips[start:start + self.shard_size]
+                shards.append(FleetShard(len(shards), subnet_id, len(chunk), chunk if ip_plan else None,
+                                         '{0}-{1}'.format(client_token[:56], len(shards))))
+        return shards
+
+    def launch(self, image_id, subnets, count=None, ip_plan=None, client_token=None, **kwargs):
+        """
+        Plan and launch a fleet
+        :param image_id: OMI of the instances
+        :type image_id: str
+        :param subnets: subnets of the fleet, see plan
+        :type subnets: list
+        :param count: number of instances, see plan
+        :type count: int
+        :param ip_plan: private IPs of the instances per subnet, see plan
+        :type ip_plan: dict
+        :param client_token: prefix of the client tokens of the shards, see plan
+        :type client_token: str
+        :param kwargs: other arguments of boto run_instances (instance_type, key_name, security_group_ids...)
+        :return: instances launched, all shards and failed shards
+        :rtype: FleetResult
+        :raises OCBError: when the fleet does not fit the quota
+        """
+        shards = self.plan(subnets, count, ip_plan, client_token)
+        total = sum([shard.count for shard in shards])
+        if self.planner is not None and self.quota_name:
+            with self.planner.reserve({self.quota_name: total}) as reservation:
+                reservation.created = True
+                return self.run(shards, image_id, **kwargs)
+        free = self.free_quota()
+        if free is not None and total > free:
+            raise OCBError('Fleet of {0} instances exceeds {1} quota, {2} left'.format(total, self.quota_name, free))
+        return self.run(shards, image_id, **kwargs)
+
+    def run(self, shards, image_id, **kwargs):
+        """
+        Launch shards, shards already launched are left as is and failed shards are sent again
+        as long as their error is retriable.
+        :param shards: shards from plan, or failed shards of a previous result
+        :type shards: list
+        :param image_id: OMI of the instances
+        :type image_id: str
+        :param kwargs: other arguments of boto run_instances
+        :return: instances launched, shards and failed shards
+        :rtype: FleetResult
+        """
+        pending = [shard for shard in shards if not shard.instances]
+        delay = self.base_delay
+        for attempt in range(self.max_attempts):
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda shard: self._run_shard(shard, image_id, kwargs), pending))
+            pending = [shard for shard in pending if shard.retriable]
+            if not pending or attempt + 1 == self.max_attempts:
+                break
+            self.ocb.log('{0} shards failed, sending them again in {1:.1f}s'.format(len(pending), delay), 'warning', __file__)
+            time.sleep(random.uniform(delay / 2, delay))
+            delay *= 2
+        failed = [shard for shard in shards if shard.error is not None]
+        instances = [instance for shard in shards for instance in shard.instances]
+        self.ocb.log('Fleet launched {0} instances, {1} shards failed'.format(len(instances), len(failed)), 'info', __file__)
+        return FleetResult(instances, shards, failed)
+
+    def _run_shard(self, shard, image_id, kwargs):
+        shard.attempts += 1
+        try:
+            reservation = self.ocb.fcu.multi_run_instances(shard.private_ips, image_id=image_id,
+                                                           min_count=shard.count, max_count=shard.count,
+                                                           subnet_id=shard.subnet_id, client_token=shard.client_token,
+                                                           **kwargs)
+        except Exception as err:
+            shard.error = err
+            self.ocb.log('Shard {0} of {1} instances in {2} failed: {3}'.format(shard.index, shard.count, shard.subnet_id, err),
+                         'warning', __file__)
+            return
+        shard.instances = reservation.instances
+        shard.error = None
@@ -0,0 +1,408 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Local inventory of an account's ressources, stored in SQLite.
+
+Ressources are indexed by kind, VPC, subnet, state and tags, and relations
+(load balancer subnets, instance security groups, route table associations...)
+are stored as links, so relationship queries are answered locally:
+
+    inventory = Inventory('~/.osc_cloud_builder/inventory.db')
+    inventory.refresh(max_age=300)
+    inventory.find('load_balancer', vpc_id='vpc-12345678')
+
+A refresh only rewrites the ressources which changed since the previous one.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from boto.ec2.ec2object import EC2Object
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS ressources (id TEXT PRIMARY KEY, kind TEXT NOT NULL, vpc_id TEXT, subnet_id TEXT,'
+    ' state TEXT, name TEXT, data TEXT, digest TEXT, refreshed REAL)',
+    'CREATE INDEX IF NOT EXISTS ressources_kind ON ressources (kind)',
+    'CREATE INDEX IF NOT EXISTS ressources_vpc ON ressources (vpc_id)',
+    'CREATE INDEX IF NOT EXISTS ressources_subnet ON ressources (subnet_id)',
+    'CREATE TABLE IF NOT EXISTS tags (ressource_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT)',
+    'CREATE INDEX IF NOT EXISTS tags_ressource ON tags (ressource_id)',
+    'CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value)',
+    'CREATE TABLE IF NOT EXISTS links (ressource_id TEXT NOT NULL, relation TEXT NOT NULL, target_id TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS links_ressource ON links (ressource_id)',
+    'CREATE INDEX IF NOT EXISTS links_target ON links (target_id)',
+    'CREATE TABLE IF NOT EXISTS refreshes (kind TEXT PRIMARY KEY, refreshed REAL)',
+)
+
+# ressources of a kind in a VPC, or linked to a ressource of the VPC
+SELECT_VPC_IDS = ('SELECT id, digest FROM ressources WHERE kind = ? AND (vpc_id = ? OR id IN'
+                  ' (SELECT links.ressource_id FROM links JOIN ressources AS target ON target.id = links.target_id'
+                  ' WHERE target.vpc_id = ?))')
+
+
+def _tags(obj):
+    return dict(getattr(obj, 'tags', None) or {})
+
+
+def _vpcs(ocb, filters):
+    return [{'id': vpc.id, 'vpc_id': vpc.id, 'state': vpc.state, 'tags': _tags(vpc),
+             'data': {'cidr_block': vpc.cidr_block}}
+            for vpc in ocb.fcu.get_all_vpcs(filters=filters)]
+
+
+def _subnets(ocb, filters):
+    return [{'id': subnet.id, 'vpc_id': subnet.vpc_id, 'subnet_id': subnet.id, 'state': subnet.state, 'tags': _tags(subnet),
+             'data': {'cidr_block': subnet.cidr_block, 'availability_zone': subnet.availability_zone}}
+            for subnet in ocb.fcu.get_all_subnets(filters=filters)]
+
+
+def _route_tables(ocb, filters):
+    return [{'id': rt.id, 'vpc_id': rt.vpc_id, 'tags': _tags(rt),
+             'links': [('association', association.subnet_id) for association in rt.associations if association.subnet_id],
+             'data': {'main': bool([association for association in rt.associations if association.main]),
+                      'routes': [(route.destination_cidr_block, route.gateway_id or route.instance_id or route.interface_id)
+                                 for route in rt.routes]}}
+            for rt in ocb.fcu.get_all_route_tables(filters=filters)]
+
+
+def _security_groups(ocb, filters):
+    return [{'id': group.id, 'vpc_id': group.vpc_id, 'name': group.name, 'tags': _tags(group),
+             'links': [('source_group', grant.group_id) for rule in group.rules for grant in rule.grants if grant.group_id],
+             'data': {'description': group.description,
+                      'rules': [(rule.ip_protocol, rule.from_port, rule.to_port, [str(grant) for grant in rule.grants])
+                                for rule in group.rules]}}
+            for group in ocb.fcu.get_all_security_groups(filters=filters)]
+
+
+def _instances(ocb, filters):
+    return [{'id': instance.id, 'vpc_id': instance.vpc_id, 'subnet_id': instance.subnet_id, 'state': instance.state,
+             'name': _tags(instance).get('Name'), 'tags': _tags(instance),
+             'links': [('security_group', group.id) for group in instance.groups],
+             'data': {'instance_type': instance.instance_type, 'private_ip_address': instance.private_ip_address,
+                      'ip_address': instance.ip_address, 'image_id': instance.image_id, 'key_name': instance.key_name}}
+            for instance in ocb.fcu.get_only_instances(filters=filters)]
+
+
+def _addresses(ocb, filters):
+    return [{'id': address.allocation_id or address.public_ip,
+             'links': ([('instance', address.instance_id)] if address.instance_id else []) +
+                      ([('network_interface', address.network_interface_id)] if address.network_interface_id else []),
+             'data': {'public_ip': address.public_ip, 'association_id': address.association_id,
+                      'private_ip_address': address.private_ip_address}}
+            for address in ocb.fcu.get_all_addresses(filters=filters)]
+
+
+def _internet_gateways(ocb, filters):
+    return [{'id': gw.id, 'vpc_id': gw.attachments[0].vpc_id if gw.attachments else None, 'tags': _tags(gw), 'data': {}}
+            for gw in ocb.fcu.get_all_internet_gateways(filters=filters)]
+
+
+def _nat_gateways(ocb, filters):
+    params = {}
+    if filters:
+        ocb.fcu.build_filter_params(params, filters)
+    with ocb.fcu.api_version(ocb.fcu.NatGatewayAPIVersion):
+        nat_gws = ocb.fcu.get_list('DescribeNatGateways', params, [('item', EC2Object)])
+    return [{'id': nat_gw.natGatewayId, 'vpc_id': getattr(nat_gw, 'vpcId', None), 'subnet_id': getattr(nat_gw, 'subnetId', None),
+             'state': getattr(nat_gw, 'state', None),
+             'links': [('address', nat_gw.allocationId)] if getattr(nat_gw, 'allocationId', None) else [],
+             'data': {'public_ip': getattr(nat_gw, 'publicIp', None)}}
+            for nat_gw in nat_gws]
+
+
+def _network_interfaces(ocb, filters):
+    return [{'id': nic.id, 'vpc_id': nic.vpc_id, 'subnet_id': nic.subnet_id, 'state': nic.status, 'tags': _tags(nic),
+             'links': [('instance', nic.attachment.instance_id)] if nic.attachment and nic.attachment.instance_id else [],
+             'data': {'private_ip_address': nic.private_ip_address}}
+            for nic in ocb.fcu.get_all_network_interfaces(filters=filters)]
+
+
+def _load_balancers(ocb, filters):
+    if not ocb.lbu:
+        return []
+    return [{'id': lb.name, 'name': lb.name, 'vpc_id': getattr(lb, 'vpc_id', None),
+             'links': [('subnet', subnet) for subnet in lb.subnets] +
+                      [('instance', instance.id) for instance in lb.instances] +
+                      [('security_group', group) for group in lb.security_groups],
+             'data': {'dns_name': lb.dns_name, 'scheme': lb.scheme}}
+            for lb in ocb.lbu.get_all_load_balancers()]
+
+
+# kind -> function describing the ressources of the kind, called with the connections and FCU filters.
+# Kinds are stored in this order: kinds without VPC filter come last, their VPC is found through
+# the ressources they link to, which are stored before them
+KINDS = OrderedDict([
+    ('vpc', _vpcs),
+    ('subnet', _subnets),
+    ('route_table', _route_tables),
+    ('security_group', _security_groups),
+    ('instance', _instances),
+    ('internet_gateway', _internet_gateways),
+    ('nat_gateway', _nat_gateways),
+    ('network_interface', _network_interfaces),
+    ('address', _addresses),
+    ('load_balancer', _load_balancers),
+])
+
+# kinds which can be refreshed for a single VPC with a vpc-id filter
+VPC_FILTERS = {
+    'vpc': 'vpc-id',
+    'subnet': 'vpc-id',
+    'route_table': 'vpc-id',
+    'security_group': 'vpc-id',
+    'instance': 'vpc-id',
+    'internet_gateway': 'attachment.vpc-id',
+    'nat_gateway': 'vpc-id',
+    'network_interface': 'vpc-id',
+}
+
+
+def _digest(ressource):
+    return hashlib.sha1(json.dumps(ressource, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Inventory(object):
+    """
+    SQLite snapshot of the ressources of one account
+    """
+
+    def __init__(self, path=':memory:', ocb=None, max_workers=8):
+        """
+        :param path: SQLite database, one per account
+        :type path: str
+        :param ocb: connections of the account, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :param max_workers: maximum number of describe calls at once during a refresh
+        :type max_workers: int
+        """
+        self.path = os.path.expanduser(path)
+        self.ocb = ocb or OCBase()
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            for statement in SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+
+    def __repr__(self):
+        return 'Inventory:{0}'.format(self.path)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def refreshed(self, kind):
+        """
+        :return: time of the last full refresh of kind, None if never refreshed
+        :rtype: float
+        """
+        with self._lock:
+            row = self._db.execute('SELECT refreshed FROM refreshes WHERE kind = ?', (kind,)).fetchone()
+        return row[0] if row else None
+
+    def refresh(self, kinds=None, vpc_id=None, max_age=0):
+        """
+        Describe ressources and store the changes
+        :param kinds: kinds to refresh, all KINDS if None
+        :type kinds: list
+        :param vpc_id: only refresh the ressources of this VPC
+        :type vpc_id: str
+        :param max_age: skip kinds refreshed less than max_age seconds ago (full refreshes only)
+        :type max_age: float
+        :return: number of added, updated and removed ressources
+        :rtype: dict
+        :raises OCBError: when a kind is unknown
+        """
+        kinds = list(kinds or KINDS)
+        unknown = [kind for kind in kinds if kind not in KINDS]
+        if unknown:
+            raise OCBError('Unknown inventory kinds {0}'.format(unknown))
+        kinds = [kind for kind in KINDS if kind in kinds]
+        now = time.time()
+        if vpc_id is None and max_age:
+            kinds = [kind for kind in kinds if (self.refreshed(kind) or 0) < now - max_age]
+        counts = {'added': 0, 'updated': 0, 'removed': 0}
+        if not kinds:
+            return counts
+
+        def describe(kind):
+            filters = None
+            if vpc_id is not None and kind in VPC_FILTERS:
+                filters = {VPC_FILTERS[kind]: vpc_id}
+            return KINDS[kind](self.ocb, filters)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = dict((kind, executor.submit(describe, kind)) for kind in kinds)
+            described = dict((kind, future.result()) for kind, future in futures.items())
+        finally:
+            executor.shutdown(wait=True)
+
+        with self._lock:
+            try:
+                for kind in kinds:
+                    self._store(kind, described[kind], vpc_id, now, counts,
+                                unfiltered=vpc_id is not None and kind not in VPC_FILTERS)
+                    if vpc_id is None:
+                        self._db.execute('INSERT OR REPLACE INTO refreshes (kind, refreshed) VALUES (?, ?)', (kind, now))
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        return counts
+
+    def _in_vpc(self, ressource, vpc_id):
+        if ressource.get('vpc_id') == vpc_id:
+            return True
+        targets = [target for _, target in ressource.get('links', [])]
+        if not targets:
+            return False
+        query = 'SELECT 1 FROM ressources WHERE vpc_id = ? AND id IN ({0}) LIMIT 1'.format(','.join('?' * len(targets)))
+        return self._db.execute(query, [vpc_id] + targets).fetchone() is not None
+
+    def _store(self, kind, ressources, vpc_id, now, counts, unfiltered=False):
+        if vpc_id is None:
+            rows = self._db.execute('SELECT id, digest FROM ressources WHERE kind = ?', (kind,))
+        else:
+            rows = self._db.execute(SELECT_VPC_IDS, (kind, vpc_id, vpc_id))
+        known = dict(rows.fetchall())
+        if unfiltered:
+            # not filtered by the API, relations are only known once stored: keep the ressources of the VPC,
+            # and update the known ones which left it instead of removing them
+            ressources = [ressource for ressource in ressources
+                          if ressource['id'] in known or self._in_vpc(ressource, vpc_id)]
+        for ressource in ressources:
+            digest = _digest(ressource)
+            previous = known.pop(ressource['id'], None)
+            if previous == digest:
+                continue
+            counts['updated' if previous else 'added'] += 1
+            self._db.execute('INSERT OR REPLACE INTO ressources (id, kind, vpc_id, subnet_id, state, name, data, digest, refreshed)'
+                             ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (ressource['id'], kind, ressource.get('vpc_id'), ressource.get('subnet_id'),
+                              ressource.get('state'), ressource.get('name'),
+                              json.dumps(ressource.get('data', {}), default=str), digest, now))
+            self._db.execute('DELETE FROM tags WHERE ressource_id = ?', (ressource['id'],))
+            self._db.executemany('INSERT INTO tags (ressource_id, key, value) VALUES (?, ?, ?)',
+                                 [(ressource['id'], key, value) for key, value in ressource.get('tags', {}).items()])
+            self._db.execute('DELETE FROM links WHERE ressource_id = ?', (ressource['id'],))
+            self._db.executemany('INSERT INTO links (ressource_id, relation, target_id) VALUES (?, ?, ?)',
+                                 [(ressource['id'], relation, target) for relation, target in ressource.get('links', [])])
+        for ressource_id in known:
+            counts['removed'] += 1
+            for table, column in (('ressources', 'id'), ('tags', 'ressource_id'), ('links', 'ressource_id')):
+                self._db.execute('DELETE FROM {0} WHERE {1} = ?'.format(table, column), (ressource_id,))
+
+    def _rows(self, rows):
+        ressources = []
+        for ressource_id, kind, vpc_id, subnet_id, state, name, data in rows:
+            ressources.append({'id': ressource_id, 'kind': kind, 'vpc_id': vpc_id, 'subnet_id': subnet_id,
+                               'state': state, 'name': name, 'data': json.loads(data) if data else {}})
+        if ressources:
+            by_id = dict((ressource['id'], ressource) for ressource in ressources)
+            for ressource in ressources:
+                ressource['tags'] = {}
+                ressource['links'] = []
+            marks = ','.join('?' * len(by_id))
+            for ressource_id, key, value in self._db.execute(
+                    'SELECT ressource_id, key, value FROM tags WHERE ressource_id IN ({0})'.format(marks), list(by_id)):
+                by_id[ressource_id]['tags'][key] = value
+            for ressource_id, relation, target in self._db.execute(
+                    'SELECT ressource_id, relation, target_id FROM links WHERE ressource_id IN ({0})'.format(marks), list(by_id)):
+                by_id[ressource_id]['links'].append((relation, target))
+        return ressources
+
+    def get(self, ressource_id):
+        """
+        :return: the ressource as a dict (id, kind, vpc_id, subnet_id, state, name, data, tags, links), None if unknown
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT id, kind, vpc_id, subnet_id, state, name, data FROM ressources WHERE id = ?',
+                                    (ressource_id,)).fetchall()
+            ressources = self._rows(rows)
+        return ressources[0] if ressources else None
+
+    def find(self, kind=None, vpc_id=None, subnet_id=None, state=None, tags=None, linked_to=None):
+        """
+        Query stored ressources, all criteria must match
+        :param kind: one of KINDS
+        :type kind: str
+        :param vpc_id: ressources in the VPC, or linked to a ressource in the VPC (load balancers through their subnets...)
+        :type vpc_id: str
+        :param subnet_id: ressources in the subnet, or linked to it
+        :type subnet_id: str
+        :param state: ressource state
+        :type state: str
+        :param tags: tag key -> value, None value matches any value
+        :type tags: dict
+        :param linked_to: ressources linked to this ressource id (instances of a security group...)
+        :type linked_to: str
+        :return: ressources as dicts, see get()
+        :rtype: list
+        """
+        clauses = []
+        values = []
+        if kind is not None:
+            clauses.append('kind = ?')
+            values.append(kind)
+        if vpc_id is not None:
+            clauses.append('(vpc_id = ? OR id IN (SELECT links.ressource_id FROM links JOIN ressources AS target'
+                           ' ON target.id = links.target_id WHERE target.vpc_id = ?))')
+            values.extend([vpc_id, vpc_id])
+        if subnet_id is not None:
+            clauses.append('(subnet_id = ? OR id IN (SELECT ressource_id FROM links WHERE target_id = ?))')
+            values.extend([subnet_id, subnet_id])
+        if state is not None:
+            clauses.append('state = ?')
+            values.append(state)
+        for key, value in (tags or {}).items():
+            if value is None:
+                clauses.append('id IN (SELECT ressource_id FROM tags WHERE key = ?)')
+                values.append(key)
+            else:
+                clauses.append('id IN (SELECT ressource_id FROM tags WHERE key = ? AND value = ?)')
+                values.extend([key, value])
+        if linked_to is not None:
+            clauses.append('id IN (SELECT ressource_id FROM links WHERE target_id = ?)')
+            values.append(linked_to)
+        query = 'SELECT id, kind, vpc_id, subnet_id, state, name, data FROM ressources'
+        if clauses:
+            query = '{0} WHERE {1}'.format(query, ' AND '.join(clauses))
+        with self._lock:
+            return self._rows(self._db.execute(query, values).fetchall())
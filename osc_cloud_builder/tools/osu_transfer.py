@@ -0,0 +1,331 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Parallel transfers of large files to and from OSU.
+
+Uploads are multipart uploads whose parts are sent by several threads, straight
+from a memory-mapped file. Downloads are ranged GETs written by several threads
+into a memory-mapped file. Both can keep their progress in a JSON manifest: a
+transfer started again with the same manifest only sends or fetches the missing parts.
+
+    transfer = OSUTransfer(part_size=64 * MB, max_workers=8)
+    transfer.upload('/data/image.qcow2', 'images', 'image.qcow2', manifest_path='/data/image.qcow2.upload')
+    transfer.download('images', 'image.qcow2', '/data/copy.qcow2', manifest_path='/data/copy.qcow2.download')
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import json
+import mmap
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+MB = 1024 * 1024
+# smallest part accepted by OSU, except for the last part
+MIN_PART_SIZE = 5 * MB
+DEFAULT_PART_SIZE = 64 * MB
+# bytes read from a ranged GET response at once
+READ_SIZE = MB
+
+MANIFEST_VERSION = 1
+
+
+class MappedPart(object):
+    """
+    Read only file object over a slice of a mmap, boto reads it in small chunks
+    """
+
+    def __init__(self, mapped, start, size):
+        """
+        :param mapped: memory-mapped file
+        :type mapped: mmap.mmap
+        :param start: offset of the part
+        :type start: int
+        :param size: size of the part
+        :type size: int
+        """
+        self.mapped = mapped
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        chunk = self.mapped[self.start + self.position:self.start + self.position + size]
+        self.position += size
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+
+def _parts(size, part_size):
+    """
+    :return list: (part number, offset, size) of a file, part numbers start at 1
+    """
+    return [(index + 1, offset, min(part_size, size - offset))
+            for index, offset in enumerate(range(0, size, part_size))]
+
+
+class Manifest(object):
+    """
+    Progress of a transfer, saved as JSON after each part
+    """
+
+    def __init__(self, path, identity):
+        """
+        :param path: manifest file, no manifest is written if None
+        :type path: str
+        :param identity: what is transferred, a saved manifest with another identity is ignored
+        :type identity: dict
+        """
+        self.path = path
+        self.identity = identity
+        self.state = {}
+        self.done = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as manifest_file:
+                saved = json.load(manifest_file)
+            if saved.get('version') == MANIFEST_VERSION and saved.get('identity') == identity:
+                self.state = saved['state']
+                self.done = dict((int(number), value) for number, value in saved['done'].items())
+
+    def __repr__(self):
+        return 'Manifest:{0}:{1}'.format(self.path, len(self.done))
+
+    def save(self):
+        """
+        Write the manifest, atomically
+        """
+        if not self.path:
+            return
+        with self._lock:
+            content = {'version': MANIFEST_VERSION, 'identity': self.identity, 'state': self.state, 'done': self.done}
+            descriptor, path = tempfile.mkstemp(prefix='.osu-transfer-', dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(descriptor, 'w') as manifest_file:
+                json.dump(content, manifest_file)
+            os.rename(path, self.path)
+
+    def mark(self, number, value):
+        with self._lock:
+            self.done[number] = value
+        self.save()
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class OSUTransfer(object):
+    """
+    Multipart uploads and ranged downloads with parallel parts
+    """
+
+    def __init__(self, ocb=None, part_size=DEFAULT_PART_SIZE, max_workers=8):
+        """
+        :param ocb: connections, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :param part_size: bytes per part, at least MIN_PART_SIZE
+        :type part_size: int
+        :param max_workers: parts transferred at once
+        :type max_workers: int
+        :raises OCBError: when part_size is too small
+        """
+        if part_size < MIN_PART_SIZE:
+            raise OCBError('Part size must be at least {0} bytes'.format(MIN_PART_SIZE))
+        self.ocb = ocb or OCBase()
+        self.part_size = part_size
+        self.max_workers = max_workers
+
+    def __repr__(self):
+        return 'OSUTransfer:{0}x{1}'.format(self.max_workers, self.part_size)
+
+    def _bucket(self, bucket_name):
+        # connections are per thread, so is the bucket
+        return self.ocb.osu.get_bucket(bucket_name, validate=False)
+
+    def _run(self, function, parts, description):
+        failed = []
+        if parts:
+            executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(parts)))
+            try:
+                futures = [(part, executor.submit(function, *part)) for part in parts]
+                for part, future in futures:
+                    try:
+                        future.result()
+                    except Exception as err:
+                        self.ocb.log('Part {0} of {1} failed: {2}'.format(part[0], description, err), 'error', __file__)
+                        failed.append(part[0])
+            finally:
+                executor.shutdown(wait=True)
+        if failed:
+            raise OCBError('Parts {0} of {1} failed, start again with the same manifest to resume'.format(failed, description))
+
+    def upload(self, path, bucket_name, key_name, manifest_path=None, headers=None):
+        """
+        Upload a file, with a multipart upload if it is larger than part_size
+        :param path: file to upload
+        :type path: str
+        :param bucket_name: destination bucket
+        :type bucket_name: str
+        :param key_name: destination key
+        :type key_name: str
+        :param manifest_path: where progress is kept to resume the upload, removed once completed
+        :type manifest_path: str
+        :param headers: headers of the object (Content-Type...)
+        :type headers: dict
+        :return: ETag of the uploaded object
+        :rtype: str
+        :raises OCBError: when parts failed, the multipart upload is left open to be resumed
+        """
+        stat = os.stat(path)
+        description = '{0} to {1}/{2}'.format(path, bucket_name, key_name)
+        if stat.st_size <= self.part_size:
+            key = self._bucket(bucket_name).new_key(key_name)
+            key.set_contents_from_filename(path, headers=headers)
+            return key.etag
+
+        manifest = Manifest(manifest_path, {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                            'bucket': bucket_name, 'key': key_name, 'part_size': self.part_size})
+        upload = None
+        if manifest.state.get('upload_id'):
+            upload = MultiPartUpload(self._bucket(bucket_name))
+            upload.key_name = key_name
+            upload.id = manifest.state['upload_id']
+            try:
+                uploaded = dict((part.part_number, part.etag) for part in upload)
+            except S3ResponseError as err:
+                if err.status != 404:
+                    raise
+                self.ocb.log('Upload {0} of {1} is gone, starting again'.format(upload.id, description), 'warning', __file__)
+                upload = None
+            else:
+                # parts listed in the manifest but not found by OSU are sent again
+                manifest.done = dict((number, etag) for number, etag in manifest.done.items() if uploaded.get(number) == etag)
+        if upload is None:
+            upload = self._bucket(bucket_name).initiate_multipart_upload(key_name, headers=headers)
+            manifest.state = {'upload_id': upload.id}
+            manifest.done = {}
+            manifest.save()
+        self.ocb.log('Uploading {0} with {1}, {2} parts done'.format(description, upload.id, len(manifest.done)), 'info', __file__)
+
+        with open(path, 'rb') as source:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                def send(number, offset, size):
+                    part_upload = MultiPartUpload(self._bucket(bucket_name))
+                    part_upload.key_name = key_name
+                    part_upload.id = upload.id
+                    key = part_upload.upload_part_from_file(MappedPart(mapped, offset, size), number, size=size)
+                    manifest.mark(number, key.etag)
+
+                missing = [part for part in _parts(stat.st_size, self.part_size) if part[0] not in manifest.done]
+                self._run(send, missing, description)
+            finally:
+                mapped.close()
+
+        completed = upload.complete_upload()
+        manifest.remove()
+        return completed.etag
+
+    def download(self, bucket_name, key_name, path, manifest_path=None):
+        """
+        Download an object with ranged GETs of part_size bytes
+        :param bucket_name: source bucket
+        :type bucket_name: str
+        :param key_name: source key
+        :type key_name: str
+        :param path: destination file, overwritten
+        :type path: str
+        :param manifest_path: where progress is kept to resume the download, removed once completed
+        :type manifest_path: str
+        :return: path
+        :rtype: str
+        :raises OCBError: when the object is not found or parts failed
+        """
+        description = '{0}/{1} to {2}'.format(bucket_name, key_name, path)
+        key = self._bucket(bucket_name).get_key(key_name)
+        if key is None:
+            raise OCBError('Object {0}/{1} not found'.format(bucket_name, key_name))
+        size = int(key.size)
+        manifest = Manifest(manifest_path, {'bucket': bucket_name, 'key': key_name, 'etag': key.etag, 'size': size,
+                                            'path': os.path.abspath(path), 'part_size': self.part_size})
+        if manifest.done and (not os.path.exists(path) or os.path.getsize(path) != size):
+            manifest.done = {}
+        with open(path, 'r+b' if manifest.done else 'w+b') as destination:
+            destination.truncate(size)
+            if not size:
+                manifest.remove()
+                return path
+            mapped = mmap.mmap(destination.fileno(), size, access=mmap.ACCESS_WRITE)
+            try:
+                def fetch(number, offset, part_size):
+                    last = offset + part_size - 1
+                    response = self.ocb.osu.make_request('GET', bucket_name, key_name,
+                                                         headers={'Range': 'bytes={0}-{1}'.format(offset, last)})
+                    if response.status not in (200, 206):
+                        raise self.ocb.osu.provider.storage_response_error(response.status, response.reason, response.read())
+                    if response.status == 200 and offset:
+                        raise OCBError('Range of part {0} of {1} ignored by OSU'.format(number, description))
+                    position = offset
+                    while position <= last:
+                        chunk = response.read(min(READ_SIZE, last + 1 - position))
+                        if not chunk:
+                            raise OCBError('Part {0} of {1} truncated at {2}'.format(number, description, position))
+                        mapped[position:position + len(chunk)] = chunk
+                        position += len(chunk)
+                    response.close()
+                    manifest.mark(number, True)
+
+                missing = [part for part in _parts(size, self.part_size) if part[0] not in manifest.done]
+                self.ocb.log('Downloading {0}, {1} parts to fetch'.format(description, len(missing)), 'info', __file__)
+                self._run(fetch, missing, description)
+                mapped.flush()
+            finally:
+                mapped.close()
+        manifest.remove()
+        return path
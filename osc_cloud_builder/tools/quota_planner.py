@@ -0,0 +1,341 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Pre-flight quota checks and local reservations of quota capacity.
+
+Quotas are read once by DescribeQuotas and indexed by name and reference. A
+provisioning plan, quota name -> number of ressources to create, is checked in
+memory against them before any mutating call. Capacity is reserved while a job
+provisions, so concurrent jobs can not go past the limits together: reservations
+are shared by the threads of the process, and with a ledger file by all the
+processes of the host (the file is locked with fcntl).
+
+    planner = QuotaPlanner(ledger_path='~/.osc_cloud_builder/quotas.json')
+    with planner.reserve({'vm_limit': 20, 'eip_limit': 2}) as reservation:
+        reservation.created = True
+        provision()
+
+Quotas unknown to the account are not checked. Once a job created its ressources,
+its reservation still counts until the quotas are read again, as the used values
+read before do not include them.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import threading
+from collections import namedtuple
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+GLOBAL = 'global'
+# quota names of the ressources created by the samples and tools, as returned by DescribeQuotas
+INSTANCES = 'vm_limit'
+ADDRESSES = 'eip_limit'
+VPCS = 'vpc_limit'
+SUBNETS = 'subnet_limit'
+SECURITY_GROUPS = 'security_group_limit'
+INTERNET_GATEWAYS = 'igw_limit'
+NAT_GATEWAYS = 'nat_gateway_limit'
+LOAD_BALANCERS = 'lbu_limit'
+
+
+Shortfall = namedtuple('Shortfall', ['name', 'reference', 'requested', 'available'])
+
+
+def _key(name, reference=GLOBAL):
+    return '{0}|{1}'.format(name, reference)
+
+
+def normalize(plan):
+    """
+    :param plan: quota name or (quota name, reference) -> number of ressources, the reference is global for a name
+    :type plan: dict
+    :return: 'name|reference' -> number of ressources, without empty entries
+    :rtype: dict
+    """
+    amounts = {}
+    for quota, amount in plan.items():
+        name, reference = quota if isinstance(quota, tuple) else (quota, GLOBAL)
+        if amount:
+            amounts[_key(name, reference)] = amounts.get(_key(name, reference), 0) + amount
+    return amounts
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class MemoryLedger(object):
+    """
+    Reservations of the process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def __repr__(self):
+        return 'MemoryLedger:{0}'.format(len(self._entries))
+
+    def _load(self):
+        return self._entries
+
+    def _store(self, entries):
+        self._entries = entries
+
+    def transaction(self, update):
+        """
+        :param update: called with the reservations, reservation ID -> entry, changes them in place
+        :type update: callable
+        :return: result of update
+        """
+        with self._lock:
+            entries = self._load()
+            result = update(entries)
+            self._store(entries)
+            return result
+
+
+class FileLedger(MemoryLedger):
+    """
+    Reservations of all processes of the host, kept in a JSON file locked by fcntl
+    """
+
+    def __init__(self, path):
+        """
+        :param path: ledger file, created if missing
+        :type path: str
+        """
+        super(FileLedger, self).__init__()
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __repr__(self):
+        return 'FileLedger:{0}'.format(self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as ledger_file:
+                return json.load(ledger_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _store(self, entries):
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as ledger_file:
+            json.dump(entries, ledger_file)
+        os.rename(tmp_path, self.path)
+
+    def transaction(self, update):
+        with self._lock:
+            with open('{0}.lock'.format(self.path), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    entries = self._load()
+                    result = update(entries)
+                    self._store(entries)
+                    return result
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class Reservation(object):
+    """
+    Capacity reserved by a job, release it when the job is done.
+    Set created once the job started creating ressources: a job failing before is released unconsumed.
+    """
+
+    def __init__(self, planner, reservation_id, amounts):
+        self.planner = planner
+        self.id = reservation_id
+        self.amounts = amounts
+        self.created = False
+        self.released = False
+
+    def __repr__(self):
+        return 'Reservation:{0}:{1}'.format(self.id, self.amounts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # ressources may have been created before a failure
+        self.release(consumed=exc_type is None or self.created)
+
+    def release(self, consumed=True):
+        """
+        :param consumed: the ressources were created, the reservation counts until the quotas are read again
+        :type consumed: bool
+        """
+        if not self.released:
+            self.planner._release(self, consumed)
+            self.released = True
+
+
+class QuotaPlanner(object):
+    """
+    Quotas of an account and reservations of their capacity, see the module documentation
+    """
+
+    def __init__(self, ocb=None, ledger_path=None, reservation_ttl=3600, consumed_ttl=900):
+        """
+        :param ocb: connections of the account, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :param ledger_path: file of the reservations shared by the processes of the host, reservations of
+                            this process only if None. Use one file per account.
+        :type ledger_path: str
+        :param reservation_ttl: seconds a reservation is kept if its job never releases it
+        :type reservation_ttl: float
+        :param consumed_ttl: seconds a consumed reservation is kept for the processes which do not read the quotas again
+        :type consumed_ttl: float
+        """
+        self.ocb = ocb or OCBase()
+        self.ledger = FileLedger(ledger_path) if ledger_path else MemoryLedger()
+        self.reservation_ttl = reservation_ttl
+        self.consumed_ttl = consumed_ttl
+        self.quotas = {}
+        self.refreshed = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'QuotaPlanner:{0}:{1}'.format(len(self.quotas), self.ledger)
+
+    def refresh(self):
+        """
+        Read all quotas of the account
+        """
+        started = time.time()
+        quotas = {}
+        for reference in self.ocb.fcu.iter_quotas(compact=True):
+            for quota in reference.quotas:
+                quotas[_key(quota.name, reference.reference or GLOBAL)] = quota
+        with self._lock:
+            self.quotas = quotas
+            self.refreshed = started
+        self.ocb.log('{0} quotas read'.format(len(quotas)), 'debug', __file__)
+
+    def quota(self, name, reference=GLOBAL):
+        """
+        :return: quota, None if unknown
+        :rtype: osc_cloud_builder.vendor.outscale.fcu.records.QuotaRecord
+        """
+        if self.refreshed is None:
+            self.refresh()
+        return self.quotas.get(_key(name, reference))
+
+    def _reserved(self, entries, now):
+        """
+        :return: 'name|reference' -> capacity reserved, outdated entries are removed from entries
+        :rtype: dict
+        """
+        reserved = {}
+        for reservation_id, entry in list(entries.items()):
+            if entry['expires'] < now or (entry['released'] is None and not _alive(entry['pid'])):
+                del entries[reservation_id]
+                continue
+            if entry['released'] is not None and self.refreshed is not None and entry['released'] < self.refreshed:
+                # the quotas read since include these ressources
+                continue
+            for key, amount in entry['amounts'].items():
+                reserved[key] = reserved.get(key, 0) + amount
+        return reserved
+
+    def _shortfalls(self, amounts, reserved):
+        shortfalls = []
+        for key, amount in sorted(amounts.items()):
+            quota = self.quotas.get(key)
+            if quota is None or quota.max_quota_value is None:
+                continue
+            available = quota.max_quota_value - (quota.used_quota_value or 0) - reserved.get(key, 0)
+            if amount > available:
+                name, _, reference = key.partition('|')
+                shortfalls.append(Shortfall(name, reference, amount, max(available, 0)))
+        return shortfalls
+
+    def check(self, plan):
+        """
+        :param plan: quota name or (quota name, reference) -> number of ressources to create
+        :type plan: dict
+        :return: quotas the plan would exceed, with the reservations of other jobs
+        :rtype: list
+        """
+        if self.refreshed is None:
+            self.refresh()
+        amounts = normalize(plan)
+        return self.ledger.transaction(lambda entries: self._shortfalls(amounts, self._reserved(entries, time.time())))
+
+    def reserve(self, plan):
+        """
+        Check a plan and reserve its capacity at once
+        :param plan: quota name or (quota name, reference) -> number of ressources to create
+        :type plan: dict
+        :return: reservation, to be released when the ressources are created
+        :rtype: Reservation
+        :raises OCBError: when the plan exceeds a quota
+        """
+        if self.refreshed is None:
+            self.refresh()
+        amounts = normalize(plan)
+        reservation_id = uuid.uuid4().hex
+
+        def update(entries):
+            now = time.time()
+            shortfalls = self._shortfalls(amounts, self._reserved(entries, now))
+            if not shortfalls:
+                entries[reservation_id] = {'pid': os.getpid(), 'expires': now + self.reservation_ttl,
+                                           'amounts': amounts, 'released': None}
+            return shortfalls
+
+        shortfalls = self.ledger.transaction(update)
+        if shortfalls:
+            raise OCBError('Quotas exceeded: {0}'.format(', '.join(
+                ['{0} ({1}) needs {2}, {3} available'.format(*shortfall) for shortfall in shortfalls])))
+        return Reservation(self, reservation_id, amounts)
+
+    def _release(self, reservation, consumed):
+        def update(entries):
+            entry = entries.get(reservation.id)
+            if entry is None:
+                return
+            if consumed:
+                entry['released'] = time.time()
+                entry['expires'] = entry['released'] + self.consumed_ttl
+            else:
+                del entries[reservation.id]
+        self.ledger.transaction(update)
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Run a command on many instances at once over SSH.
+
+Private instances are reached through the bouncer of the VPC: one SSH connection to
+the bouncer is kept open and the connection to each instance is a direct-tcpip channel
+of it, like ssh -J. Connections to the instances are kept for the next commands.
+At most max_workers hosts run the command at the same time, their output is given line
+by line to a callback as it arrives.
+
+Requirements:
+    pip install osc_cloud_builder[ssh]
+
+    with SSHFanout('/tmp/keytest.rsa.d/key.pem', user='outscale', bouncer=instance_bouncer.ip_address) as fanout:
+        for result in fanout.run([instance.private_ip_address for instance in instances], 'uptime'):
+            print result.host, result.exit_status, result.stdout
+
+Hosts are addresses or address:port, so the module can be tried against local sshd containers
+or osc_cloud_builder.benchmark.ssh_server.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import time
+import random
+import select
+import socket
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import paramiko
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+READ_SIZE = 32768
+
+
+HostResult = namedtuple('HostResult', ['host', 'exit_status', 'stdout', 'stderr', 'error', 'duration'])
+
+
+def split_host(host, default_port=22):
+    """
+    :param host: address, address:port, [IPv6 address] or [IPv6 address]:port
+    :type host: str
+    :return: (address, port)
+    :rtype: tuple
+    """
+    if host.startswith('['):
+        address, _, port = host[1:].partition(']')
+        return address, int(port[1:]) if port.startswith(':') else default_port
+    if host.count(':') != 1:
+        # a bare IPv6 address has no port
+        return host, default_port
+    address, _, port = host.partition(':')
+    return address, int(port)
+
+
+class _Lines(object):
+    """
+    Output of a stream, given line by line to a callback
+    """
+
+    def __init__(self, host, name, callback):
+        self.host = host
+        self.name = name
+        self.callback = callback
+        self.chunks = []
+        self._partial = ''
+
+    def feed(self, data):
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        self.chunks.append(data)
+        if self.callback is None:
+            return
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.callback(self.host, self.name, line)
+
+    def close(self):
+        if self.callback is not None and self._partial:
+            self.callback(self.host, self.name, self._partial)
+        self._partial = ''
+        return ''.join(self.chunks)
+
+
+class SSHFanout(object):
+    """
+    SSH connections to many hosts, directly or through a bouncer, see the module documentation
+    """
+
+    def __init__(self, key_filename=None, user='root', bouncer=None, bouncer_user=None, max_workers=32,
+                 connect_timeout=10, connection_attempts=10, host_key_policy=None, output=None, ocb=None):
+        """
+        :param key_filename: private key, the SSH agent and the default keys are also tried
+        :type key_filename: str
+        :param user: user on the hosts
+        :type user: str
+        :param bouncer: address or address:port of the jump host, hosts are reached directly if None
+        :type bouncer: str
+        :param bouncer_user: user on the bouncer, user if None
+        :type bouncer_user: str
+        :param max_workers: maximum number of hosts running a command at the same time
+        :type max_workers: int
+        :param connect_timeout: seconds to open a connection
+        :type connect_timeout: float
+        :param connection_attempts: attempts to connect to a host, instances just started refuse connections for a while
+        :type connection_attempts: int
+        :param host_key_policy: policy for unknown host keys, unknown keys are accepted if None
+        :type host_key_policy: paramiko.MissingHostKeyPolicy
+        :param output: called with (host, 'stdout' or 'stderr', line) for each line of output, as it arrives
+        :type output: callable
+        :param ocb: used for logs, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        """
+        self.key_filename = key_filename
+        self.user = user
+        self.bouncer = bouncer
+        self.bouncer_user = bouncer_user or user
+        self.max_workers = max_workers
+        self.connect_timeout = connect_timeout
+        self.connection_attempts = connection_attempts
+        self.host_key_policy = host_key_policy or paramiko.AutoAddPolicy()
+        self.output = output
+        self.ocb = ocb or OCBase()
+        self._jump = None
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+    def __repr__(self):
+        return 'SSHFanout:{0}:{1}'.format(self.bouncer or 'direct', len(self._clients))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self, host, user, sock=None):
+        address, port = split_host(host)
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(self.host_key_policy)
+        client.connect(address, port, username=user, key_filename=self.key_filename, timeout=self.connect_timeout,
+                       banner_timeout=self.connect_timeout, auth_timeout=self.connect_timeout, sock=sock)
+        client.get_transport().set_keepalive(30)
+        return client
+
+    def _attempts(self, description, connect):
+        delay = 1.0
+        for attempt in range(self.connection_attempts):
+            try:
+                return connect()
+            except (socket.error, paramiko.SSHException, EOFError) as err:
+                if isinstance(err, paramiko.AuthenticationException) or attempt + 1 == self.connection_attempts:
+                    raise
+                self.ocb.log('Connection to {0} failed: {1}, retrying'.format(description, err), 'debug', __file__)
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, 10.0)
+
+    def _jump_transport(self):
+        """
+        :return: transport of the bouncer connection, opened or opened again if it was lost
+        :rtype: paramiko.Transport
+        """
+        with self._lock:
+            if self._jump is not None and self._jump.get_transport() is not None and self._jump.get_transport().is_active():
+                return self._jump.get_transport()
+            if self._jump is not None:
+                self._jump.close()
+            self._jump = self._attempts(self.bouncer, lambda: self._connect(self.bouncer, self.bouncer_user))
+            self.ocb.log('Connected to bouncer {0}'.format(self.bouncer), 'debug', __file__)
+            return self._jump.get_transport()
+
+    def client(self, host):
+        """
+        :param host: address or address:port
+        :type host: str
+        :return: connection to the host, kept for the next calls
+        :rtype: paramiko.SSHClient
+        """
+        with self._lock:
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+        with host_lock:
+            client = self._clients.get(host)
+            if client is not None and client.get_transport() is not None and client.get_transport().is_active():
+                return client
+
+            def connect():
+                sock = None
+                if self.bouncer:
+                    sock = self._jump_transport().open_channel('direct-tcpip', split_host(host), ('127.0.0.1', 0),
+                                                               timeout=self.connect_timeout)
+                return self._connect(host, self.user, sock)
+
+            client = self._attempts(host, connect)
+            with self._lock:
+                self._clients[host] = client
+            return client
+
+    def execute(self, host, command, timeout=None):
+        """
+        :param host: address or address:port
+        :type host: str
+        :param command: shell command
+        :type command: str
+        :param timeout: seconds the command may run, no limit if None
+        :type timeout: float
+        :return: exit status and output of the command, error if it could not run
+        :rtype: HostResult
+        """
+        started = time.time()
+        stdout = _Lines(host, 'stdout', self.output)
+        stderr = _Lines(host, 'stderr', self.output)
+        try:
+            channel = self.client(host).get_transport().open_session(timeout=self.connect_timeout)
+        except Exception as err:
+            return HostResult(host, None, '', '', err, time.time() - started)
+        try:
+            channel.exec_command(command)
+            while True:
+                if timeout is not None and time.time() - started > timeout:
+                    raise OCBError('Command timed out after {0}s'.format(timeout))
+                select.select([channel], [], [], 0.5)
+                while channel.recv_ready():
+                    stdout.feed(channel.recv(READ_SIZE))
+                while channel.recv_stderr_ready():
+                    stderr.feed(channel.recv_stderr(READ_SIZE))
+                if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+            return HostResult(host, channel.recv_exit_status(), stdout.close(), stderr.close(), None, time.time() - started)
+        except Exception as err:
+            return HostResult(host, None, stdout.close(), stderr.close(), err, time.time() - started)
+        finally:
+            channel.close()
+
+    def run(self, hosts, command, timeout=None):
+        """
+        Run a command on hosts, max_workers at a time
+        :param hosts: addresses or address:port
+        :type hosts: list
+        :param command: shell command
+        :type command: str
+        :param timeout: seconds the command may run on a host, no limit if None
+        :type timeout: float
+        :return: generator of HostResult, in order of completion
+        :rtype: generator
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = [executor.submit(self.execute, host, command, timeout) for host in sorted(set(hosts))]
+            for future in as_completed(futures):
+                result = future.result()
+                if result.error is not None:
+                    self.ocb.log('{0} on {1} failed: {2}'.format(command, result.host, result.error), 'warning', __file__)
+                yield result
+        finally:
+            executor.shutdown(wait=False)
+
+    def map(self, hosts, command, timeout=None):
+        """
+        Like run() but wait for all hosts
+        :return: HostResult by host
+        :rtype: dict
+        """
+        return dict((result.host, result) for result in self.run(hosts, command, timeout))
+
+    def close(self):
+        """
+        Close the connections to the hosts and to the bouncer
+        """
+        with self._lock:
+            clients, self._clients = self._clients, {}
+            jump, self._jump = self._jump, None
+        for client in clients.values():
+            client.close()
+        if jump is not None:
+            jump.close()
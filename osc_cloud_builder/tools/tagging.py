@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Batched tagging of FCU ressources.
+
+Tag operations are buffered and the ressources getting the same tags are tagged
+by one CreateTags (or DeleteTags) call, chunked to the API limits. Buffered
+operations are sent by a background thread every flush_interval seconds, or as soon
+as a full call is buffered. Calls failing because a ressource just created is not
+visible yet, or because of throttling, are retried with backoff.
+
+    with Tagger(ocb) as tagger:
+        tagger.tag([instance.id for instance in reservation.instances], {'project': 'demo'})
+        tagger.tag([vpc.id], {'Name': 'demo'})
+    # all tags are set here, 2 calls instead of one per ressource
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import time
+import random
+import threading
+from collections import OrderedDict
+from boto.exception import EC2ResponseError
+from osc_cloud_builder.OCBase import OCBase, OCBError
+from osc_cloud_builder.vendor.outscale.throttle import THROTTLING_CODES
+
+# ressources and tags accepted by one CreateTags/DeleteTags call
+MAX_RESSOURCES = 1000
+MAX_TAGS = 50
+DEFAULT_CHUNK_SIZE = 500
+
+
+def _retriable(error):
+    """
+    :param error: error of a tagging call
+    :type error: boto.exception.EC2ResponseError
+    :return: True if the call may succeed later
+    :rtype: bool
+    """
+    code = error.error_code or ''
+    return code.endswith('.NotFound') or code in THROTTLING_CODES or error.status >= 500
+
+
+class Tagger(object):
+    """
+    Buffer of tag operations, flushed as multi-ressource calls.
+    Operations of one ressource are sent in the order they were buffered.
+    """
+
+    def __init__(self, ocb=None, chunk_size=DEFAULT_CHUNK_SIZE, flush_interval=1.0, max_attempts=5, base_delay=1.0):
+        """
+        :param ocb: connections of the account, OCBase() if None
+        :type ocb: OCBase.OCBConnections
+        :param chunk_size: ressources per call, at most MAX_RESSOURCES
+        :type chunk_size: int
+        :param flush_interval: seconds an operation stays buffered, no background thread if None:
+                               operations are only sent by flush()
+        :type flush_interval: float
+        :param max_attempts: attempts of a call before giving up
+        :type max_attempts: int
+        :param base_delay: seconds before the first retry, doubled on each retry
+        :type base_delay: float
+        """
+        self.ocb = ocb or OCBase()
+        self.chunk_size = max(1, min(chunk_size, MAX_RESSOURCES))
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.calls = 0
+        self.operations = 0
+        self.failed = []
+        self._generations = [OrderedDict()]
+        self._touched = {}
+        self._oldest = None
+        self._sending = 0
+        self._flushing = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+        if flush_interval is not None:
+            self._thread = threading.Thread(target=self._run, name='ocb-tagger')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __repr__(self):
+        return 'Tagger:{0}/{1}'.format(self.calls, self.operations)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def pending(self):
+        """
+        :return: number of buffered ressource operations
+        :rtype: int
+        """
+        with self._condition:
+            return self._pending()
+
+    def _pending(self):
+        return sum([len(ids) for generation in self._generations for ids in generation.values()])
+
+    def tag(self, ids, tags):
+        """
+        :param ids: ressources to tag
+        :type ids: list
+        :param tags: tags to set
+        :type tags: dict
+        """
+        self._add('create', ids, tags)
+
+    def untag(self, ids, tags):
+        """
+        :param ids: ressources to untag
+        :type ids: list
+        :param tags: tags to remove, a None value or a list of keys removes the tag whatever its value
+        :type tags: dict or list
+        """
+        if not isinstance(tags, dict):
+            tags = dict((key, None) for key in tags)
+        self._add('delete', ids, tags)
+
+    def _add(self, operation, ids, tags):
+        if not ids or not tags:
+            return
+        key = (operation, tuple(sorted(tags.items())))
+        with self._condition:
+            if self._closed:
+                raise OCBError('Tagger is closed')
+            for ressource_id in ids:
+                # a ressource can not get different operations or values on a tag in one generation,
+                # the order of the calls would not be the order of the operations
+                for tag_key, value in tags.items():
+                    if self._touched.get((ressource_id, tag_key), (operation, value)) != (operation, value):
+                        self._generations.append(OrderedDict())
+                        self._touched = {}
+                        break
+                generation = self._generations[-1]
+                generation.setdefault(key, OrderedDict())[ressource_id] = True
+                for tag_key, value in tags.items():
+                    self._touched[(ressource_id, tag_key)] = (operation, value)
+                self.operations += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._condition.notify_all()
+
+    def _due(self):
+        if self._oldest is None:
+            return self._closed
+        if self._flushing or self._closed:
+            return True
+        if time.time() - self._oldest >= self.flush_interval:
+            return True
+        return max([len(ids) for generation in self._generations for ids in generation.values()]) >= self.chunk_size
+
+    def _take(self):
+        generations = [generation for generation in self._generations if generation]
+        self._generations = [OrderedDict()]
+        self._touched = {}
+        self._oldest = None
+        self._sending += 1
+        return generations
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due():
+                    if self._oldest is None:
+                        self._condition.wait()
+                    else:
+                        self._condition.wait(max(self.flush_interval - (time.time() - self._oldest), 0.01))
+                if self._closed and self._oldest is None:
+                    return
+                generations = self._take()
+            self._send(generations)
+
+    def _send(self, generations):
+        try:
+            for generation in generations:
+                for (operation, tags), ids in generation.items():
+                    ids = list(ids)
+                    for start in range(0, len(ids), self.chunk_size):
+                        for tag_start in range(0, len(tags), MAX_TAGS):
+                            self._call(operation, ids[start:start + self.chunk_size], dict(tags[tag_start:tag_start + MAX_TAGS]))
+        finally:
+            with self._condition:
+                self._sending -= 1
+                self._condition.notify_all()
+
+    def _call(self, operation, ids, tags, attempts=None):
+        attempts = attempts or self.max_attempts
+        function = self.ocb.fcu.create_tags if operation == 'create' else self.ocb.fcu.delete_tags
+        delay = self.base_delay
+        error = None
+        for attempt in range(attempts):
+            try:
+                with self._condition:
+                    self.calls += 1
+                function(ids, tags)
+                return
+            except EC2ResponseError as err:
+                error = err
+                if not _retriable(err):
+                    break
+                if attempt + 1 < attempts:
+                    self.ocb.log('Tagging {0} ressources failed with {1}, retrying in {2:.1f}s'.format(len(ids), err.error_code, delay), 'warning', __file__)
+                    time.sleep(random.uniform(delay / 2, delay))
+                    delay *= 2
+            except Exception as err:
+                error = err
+                break
+        if len(ids) > 1 and (getattr(error, 'error_code', None) or '').endswith('.NotFound'):
+            # one missing ressource fails the whole call, split it to tag the others
+            middle = len(ids) // 2
+            self._call(operation, ids[:middle], tags, 1)
+            self._call(operation, ids[middle:], tags, 1)
+            return
+        self.ocb.log('Tagging {0} ressources failed: {1}'.format(len(ids), error), 'error', __file__, resource_ids=ids)
+        with self._condition:
+            self.failed.extend([(operation, ressource_id, tags, error) for ressource_id in ids])
+
+    def flush(self, timeout=None):
+        """
+        Send all buffered operations and wait for them
+        :param timeout: maximum seconds to wait, no limit if None
+        :type timeout: float
+        :return: True if all operations are sent, False on timeout
+        :rtype: bool
+        :raises OCBError: when some ressources could not be tagged
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            try:
+                while self._oldest is not None or self._sending:
+                    if self._thread is None and self._oldest is not None:
+                        generations = self._take()
+                        self._condition.release()
+                        try:
+                            self._send(generations)
+                        finally:
+                            self._condition.acquire()
+                        continue
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self._flushing = False
+            failed, self.failed = self.failed, []
+        if failed:
+            raise OCBError('Tagging failed on {0}'.format(', '.join(sorted(set([ressource_id for _, ressource_id, _, _ in failed])))))
+        return True
+
+    def close(self, timeout=None):
+        """
+        Flush buffered operations and stop the background thread
+        :param timeout: maximum seconds to wait, no limit if None
+        :type timeout: float
+        :raises OCBError: when some ressources could not be tagged
+        """
+        try:
+            self.flush(timeout)
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            if self._thread is not None:
+                self._thread.join(timeout)
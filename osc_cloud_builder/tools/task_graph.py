@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Outscale SAS
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Run a dependency graph of tasks with a bounded thread pool
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from osc_cloud_builder.OCBase import OCBError
+
+
+class Task(object):
+    """
+    A node of the TaskGraph
+    """
+
+    def __init__(self, name, function=None, args=(), kwargs=None, requires=(), cost=1):
+        """
+        :param name: unique task name
+        :type name: str
+        :param function: callable to run, None for a pure synchronisation task
+        :type function: callable
+        :param args: positional arguments of function
+        :type args: tuple
+        :param kwargs: keyword arguments of function
+        :type kwargs: dict
+        :param requires: names of the tasks to be done before this one
+        :type requires: list
+        :param cost: estimated duration in seconds, used to compute the critical path before run
+        :type cost: float
+        """
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.requires = list(requires)
+        self.cost = cost
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.started = None
+        self.ended = None
+
+    def __repr__(self):
+        return 'Task:{0}:{1}'.format(self.name, self.status)
+
+    @property
+    def duration(self):
+        if self.started is None or self.ended is None:
+            return None
+        return self.ended - self.started
+
+    def run(self):
+        self.started = time.time()
+        try:
+            if self.function:
+                self.result = self.function(*self.args, **self.kwargs)
+        finally:
+            self.ended = time.time()
+        return self.result
+
+
+class TaskGraph(object):
+    """
+    Dependency graph of tasks.
+    Each task starts as soon as all the tasks it requires are done.
+    A task whose requirement failed is skipped.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.order = []
+
+    def add(self, name, function=None, args=(), kwargs=None, requires=(), cost=1):
+        """
+        Add a task to the graph, see Task for parameters
+        :return: the new task
+        :rtype: Task
+        """
+        if name in self.tasks:
+            raise OCBError('Task {0} already exists'.format(name))
+        task = Task(name, function, args, kwargs, requires, cost)
+        self.tasks[name] = task
+        self.order.append(name)
+        return task
+
+    def result(self, name):
+        """
+        :return: result of a task which is done
+        """
+        return self.tasks[name].result
+
+    def levels(self):
+        """
+        Topological sort of the graph
+        :return: list of task names lists, tasks of a level only require tasks of previous levels
+        :rtype: list
+        :raises OCBError: when a requirement is unknown or the graph has a cycle
+        """
+        for task in self.tasks.values():
+            for required in task.requires:
+                if required not in self.tasks:
+                    raise OCBError('Task {0} requires unknown task {1}'.format(task.name, required))
+        remaining = dict((name, set(self.tasks[name].requires)) for name in self.order)
+        levels = []
+        while remaining:
+            level = [name for name in self.order if name in remaining and not remaining[name]]
+            if not level:
+                raise OCBError('Cycle between tasks {0}'.format(sorted(remaining)))
+            for name in level:
+                del remaining[name]
+            for requires in remaining.values():
+                requires.difference_update(level)
+            levels.append(level)
+        return levels
+
+    def critical_path(self, actual=False):
+        """
+        Longest chain of dependent tasks
+        :param actual: weight tasks with their measured duration instead of their estimated cost
+        :type actual: bool
+        :return: length of the path and the tasks names on it
+        :rtype: float, list
+        """
+        longest = {}
+        for level in self.levels():
+            for name in level:
+                task = self.tasks[name]
+                weight = (task.duration or 0) if actual else task.cost
+                best = (0, [])
+                for required in task.requires:
+                    if longest[required][0] > best[0]:
+                        best = longest[required]
+                longest[name] = (best[0] + weight, best[1] + [name])
+        if not longest:
+            return 0, []
+        return max(longest.values(), key=lambda path: path[0])
+
+    def describe(self):
+        """
+        :return: human readable plan of the graph
+        :rtype: list
+        """
+        lines = []
+        for index, level in enumerate(self.levels()):
+            lines.append('Step {0}: {1} task(s) in parallel'.format(index + 1, len(level)))
+            for name in level:
+                requires = self.tasks[name].requires
+                lines.append('    {0}{1}'.format(name, ' (after {0})'.format(', '.join(requires)) if requires else ''))
+        length, path = self.critical_path()
+        lines.append('Critical path: {0} task(s), ~{1}s estimated: {2}'.format(len(path), length, ' -> '.join(path)))
+        return lines
+
+    def timings(self):
+        """
+        :return: (task name, duration in seconds) of executed tasks, slowest first
+        :rtype: list
+        """
+        timings = [(task.name, task.duration) for task in self.tasks.values() if task.duration is not None]
+        return sorted(timings, key=lambda timing: timing[1], reverse=True)
+
+    def failed(self):
+        """
+        :return: tasks which failed or have been skipped
+        :rtype: list
+        """
+        return [self.tasks[name] for name in self.order if self.tasks[name].status in ('failed', 'skipped')]
+
+    def run(self, max_workers=8):
+        """
+        Run all tasks, at most max_workers at the same time
+        :param max_workers: size of the thread pool
+        :type max_workers: int
+        :return: tasks which failed or have been skipped
+        :rtype: list
+        """
+        self.levels()
+        dependents = dict((name, []) for name in self.order)
+        for task in self.tasks.values():
+            for required in task.requires:
+                dependents[required].append(task.name)
+        waiting = dict((name, len(self.tasks[name].requires)) for name in self.order)
+        running = {}
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            finished = []
+            ready = [name for name in self.order if not waiting[name]]
+            while ready or running:
+                for name in ready:
+                    task = self.tasks[name]
+                    if [required for required in task.requires if self.tasks[required].status != 'done']:
+                        task.status = 'skipped'
+                        finished.append(name)
+                    else:
+                        task.status = 'running'
+                        running[executor.submit(task.run)] = task
+                ready = []
+                if not finished and running:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = running.pop(future)
+                        if future.exception() is not None:
+                            task.status = 'failed'
+                            task.error = future.exception()
+                        else:
+                            task.status = 'done'
+                        finished.append(task.name)
+                for name in finished:
+                    for dependent in dependents[name]:
+                        waiting[dependent] -= 1
+                        if not waiting[dependent]:
+                            ready.append(dependent)
+                finished = []
+        finally:
+            executor.shutdown(wait=True)
+        return self.failed()
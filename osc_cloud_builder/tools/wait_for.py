@@ -32,8 +32,211 @@ Collection of generic functions
 __author__      = "Heckle"
 __copyright__   = "BSD"
 
+import re
 import time
-from osc_cloud_builder.OCBase import SLEEP_SHORT
+import random
+from boto.ec2.ec2object import EC2Object
+from boto.ec2.instance import Instance
+from boto.ec2.volume import Volume
+from boto.ec2.snapshot import Snapshot
+from boto.exception import EC2ResponseError
+from osc_cloud_builder.vendor.outscale.fcu.snapshot_export_task import SnapshotExportTask
+from osc_cloud_builder.vendor.outscale.fcu.image_export_task import ImageExportTask
+
+SLEEP_MIN = 1
+SLEEP_MAX = 30
+
+
+def _describe_instances(connection, ids):
+    return connection.get_only_instances(instance_ids=ids)
+
+
+def _describe_volumes(connection, ids):
+    return connection.get_all_volumes(volume_ids=ids)
+
+
+def _describe_snapshots(connection, ids):
+    return connection.get_all_snapshots(snapshot_ids=ids)
+
+
+def _describe_snapshot_export_tasks(connection, ids):
+    return connection.get_all_snapshot_export_tasks(snapshot_export_ids=ids)
+
+
+def _describe_image_export_tasks(connection, ids):
+    return connection.get_all_image_export_tasks(image_export_ids=ids)
+
+
+def _describe_nat_gateways(connection, ids):
+    params = {}
+    connection.build_list_params(params, ids, 'NatGatewayId')
+    with connection.api_version(connection.NatGatewayAPIVersion):
+        return connection.get_list('DescribeNatGateways', params, [('item', EC2Object)])
+
+
+def _is_nat_gateway(obj):
+    return isinstance(obj, EC2Object) and hasattr(obj, 'natGatewayId')
+
+
+# (name, predicate, id attribute, state attribute, describe function)
+# Order matters: the first matching predicate wins.
+RESOURCE_TYPES = [
+    ('instance', lambda obj: isinstance(obj, Instance), 'id', 'state', _describe_instances),
+    ('volume', lambda obj: isinstance(obj, Volume), 'id', 'status', _describe_volumes),
+    ('snapshot', lambda obj: isinstance(obj, Snapshot), 'id', 'status', _describe_snapshots),
+    ('snapshot_export_task', lambda obj: isinstance(obj, SnapshotExportTask), 'id', 'state', _describe_snapshot_export_tasks),
+    ('image_export_task', lambda obj: isinstance(obj, ImageExportTask), 'id', 'state', _describe_image_export_tasks),
+    ('nat_gateway', _is_nat_gateway, 'natGatewayId', 'state', _describe_nat_gateways),
+]
+
+
+class BatchWaiter(object):
+    """
+    Wait for many cloud ressources at once.
+
+    Pending ressources are grouped by type and connection, each group is refreshed
+    with a single Describe call per sweep. Sweeps are spaced with an exponential
+    backoff with full jitter and never sleep past the deadline.
+    Ressources of unknown type are refreshed one by one with their update() method.
+    """
+
+    def __init__(self, objs, state_name, timeout=120, min_sleep=SLEEP_MIN, max_sleep=SLEEP_MAX):
+        """
+        :param objs: list of boto objects
+        :type objs: list
+        :param state_name: state name expected
+        :type state_name: str
+        :param timeout: Timeout for ressources to reach state_name
+        :type timeout: int
+        :param min_sleep: shortest delay between two sweeps
+        :type min_sleep: float
+        :param max_sleep: longest delay between two sweeps
+        :type max_sleep: float
+        """
+        self.state_name = state_name
+        self.deadline = time.time() + timeout
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.pending = [obj for obj in objs if self._resource_type(obj) or hasattr(obj, 'update')]
+        self.describe_calls = 0
+
+    @staticmethod
+    def _resource_type(obj):
+        for resource_type in RESOURCE_TYPES:
+            if resource_type[1](obj):
+                return resource_type
+        return None
+
+    def _groups(self):
+        """
+        :return: pending objects grouped by (type name, connection) and objects without group
+        :rtype: dict, list
+        """
+        groups = {}
+        others = []
+        for obj in self.pending:
+            resource_type = self._resource_type(obj)
+            if resource_type is None or getattr(obj, 'connection', None) is None:
+                others.append(obj)
+                continue
+            key = (resource_type[0], id(obj.connection))
+            groups.setdefault(key, (resource_type, obj.connection, []))[2].append(obj)
+        return groups, others
+
+    def _describe(self, describe, connection, ids):
+        """
+        Describe ids, skipping the ones which are not found
+        :return: fresh objects of the ids found
+        :rtype: list
+        """
+        try:
+            return describe(connection, ids)
+        except EC2ResponseError as err:
+            # Newly created ressources may not be visible yet, one unknown ID fails the whole call
+            if not err.error_code or not err.error_code.endswith('NotFound'):
+                raise
+            missing = set(re.findall(r'[\w-]+', err.error_message or '')) & set(ids)
+            if missing and len(missing) < len(ids):
+                return self._describe(describe, connection, [ressource_id for ressource_id in ids if ressource_id not in missing])
+            if missing or len(ids) == 1:
+                return []
+            # the message does not name the unknown IDs
+            middle = len(ids) // 2
+            return self._describe(describe, connection, ids[:middle]) + self._describe(describe, connection, ids[middle:])
+        finally:
+            self.describe_calls += 1
+
+    def _refresh_group(self, resource_type, connection, objs):
+        """
+        Refresh a group of objects with one Describe call
+        :return: objects which reached the expected state
+        :rtype: list
+        """
+        name, _, id_attr, state_attr, describe = resource_type
+        fresh_objs = self._describe(describe, connection, [getattr(obj, id_attr) for obj in objs])
+        fresh_by_id = dict((getattr(fresh, id_attr, None), fresh) for fresh in fresh_objs)
+        done = []
+        for obj in objs:
+            fresh = fresh_by_id.get(getattr(obj, id_attr))
+            if fresh is None:
+                continue
+            obj.__dict__.update(fresh.__dict__)
+            if getattr(obj, state_attr, None) == self.state_name:
+                done.append(obj)
+        return done
+
+    def sweep(self):
+        """
+        Refresh all pending objects once
+        :return: boto objects which are not in the expected state_name
+        :rtype: list
+        """
+        groups, others = self._groups()
+        done = []
+        for resource_type, connection, objs in groups.values():
+            done.extend(self._refresh_group(resource_type, connection, objs))
+        for obj in others:
+            if obj.update() == self.state_name:
+                done.append(obj)
+        self.pending = [obj for obj in self.pending if obj not in done]
+        return self.pending
+
+    def wait(self):
+        """
+        Sweep until all objects reached the expected state or the deadline is over
+        :return: boto objects which are not in the expected state_name
+        :rtype: list
+        """
+        if self.pending:
+            wait_until(lambda: not self.sweep(), self.deadline - time.time(), self.min_sleep, self.max_sleep)
+        return self.pending
+
+
+def wait_until(condition, timeout=120, min_sleep=SLEEP_MIN, max_sleep=SLEEP_MAX):
+    """
+    Call condition until it returns a true value.
+    Calls are spaced with an exponential backoff with full jitter and never sleep past the deadline.
+    :param condition: callable without parameter
+    :type condition: callable
+    :param timeout: Timeout for condition to be true
+    :type timeout: int
+    :param min_sleep: shortest delay between two calls
+    :type min_sleep: float
+    :param max_sleep: longest delay between two calls
+    :type max_sleep: float
+    :return: last value returned by condition
+    """
+    deadline = time.time() + timeout
+    attempt = 0
+    while True:
+        result = condition()
+        remaining = deadline - time.time()
+        if result or remaining <= 0:
+            return result
+        delay = random.uniform(min_sleep, min(max_sleep, min_sleep * 2 ** attempt))
+        time.sleep(min(delay, remaining))
+        attempt += 1
+
 
 def wait_state(objs, state_name, timeout=120):
     """
@@ -48,13 +251,4 @@ def wait_state(objs, state_name, timeout=120):
     :rtype: list
 
     """
-    objs = [obj for obj in objs if hasattr(obj, 'update')]
-
-    timeout = time.time() + timeout
-    while time.time() < timeout and objs:
-        for obj in objs:
-            if obj.update() == state_name:
-                objs.remove(obj)
-            time.sleep(SLEEP_SHORT)
-
-    return objs
+    return BatchWaiter(objs, state_name, timeout).wait()
@@ -104,6 +104,20 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
         'boto==2.47.0',
+        'futures==3.2.0',
         'lxml==3.6.4',
     ],
+
+    # Optional dependencies, installed with: pip install osc_cloud_builder[ssh]
+    extras_require={
+        'ssh': ['paramiko'],
+    },
+
+    # To provide executable scripts, use entry points in preference to the
+    # "scripts" keyword.
+    entry_points={
+        'console_scripts': [
+            'ocb=osc_cloud_builder.cli:main',
+        ],
+    },
 )